@@ -14,9 +14,11 @@ from flask_restful import Api, Resource
 from flasgger import Swagger
 from flask_cors import CORS
 from tranql.concept import ConceptModel
-from tranql.main import TranQL, TranQLIncompleteParser
-from tranql.tranql_ast import SelectStatement
+from tranql.main import InterpreterPool, ProgramCache, TranQLIncompleteParser, program_cache
+from tranql.tranql_ast import QueryPlanStrategy, SelectStatement
+from tranql.kp_statistics import kp_statistics
 from tranql.tranql_schema import GraphTranslator
+from tranql.utils.merge_utils import SCORE_POLICIES
 from tranql.exception import TranQLException
 
 logger = logging.getLogger (__name__)
@@ -24,6 +26,8 @@ logger = logging.getLogger (__name__)
 web_app_root = os.path.join (os.path.dirname (__file__), "..", "web", "build")
 
 app = Flask(__name__)
+interpreter_pool = InterpreterPool ()
+prepared_programs = ProgramCache (maxsize=program_cache.maxsize)
 #app = Flask(__name__, static_folder=web_app_root)
 #dashboard.bind(app)
 
@@ -123,6 +127,14 @@ class StandardAPIResource(Resource):
 
         return result
 
+    @staticmethod
+    def streaming_options (request):
+        """ Interpreter options for streaming handoff, if the request sets them. Otherwise conf.yml applies. """
+        options = {}
+        if 'streaming_handoff' in request.args:
+            options['streaming_handoff'] = request.args.get('streaming_handoff').upper() == 'TRUE'
+        return options
+
     @staticmethod
     def response(data):
         status_code = 200
@@ -324,6 +336,15 @@ class MergeMessages(StandardAPIResource):
                 (Experimental) Tells the merger to invoke the Bionames API on nodes in order to get more equivalent identifiers.
                 Ideally, this should result in a more thoroughly merged graph, as fewer equivalent nodes will fail to be detected.
                 This currently should not be used on large queries (1000+ nodes), or it will end up flooding the Bionames API.
+            - in: query
+              name: score_policy
+              schema:
+                type: string
+                enum: [last, max, sum, product]
+              required: false
+              description: >
+                How the scores of the answers a merged answer was joined from combine into its score. Defaults to
+                SCORE_POLICY in the configuration, which is `last`: the score of the last of them.
             - in: query
               name: question_graph
               schema:
@@ -362,13 +383,17 @@ class MergeMessages(StandardAPIResource):
             "name_based_merging" : request.args.get('name_based_merging','true').upper() == 'TRUE',
             "resolve_names" : request.args.get('resolve_names','false').upper() == 'TRUE'
         }
+        if 'score_policy' in request.args:
+            if request.args['score_policy'] not in SCORE_POLICIES:
+                return {"message" : f"Unknown score_policy. Expected one of {', '.join(SCORE_POLICIES)}."}, 400
+            interpreter_options["score_policy"] = request.args['score_policy']
         root_question_graph = json.loads(request.args['question_graph'])
         root_order = request.args.get('root_order',None)
         if root_order != None:
             # werkzeug.ImmutableMultiDict.getlist doesn't allow for a default if the key isn't present,
             # so first check if its present, and, if so, get it as a list.
             root_order = request.args.getlist('root_order')
-        tranql = TranQL (options=interpreter_options)
+        tranql = interpreter_pool.get (options=interpreter_options)
         return self.response(SelectStatement.merge_results(messages,tranql,root_question_graph,root_order))
 class TranQLQuery(StandardAPIResource):
     """ TranQL Resource. """
@@ -409,6 +434,21 @@ class TranQLQuery(StandardAPIResource):
               required: false
               default: true
               description: Specifies if requests made by TranQL will be asynchronous.
+            - in: query
+              name: streaming_handoff
+              schema:
+                type: boolean
+              required: false
+              description: Pass bindings between plan segments as each response arrives. Defaults to STREAMING_HANDOFF in conf.yml.
+            - in: query
+              name: explain
+              schema:
+                type: string
+                enum: [plan, analyze]
+              required: false
+              description: >
+                Like prefixing select statements with EXPLAIN or EXPLAIN ANALYZE. The result is then
+                an explain object describing each plan segment, with its timings and counts when analyzed.
         responses:
             '200':
                 description: Message
@@ -432,12 +472,14 @@ class TranQLQuery(StandardAPIResource):
         dynamic_id_resolution = request.args.get('dynamic_id_resolution','False').upper() == 'TRUE'
         asynchronous = request.args.get('asynchronous', 'True').upper() == 'TRUE'
         logging.debug (f"--> query: {query}")
-        tranql = TranQL (options = {
+        tranql = interpreter_pool.get (options = {
             "dynamic_id_resolution" : dynamic_id_resolution,
             "asynchronous" : asynchronous,
             "registry": app.config.get('registry', False),
             # when testing new schema should be created as per the test case
-            "recreate_schema": app.config.get('TESTING', True)
+            "recreate_schema": app.config.get('TESTING', True),
+            "explain": request.args.get('explain', None),
+            **self.streaming_options (request)
         })
         try:
             context = tranql.execute (query) #, cache=True)
@@ -452,6 +494,165 @@ class TranQLQuery(StandardAPIResource):
             result = self.handle_exception (errors)
         return self.response(result)
 
+class PrepareQuery(StandardAPIResource):
+    """ Compile a TranQL program once for repeated execution. """
+
+    def __init__(self):
+        super().__init__()
+
+    def post(self):
+        """
+        Prepare a TranQL query
+        ---
+        tags: [query]
+        description: |
+            Parse and plan a TranQL program, returning an identifier to execute it
+            with at /tranql/execute/{id} and its parameters: the variables it reads
+            before setting them, in concept values, constraints, FROM clauses or SET values.
+            For example:
+            ```
+               select chemical_substance->gene->disease
+                 from \"/schema\"
+                where disease=$disease
+            ```
+        requestBody:
+            description: TranQL program
+            required: true
+            content:
+                text/plain:
+                    schema:
+                        type: string
+        responses:
+            '200':
+                description: Prepared statement
+                content:
+                    application/json:
+                        schema:
+                          type: object
+            '500':
+                description: An error was encountered
+                content:
+                    application/json:
+                        schema:
+                          $ref: '#/definitions/Error'
+        """
+        query = request.data.decode('utf-8')
+        tranql = interpreter_pool.get (options = {
+            "registry": app.config.get('registry', False),
+            # when testing new schema should be created as per the test case
+            "recreate_schema": app.config.get('TESTING', True)
+        })
+        try:
+            prepared = tranql.prepare (query)
+            prepared_programs.put (prepared.id, prepared)
+            result = {
+                "id" : prepared.id,
+                "parameters" : prepared.parameters
+            }
+        except Exception as e:
+            result = self.handle_exception (e)
+        return self.response(result)
+
+class ExecutePrepared(StandardAPIResource):
+    """ Execute a prepared TranQL program with bound variables. """
+
+    def __init__(self):
+        super().__init__()
+
+    def post(self, id):
+        """
+        Execute a prepared TranQL query
+        ---
+        tags: [query]
+        description: |
+            Execute a program prepared with /tranql/prepare. The request body is a JSON
+            object binding a value to each of the program's parameters, and nothing else,
+            e.g. {"disease" : "MONDO:0004979"}.
+        parameters:
+            - in: path
+              name: id
+              schema:
+                type: string
+              required: true
+              description: The identifier returned by /tranql/prepare
+            - in: query
+              name: dynamic_id_resolution
+              schema:
+                type: boolean
+              required: false
+              default: false
+              description: Specifies if dynamic id lookup of curies will be performed
+            - in: query
+              name: asynchronous
+              schema:
+                type: boolean
+              required: false
+              default: true
+              description: Specifies if requests made by TranQL will be asynchronous.
+            - in: query
+              name: streaming_handoff
+              schema:
+                type: boolean
+              required: false
+              description: Pass bindings between plan segments as each response arrives. Defaults to STREAMING_HANDOFF in conf.yml.
+        requestBody:
+            description: Variable bindings
+            required: false
+            content:
+                application/json:
+                    schema:
+                        type: object
+        responses:
+            '200':
+                description: Message
+                content:
+                    application/json:
+                        schema:
+                          $ref: '#/definitions/Message'
+            '400':
+                description: The bindings don't match the program's parameters
+            '404':
+                description: No prepared statement has this identifier
+            '500':
+                description: An error was encountered
+                content:
+                    application/json:
+                        schema:
+                          $ref: '#/definitions/Error'
+        """
+        prepared = prepared_programs.get (id)
+        if prepared is None:
+            return self.handle_exception (TranQLException (f"Unknown prepared statement: {id}",
+                                                           details="Prepare the program again at /tranql/prepare.")), 404
+        bindings = request.get_json (silent=True) or {}
+        if not isinstance(bindings, dict):
+            return {"message" : "Bindings must be a JSON object."}, 400
+        unknown = [ name for name in bindings if name not in prepared.parameters ]
+        missing = [ name for name in prepared.parameters if name not in bindings ]
+        if len(unknown) > 0 or len(missing) > 0:
+            return {"message" : f"Bindings must set exactly the program's parameters: {', '.join(prepared.parameters)}. "
+                                f"Unknown: {', '.join(unknown) or 'none'}. Missing: {', '.join(missing) or 'none'}."}, 400
+        dynamic_id_resolution = request.args.get('dynamic_id_resolution','False').upper() == 'TRUE'
+        asynchronous = request.args.get('asynchronous', 'True').upper() == 'TRUE'
+        tranql = interpreter_pool.get (options = {
+            "dynamic_id_resolution" : dynamic_id_resolution,
+            "asynchronous" : asynchronous,
+            "registry": app.config.get('registry', False),
+            "recreate_schema": app.config.get('TESTING', True),
+            **self.streaming_options (request)
+        })
+        try:
+            context = prepared.execute (tranql, bindings)
+            result = context.mem.get ('result', {})
+            if len(context.mem.get ('requestErrors', [])) > 0:
+                errors = self.handle_exception(context.mem['requestErrors'], warning=True)
+                result.update(errors)
+        except Exception as e:
+            traceback.print_exc()
+            errors = [e, *tranql.context.mem.get ('requestErrors', [])]
+            result = self.handle_exception (errors)
+        return self.response(result)
+
 class AnnotateGraph(StandardAPIResource):
     """ Request the message object to be annotated by the backplane and return the annotated message """
 
@@ -486,7 +687,7 @@ class AnnotateGraph(StandardAPIResource):
                         schema:
                           $ref: '#/definitions/Error'
         """
-        tranql = TranQL ()
+        tranql = interpreter_pool.get ()
         messageObject = request.json
         url = tranql.context.mem.get('backplane') + '/graph/gnbr/decorate'
 
@@ -535,7 +736,7 @@ class SchemaGraph(StandardAPIResource):
                         schema:
                           $ref: '#/definitions/Error'
         """
-        tranql = TranQL (options={"registry": app.config.get('registry', False)})
+        tranql = interpreter_pool.get (options={"registry": app.config.get('registry', False)})
         schema = tranql.schema
         schemaGraph = GraphTranslator(schema.schema_graph)
 
@@ -547,11 +748,65 @@ class SchemaGraph(StandardAPIResource):
             "schema": schemaGraph.graph_to_message(),
         }
         if len(schema.loadErrors) > 0:
-            errors = self.handle_exception(schema.loadErrors, warning=True)
+            errors = self.handle_exception(list(schema.loadErrors), warning=True)
             for key in errors:
                 obj[key] = errors[key]
         return self.response(obj)
 
+class ReachableTypes(StandardAPIResource):
+    """ Types a query can get to from each type, through intermediate types if need be. """
+
+    def __init__(self):
+        super().__init__()
+
+    def get(self):
+        """
+        Reachable types
+        ---
+        tags: [schema]
+        description: >
+            For each schema type, the types reachable from it and the types reaching it, with
+            the fewest transitions needed, nearest first. Bounded by the planner's maximum path
+            length. Pass type to get a single type's entry.
+        parameters:
+            - in: query
+              name: type
+              schema:
+                type: string
+              required: false
+              description: Only report this type.
+            - in: query
+              name: max_hops
+              schema:
+                type: integer
+                minimum: 0
+              required: false
+              description: Only report types at most this many transitions away.
+        responses:
+            '200':
+                description: Message
+                content:
+                    application/json:
+                        schema:
+                          type: object
+        """
+        try:
+            max_hops = int(request.args.get ('max_hops', QueryPlanStrategy.max_path_hops))
+        except ValueError:
+            max_hops = -1
+        if max_hops < 0:
+            return {"message" : "max_hops must be a non-negative integer."}, 400
+        tranql = interpreter_pool.get (options={"registry": app.config.get('registry', False)})
+        reachability = tranql.schema.reachability
+        types = [ request.args['type'] ] if 'type' in request.args else reachability.successors.keys ()
+        return {
+            t : {
+                "reachable" : reachability.reachable (t, max_hops),
+                "reaching" : reachability.reaching (t, max_hops)
+            }
+            for t in types
+        }
+
 class ModelConceptsQuery(StandardAPIResource):
     """ Query model concepts. """
 
@@ -638,10 +893,57 @@ class ReasonerURLs(StandardAPIResource):
                         schema:
                           type: object
         """
-        tranql = TranQL ()
+        tranql = interpreter_pool.get ()
         schema = tranql.schema
         return { schema[0] : schema[1]['url'] for schema in schema.schema.items() }
 
+class ProgramCacheStatistics(StandardAPIResource):
+    """ Reports on the cache of parsed and planned programs. """
+    def __init__(self):
+        super().__init__()
+
+    def get(self):
+        """
+        Program cache statistics
+        ---
+        tags: [util]
+        description: Returns the size, bound, hits and misses of the parsed program cache.
+        responses:
+            '200':
+                description: Message
+                content:
+                    application/json:
+                        schema:
+                          type: object
+        """
+        return program_cache.stats ()
+
+class PlannerStatistics(StandardAPIResource):
+    """ Explains what the planner knows about knowledge providers. """
+    def __init__(self):
+        super().__init__()
+
+    def get(self):
+        """
+        Knowledge provider statistics
+        ---
+        tags: [util]
+        description: >
+            Returns a row per knowledge provider transition with its observed mean latency,
+            error rate, answers per input curie and number of questions, the cost the planner
+            estimates for it and whether the planner currently leaves it out.
+        responses:
+            '200':
+                description: Message
+                content:
+                    application/json:
+                        schema:
+                          type: array
+                          items:
+                            type: object
+        """
+        return kp_statistics.explain ()
+
 class ParseIncomplete(StandardAPIResource):
     """ Tokenizes an incomplete query and returns the result """
     def __init__(self):
@@ -723,7 +1025,7 @@ class ParseIncomplete(StandardAPIResource):
         else:
             query = request.json
 
-        tranql = TranQL (options= {
+        tranql = interpreter_pool.get (options= {
             'use_registry': app.config.get('registry', False)
         })
         parser = TranQLIncompleteParser (tranql.context.resolve_arg ("$backplane"))
@@ -744,7 +1046,10 @@ class ParseIncomplete(StandardAPIResource):
 ###############################################################################################
 
 api.add_resource(TranQLQuery, '/tranql/query')
+api.add_resource(PrepareQuery, '/tranql/prepare')
+api.add_resource(ExecutePrepared, '/tranql/execute/<id>')
 api.add_resource(SchemaGraph, '/tranql/schema')
+api.add_resource(ReachableTypes, '/tranql/schema/reachable')
 api.add_resource(AnnotateGraph, '/tranql/annotate')
 api.add_resource(MergeMessages,'/tranql/merge_messages')
 api.add_resource(DecorateKG,'/tranql/decorate_kg')
@@ -752,6 +1057,8 @@ api.add_resource(ModelConceptsQuery, '/tranql/model/concepts')
 api.add_resource(ModelRelationsQuery, '/tranql/model/relations')
 api.add_resource(ParseIncomplete, '/tranql/parse_incomplete')
 api.add_resource(ReasonerURLs, '/tranql/reasonerURLs')
+api.add_resource(ProgramCacheStatistics, '/tranql/cache')
+api.add_resource(PlannerStatistics, '/tranql/statistics')
 
 api.add_resource(WebAppPath, '/<path:path>', endpoint='webapp_path')
 api.add_resource(WebAppPath, '/', endpoint='webapp_root', defaults={'path': 'index.html'})
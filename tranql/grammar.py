@@ -10,9 +10,9 @@ Statements can be 'set' or 'select' statements.
 
 """
 statement = Forward()
-SELECT, FROM, WHERE, SET, AS, CREATE, GRAPH, AT = map(
+SELECT, FROM, WHERE, SET, AS, CREATE, GRAPH, AT, EXPLAIN, ANALYZE = map(
     CaselessKeyword,
-    "select from where set as create graph at".split())
+    "select from where set as create graph at explain analyze".split())
 
 concept_name    = Word( alphas, alphanums + ":_")
 ident          = Word( "$" + alphas, alphanums + "_$" ).setName("identifier")
@@ -91,9 +91,13 @@ setExpression << setStatement + ZeroOrMore( ( and_ | or_ ) + setExpression )
 
 optWhite = ZeroOrMore(LineEnd() | White())
 
+""" Explain a select statement's plan instead of running it, or run it and explain where time went. """
+explain = Group(EXPLAIN + Optional(ANALYZE))("explain") + optWhite
+
 """ Define the statement grammar. """
 statement <<= (
     Group(
+        Optional(explain) +
         Group(SELECT + question_graph_expression)("concepts") + optWhite +
         Group(FROM + tableNameList) + optWhite +
         Group(Optional(WHERE + whereExpression("where"), "")) + optWhite +
@@ -142,6 +146,7 @@ openTable = Group(delimitedList(tableNameList | Group((Literal('"') | Literal("'
 
 statement <<= (
     Group(
+        Suppress(Optional(explain)) +
         Group(SELECT + incomplete_question_graph_expression)("concepts") + Suppress(optWhite) +
         Optional(Group(FROM + (openTable | Empty()))) + Suppress(optWhite) +
         Optional(Group(WHERE + whereExpression("where"))) + Suppress(optWhite) +
@@ -0,0 +1,195 @@
+import atexit
+import json
+import logging
+import os
+import threading
+from time import time as now
+from tranql.config import Config
+
+logger = logging.getLogger (__name__)
+
+class KPStatistics:
+    """
+    Observed behaviour of knowledge providers, per (kp, source_type, predicate, target_type)
+    transition: how long questions take, how often they fail and how many answers each input
+    curie yields. The planner uses these to order and prune alternative sources, once a
+    transition has min_samples observations.
+
+    Observations older than ttl seconds are ignored when estimating, so a provider
+    dropped after an outage is tried again eventually.
+
+    The generation changes whenever a transition gains or loses min_samples recent
+    observations, or is pruned or restored, so plans made from the statistics can be
+    cached until then.
+    """
+    def __init__(self, path=None, min_samples=20, max_error_rate=0.5, ttl=86400, default_latency=1.0):
+        self.path = os.path.expanduser (path) if path else None
+        self.min_samples = min_samples
+        self.max_error_rate = max_error_rate
+        self.ttl = ttl
+        self.default_latency = default_latency
+        self.lock = threading.Lock ()
+        self.entries = {}
+        self.epoch = 0
+        """ When the earliest trusted observations expire, and the generation with them. """
+        self.expiry = None
+        if self.path is not None:
+            self.load ()
+
+    def __deepcopy__ (self, memo):
+        """ Statistics are shared by every copy of a planner, so cloning a program keeps them. """
+        return self
+
+    @staticmethod
+    def from_config (config):
+        """ Build statistics from a PLANNER configuration section. """
+        if config is None:
+            return KPStatistics ()
+        return KPStatistics (
+            path=config.get ('STATISTICS_PATH', None),
+            min_samples=int(config.get ('MIN_SAMPLES', 20)),
+            max_error_rate=float(config.get ('MAX_ERROR_RATE', 0.5)),
+            ttl=float(config.get ('TTL', 86400)),
+            default_latency=float(config.get ('DEFAULT_LATENCY', 1.0)))
+
+    def record (self, kp, source_type, predicate, target_type, requests, errors, latency, inputs, answers):
+        """
+        Add the outcome of sending requests questions over a transition: how many failed,
+        their total latency in seconds, how many curies they were asked about and how many
+        answers came back.
+        """
+        key = (kp, source_type, predicate, target_type)
+        with self.lock:
+            entry = self.entries.get (key, None)
+            before = self.status (entry)
+            if entry is None or now () - entry['updated'] > self.ttl:
+                entry = { "requests" : 0, "errors" : 0, "latency" : 0.0, "inputs" : 0, "answers" : 0 }
+                self.entries[key] = entry
+            entry['requests'] += requests
+            entry['errors'] += errors
+            entry['latency'] += latency
+            entry['inputs'] += inputs
+            entry['answers'] += answers
+            entry['updated'] = now ()
+            if self.status (entry) != before:
+                self.epoch += 1
+            if self.status (entry) is not None and self.expiry is None:
+                self.expiry = entry['updated'] + self.ttl
+
+    def status (self, entry):
+        """ None for an entry without min_samples recent observations, else whether it is pruned. """
+        if entry is None or entry['requests'] < max (self.min_samples, 1) or now () - entry['updated'] > self.ttl:
+            return None
+        fan_out = entry['answers'] / entry['inputs'] if entry['inputs'] > 0 else 0.0
+        return entry['errors'] / entry['requests'] >= self.max_error_rate or fan_out == 0
+
+    def generation (self):
+        """ A number that changes whenever what the planner decides from these statistics may change. """
+        with self.lock:
+            if self.expiry is not None and now () > self.expiry:
+                self.epoch += 1
+                expiries = [ entry['updated'] + self.ttl for entry in self.entries.values () if self.status (entry) is not None ]
+                self.expiry = min (expiries) if len(expiries) > 0 else None
+            return self.epoch
+
+    def get (self, kp, source_type, predicate, target_type):
+        """ Current estimates for a transition, or None if there are no recent observations. """
+        with self.lock:
+            entry = self.entries.get ((kp, source_type, predicate, target_type), None)
+            if entry is None or entry['requests'] == 0 or now () - entry['updated'] > self.ttl:
+                return None
+            entry = dict(entry)
+        return {
+            "samples" : entry['requests'],
+            "latency" : entry['latency'] / entry['requests'],
+            "error_rate" : entry['errors'] / entry['requests'],
+            "fan_out" : entry['answers'] / entry['inputs'] if entry['inputs'] > 0 else 0.0
+        }
+
+    def trusted (self, kp, source_type, predicate, target_type):
+        """ Estimates for a transition with at least min_samples recent observations, or None. """
+        estimate = self.get (kp, source_type, predicate, target_type)
+        return estimate if estimate is not None and estimate['samples'] >= self.min_samples else None
+
+    def cost (self, kp, source_type, predicate, target_type):
+        """ Expected seconds to get an answered question, counting retries for failures. """
+        estimate = self.trusted (kp, source_type, predicate, target_type)
+        if estimate is None:
+            return self.default_latency
+        return estimate['latency'] / max (1 - estimate['error_rate'], 0.01)
+
+    def fan_out (self, kp, source_type, predicate, target_type):
+        """ Expected answers per input curie, or None if unknown. """
+        estimate = self.trusted (kp, source_type, predicate, target_type)
+        return None if estimate is None else estimate['fan_out']
+
+    def useless (self, kp, source_type, predicate, target_type):
+        """ True if enough recent observations show a transition mostly fails or never answers. """
+        estimate = self.trusted (kp, source_type, predicate, target_type)
+        return estimate is not None and \
+            (estimate['error_rate'] >= self.max_error_rate or estimate['fan_out'] == 0)
+
+    def explain (self):
+        """ A row per transition with its estimates, for display. """
+        with self.lock:
+            keys = sorted (self.entries.keys (), key=lambda k: tuple (str(part) for part in k))
+        rows = []
+        for kp, source_type, predicate, target_type in keys:
+            estimate = self.get (kp, source_type, predicate, target_type)
+            if estimate is None:
+                continue
+            rows.append ({
+                "kp" : kp,
+                "source_type" : source_type,
+                "predicate" : predicate,
+                "target_type" : target_type,
+                **estimate,
+                "cost" : self.cost (kp, source_type, predicate, target_type),
+                "pruned" : self.useless (kp, source_type, predicate, target_type)
+            })
+        return rows
+
+    def clear (self):
+        with self.lock:
+            self.entries = {}
+            self.epoch += 1
+            self.expiry = None
+
+    def load (self):
+        """ Read observations saved by an earlier run. A missing or unreadable file starts afresh. """
+        try:
+            with open (self.path, "r") as stream:
+                rows = json.load (stream)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning (f"Ignoring unreadable KP statistics {self.path}: {e}")
+            return
+        with self.lock:
+            for row in rows:
+                key = (row['kp'], row['source_type'], row['predicate'], row['target_type'])
+                self.entries[key] = { k : row[k] for k in [ "requests", "errors", "latency", "inputs", "answers", "updated" ] }
+            expiries = [ entry['updated'] + self.ttl for entry in self.entries.values () if self.status (entry) is not None ]
+            self.expiry = min (expiries) if len(expiries) > 0 else None
+            self.epoch += 1
+
+    def save (self):
+        """ Write observations to the configured path, if any. """
+        if self.path is None:
+            return
+        with self.lock:
+            rows = [
+                { "kp" : kp, "source_type" : source_type, "predicate" : predicate, "target_type" : target_type, **entry }
+                for (kp, source_type, predicate, target_type), entry in self.entries.items ()
+            ]
+        try:
+            os.makedirs (os.path.dirname (self.path) or ".", exist_ok=True)
+            temporary = f"{self.path}.{os.getpid ()}"
+            with open (temporary, "w") as stream:
+                json.dump (rows, stream)
+            os.replace (temporary, self.path)
+        except OSError as e:
+            logger.warning (f"Unable to save KP statistics to {self.path}: {e}")
+
+kp_statistics = KPStatistics.from_config (Config ("conf.yml").get ('PLANNER', None))
+atexit.register (kp_statistics.save)
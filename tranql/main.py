@@ -31,30 +31,105 @@
 #    available data sets.
 
 import argparse
+import asyncio
+import copy
+import hashlib
 import json
 import logging
 import os
+import re
 import requests_cache
 import sys
+import threading
 import traceback
+from collections import OrderedDict
 from tranql.config import Config
 from tranql.util import Context
 from tranql.util import JSONKit
 from tranql.util import Concept
 from tranql.util import LoggingUtil
-from tranql.tranql_ast import TranQL_AST
+from tranql.tranql_ast import TranQL_AST, SelectStatement, SetStatement
 from tranql.grammar import program_grammar, incomplete_program_grammar
 from tranql.tranql_schema import SchemaFactory
+from tranql.request_util import event_loop, run_blocking
+from tranql.kp_statistics import kp_statistics
 from pyparsing import ParseException
 from tranql.exception import TranQLException
 
 LoggingUtil.setup_logging ()
 logger = logging.getLogger (__name__)
 
+class ProgramCache:
+    """
+    A bounded LRU of parsed and planned programs. Keys are the normalized program
+    text, the version of the schema it was planned against and the generation of the
+    KP statistics that ordered and pruned its sources. Entries are never
+    handed out directly: execution mutates concepts, so callers get a clone.
+    """
+    keywords = set ("select from where set as create graph at explain analyze and or in eq ne lt le gt ge".split ())
+    token = re.compile (r"""(?P<string>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")|""" +
+                        r"(?P<space>(?:\s|--[^\n]*)+)|" +
+                        r"(?P<word>[$A-Za-z_][$\w]*)")
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.programs = OrderedDict ()
+        self.lock = threading.Lock ()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize (program):
+        """ Drop comments, collapse whitespace and lower case keywords outside of quoted strings. """
+        def replace (match):
+            text = match.group ()
+            if match.lastgroup == 'space':
+                return ' '
+            if match.lastgroup == 'word' and text.lower () in ProgramCache.keywords:
+                return text.lower ()
+            return text
+        return ProgramCache.token.sub (replace, program).strip ()
+
+    def get (self, key):
+        with self.lock:
+            program = self.programs.get (key, None)
+            if program is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.programs.move_to_end (key)
+            return program
+
+    def put (self, key, program):
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.programs[key] = program
+            self.programs.move_to_end (key)
+            while len(self.programs) > self.maxsize:
+                self.programs.popitem (last=False)
+
+    def clear (self):
+        with self.lock:
+            self.programs.clear ()
+            self.hits = 0
+            self.misses = 0
+
+    def stats (self):
+        return {
+            "size" : len(self.programs),
+            "maxsize" : self.maxsize,
+            "hits" : self.hits,
+            "misses" : self.misses
+        }
+
+program_cache = ProgramCache (maxsize=int(Config ("conf.yml").get ('PROGRAM_CACHE_SIZE', 256)))
+
 class Parser:
-    def __init__(self, grammar, schema):
+    def __init__(self, grammar, schema, cache=None):
         self.program = grammar
         self.schema = schema
+        self.cache = cache
         # self.backplane = backplane
         # self.use_registry = use_registry
 
@@ -62,6 +137,21 @@ class Parser:
         return self.program.parseString (line)
 
     def parse (self, line):
+        """ Parse and plan a program, reusing a cached copy if one exists. """
+        if self.cache is None:
+            return self.compile (line)
+        key = (ProgramCache.normalize (line), getattr (self.schema, 'version', None), kp_statistics.generation ())
+        ast = self.cache.get (key)
+        if ast is None:
+            ast = self.compile (line)
+            ast.plan ()
+            if not ast.cacheable:
+                """ User defined functions were evaluated while parsing. """
+                return ast
+            self.cache.put (key, ast)
+        return ast.clone ()
+
+    def compile (self, line):
         """ Parse a program, returning an abstract syntax tree. """
         try:
             result = self.tokenize (line)
@@ -77,24 +167,64 @@ class Parser:
 
 class TranQLParser(Parser):
     """ Defines the language's grammar. """
-    def __init__(self, schema):
-        super().__init__ (program_grammar, schema)
+    def __init__(self, schema, cache=program_cache):
+        super().__init__ (program_grammar, schema, cache)
 
 class TranQLIncompleteParser(Parser):
     def __init__(self, schema):
         super().__init__ (incomplete_program_grammar, schema)
 
-class TranQL:
+class PreparedProgram:
     """
-    Define the language interpreter.
-    It provides an interface to
-      Execute the parser
-      Generate an abstract syntax tree
-      Execute statements in the abstract syntax tree.
+    A program parsed and planned once, then executed any number of times with
+    different values bound to its variables.
+    """
+    def __init__(self, program, ast):
+        self.program = program
+        self.ast = ast
+        self.id = hashlib.sha1 (ProgramCache.normalize (program).encode ('utf-8')).hexdigest ()
+        self.parameters = self.find_parameters (ast)
+        self.generation = kp_statistics.generation ()
+        """ Requests share prepared programs. Only one of them re-plans at a time. """
+        self.lock = threading.Lock ()
+
+    @staticmethod
+    def find_parameters (ast):
+        """
+        Variables the program reads before setting them, wherever a statement resolves
+        one: concept values, where clause constraints, FROM clauses and SET values.
+        """
+        assigned = set ()
+        parameters = []
+        for statement in ast.statements:
+            reads = statement.reads ()
+            if isinstance(statement, SelectStatement):
+                reads = reads - statement.implicit_reads
+            parameters.extend (sorted (reads - assigned - set (parameters)))
+            assigned.update (statement.writes ())
+        return parameters
+
+    def execute (self, interpreter, bindings=None):
+        """ Bind variables in the interpreter's context and execute a copy of the program. """
+        generation = kp_statistics.generation ()
+        with self.lock:
+            if self.ast.schema is not interpreter.schema or self.generation != generation:
+                """ Planned against an older schema snapshot or older statistics. Plan again. """
+                ast = interpreter.parser.compile (self.program)
+                ast.plan ()
+                self.ast = ast
+                self.generation = generation
+            ast = self.ast
+        for name, value in (bindings or {}).items ():
+            interpreter.context.set (name, value)
+        return interpreter.execute (ast.clone ())
+
+class InterpreterState:
+    """
+    The expensive, request independent parts of an interpreter: configuration,
+    schema and parser. Built once and shared by every interpreter that uses it.
     """
     def __init__(self, backplane="http://localhost:8099", options={}):
-        """ Initialize the interpreter. """
-        self.context = Context ()
         config_path = "conf.yml"
         self.config = Config (config_path)
 
@@ -105,7 +235,63 @@ class TranQL:
         env_backplane = self.config['BACKPLANE']
         if env_backplane:
             backplane = env_backplane
-        self.context.set ("backplane", backplane)
+        self.backplane = backplane
+
+        self.use_registry = options.get("registry", False) or self.config.get('USE_REGISTRY', False)
+        # for testing singleton is causing problems
+        recreate_schema = options.get('recreate_schema', False)
+        schema_factory = SchemaFactory(backplane=backplane, use_registry=self.use_registry, update_interval=20*60, create_new=recreate_schema)
+        self.schema = schema_factory.get_instance()
+        self.parser = TranQLParser (self.schema)
+
+    def use_schema (self, schema):
+        """ Share this state's configuration with a newer schema snapshot. """
+        state = copy.copy (self)
+        state.schema = schema
+        state.parser = TranQLParser (schema)
+        return state
+
+class InterpreterPool:
+    """
+    Hand out interpreters that share an InterpreterState. Each interpreter gets
+    its own context and request scoped options, so building one per request
+    costs a Context rather than a config read, schema copy and parser.
+    """
+    def __init__(self, backplane="http://localhost:8099"):
+        self.backplane = backplane
+        self.states = {}
+        self.lock = threading.Lock ()
+
+    def get (self, options=None):
+        """ Get an interpreter configured with the given options. """
+        options = options or {}
+        key = bool(options.get ("registry", False))
+        with self.lock:
+            state = self.states.get (key, None)
+            if state is None or options.get ('recreate_schema', False):
+                state = InterpreterState (backplane=self.backplane, options=options)
+                self.states[key] = state
+            elif state.schema is not SchemaFactory.get_instance ():
+                """ The schema was refreshed. New requests use the new snapshot. """
+                state = state.use_schema (SchemaFactory.get_instance ())
+                self.states[key] = state
+        return TranQL (backplane=self.backplane, options=options, state=state)
+
+class TranQL:
+    """
+    Define the language interpreter.
+    It provides an interface to
+      Execute the parser
+      Generate an abstract syntax tree
+      Execute statements in the abstract syntax tree.
+    """
+    def __init__(self, backplane="http://localhost:8099", options={}, state=None):
+        """ Initialize the interpreter. """
+        self.context = Context ()
+        if state is None:
+            state = InterpreterState (backplane=backplane, options=options)
+        self.config = state.config
+        self.context.set ("backplane", state.backplane)
 
 
         # Priority:
@@ -116,18 +302,38 @@ class TranQL:
         self.asynchronous = options.get("asynchronous", self.config.get('ASYNCHRONOUS_REQUESTS', True))
         self.name_based_merging = options.get("name_based_merging", self.config.get('NAME_BASED_MERGING', True))
         self.resolve_names = options.get("resolve_names", self.config.get('RESOLVE_NAMES', False))
+        self.score_policy = options.get("score_policy", self.config.get('SCORE_POLICY', 'last'))
         self.dynamic_id_resolution = options.get("dynamic_id_resolution", self.config.get('DYNAMIC_ID_RESOLUTION', False))
-        self.use_registry = options.get("registry", False) or self.config.get('USE_REGISTRY', False)
-        # for testing singleton is causing problems
+        self.streaming_handoff = self.flag (options.get("streaming_handoff", self.config.get('STREAMING_HANDOFF', False)))
+        self.handoff_window = options.get("handoff_window", self.config.get('HANDOFF_WINDOW', 10))
+        self.question_window = options.get("question_window", self.config.get('QUESTION_WINDOW', 16))
+        self.answer_budget = options.get("answer_budget", self.config.get('ANSWER_BUDGET', None))
+        self.time_budget = options.get("time_budget", self.config.get('TIME_BUDGET', None))
+        self.parallel_statements = self.flag (options.get("parallel_statements", self.config.get('PARALLEL_STATEMENTS', True)))
+        """ Explain every select statement: "plan" instead of running it, "analyze" after running it. """
+        self.explain = options.get("explain", None)
+        self.use_registry = state.use_registry
         self.recreate_schema = options.get('recreate_schema', False)
-        schema_factory = SchemaFactory(backplane=backplane, use_registry=self.use_registry, update_interval=20*60, create_new=self.recreate_schema)
-        self.schema = schema_factory.get_instance()
-        self.parser = TranQLParser (self.schema)
+        self.schema = state.schema
+        self.parser = state.parser
+
+    @staticmethod
+    def flag (value):
+        """ A boolean option. Values from the environment are strings, so "false" is False. """
+        if isinstance(value, str):
+            return value.strip ().lower () in [ 'true', 'yes', 'on', '1' ]
+        return bool(value)
 
     def parse (self, program):
         """ If we just want the AST. """
         return self.parser.parse (program)
 
+    def prepare (self, program):
+        """ Parse and plan a program for repeated execution with bound variables. """
+        ast = self.parser.compile (program)
+        ast.plan ()
+        return PreparedProgram (program, ast)
+
     def parse_file (self, file_name):
         result = None
         with open(file_name, "r") as stream:
@@ -136,6 +342,13 @@ class TranQL:
 
     def execute (self, program, cache=False):
         """ Execute a program - a list of statements. """
+        return event_loop.run (self.execute_async (program, cache))
+
+    async def execute_async (self, program, cache=False):
+        """
+        Execute a program on the event loop. Statements that don't share variables run
+        concurrently, the others in program order, unless parallel_statements is off.
+        """
         ast = None
         if cache:
             requests_cache.install_cache('demo_cache',
@@ -144,14 +357,47 @@ class TranQL:
             requests_cache.disabled()
 
         if isinstance(program, str):
-            ast = self.parse (program)
+            ast = await run_blocking (self.parse, program)
+        elif isinstance(program, TranQL_AST):
+            ast = program
         if not ast:
             raise ValueError (f"Unhandled type: {type(program)}")
-        for statement in ast.statements:
-            logger.debug (f"execute: {statement} type={type(statement).__name__}")
-            statement.execute (interpreter=self)
+        if self.explain is not None:
+            for statement in ast.statements:
+                if isinstance(statement, SelectStatement) and statement.explain is None:
+                    statement.explain = self.explain
+        self.context.set ('requestErrors', [])
+        if self.parallel_statements:
+            await self.execute_statements (ast)
+        else:
+            for statement in ast.statements:
+                logger.debug (f"execute: {statement} type={type(statement).__name__}")
+                await statement.execute_async (interpreter=self)
         return self.context
 
+    async def execute_statements (self, ast):
+        """
+        Run each statement once the earlier statements it depends on have finished. The
+        program's result is the last select statement's in program order.
+        """
+        dependencies = ast.dependencies ()
+        tasks = []
+        async def execute (statement, depends):
+            await asyncio.gather (*[ tasks[d] for d in depends ])
+            logger.debug (f"execute: {statement} type={type(statement).__name__}")
+            return await statement.execute_async (interpreter=self)
+        for statement, depends in zip (ast.statements, dependencies):
+            tasks.append (asyncio.ensure_future (execute (statement, depends)))
+        try:
+            results = await asyncio.gather (*tasks)
+        except Exception:
+            for task in tasks:
+                task.cancel ()
+            raise
+        selects = [ index for index, statement in enumerate (ast.statements) if isinstance(statement, SelectStatement) ]
+        if len(selects) > 0:
+            self.context.set ('result', results[selects[-1]])
+
     def execute_file (self, program):
         """ Execute a file on disk, soup to nuts. """
         with open (program, "r") as stream:
@@ -166,11 +412,12 @@ class TranQL:
 
     def val (self, term):
         result = {}
+        keys = self.context.mem.all_keys ()
         if isinstance(term, list):
             for t in term:
-                result.update ({ x : self.context.mem[x] for x in list(self.context.mem.keys ()) if x.lower().startswith (t) })
+                result.update ({ x : self.context.mem[x] for x in keys if x.lower().startswith (t) })
         else:
-            result = { x : self.context.mem[x] for x in list(self.context.mem.keys ()) if x.lower().startswith (term) }
+            result = { x : self.context.mem[x] for x in keys if x.lower().startswith (term) }
         return result
 
     def shell (self):
@@ -245,6 +492,8 @@ def main ():
     arg_parser.add_argument('-n', '--name_based_merging', default=True, help="Merge nodes that have the same name properties as one another")
     arg_parser.add_argument('-r', '--resolve_names', default=False, help="(Experimental) Resolve equivalent identifiers of nodes in responses via the Bionames API. Can result in a more thoroughly merged graph.")
     arg_parser.add_argument('-R', '--registry', help="Use registries to get data", default=False, action='store_true')
+    arg_parser.add_argument('-e', '--explain', choices=[ "plan", "analyze" ], default=None,
+                            help="Explain select statements' plans instead of running them (plan), or run them and explain where time went (analyze)")
     args = arg_parser.parse_args ()
 
     global logger
@@ -265,7 +514,8 @@ def main ():
         "name_based_merging",
         "resolve_names",
         "dynamic_id_resolution",
-        "registry"
+        "registry",
+        "explain"
     ]}
     tranql = TranQL (backplane = args.backplane, options = options)
     for k, v in query_args.items ():
@@ -278,6 +528,8 @@ def main ():
     elif args.source:
         """ Run a program. """
         context = tranql.execute_file (args.source)
+        if context.mem.get ('explain') is not None:
+            print (f"{json.dumps(context.mem['explain'], indent=2)}")
         if args.output == 'stdout':
             print (f"{json.dumps(context.mem, indent=2)}")
             print (f"top-gene: {json.dumps(context.top('gene',k='chemical_pathways'), indent=2)}")
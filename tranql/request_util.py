@@ -1,82 +1,405 @@
 import asyncio
+import atexit
 import json
 import logging
+import os
 import aiohttp
 import concurrent.futures
+import functools
 import random
+import requests
+import threading
+from collections import deque
 from time import time as now
+from urllib.parse import urlparse
+from tranql.config import Config
 from tranql.exception import ServiceInvocationError, RequestTimeoutError
 
 logger = logging.getLogger (__name__)
 
-async def make_request_async (semaphore, **kwargs):
-    response = {}
-    errors = []
-    timeout = aiohttp.ClientTimeout(total=60*60, connect=None,
-                      sock_connect=None, sock_read=None)
-    async with aiohttp.ClientSession (timeout=timeout) as session:
+class HostLimiter:
+    """
+    Bounds the number of requests in flight to one host. Usable from any event loop
+    and thread, so concurrent queries share the bound.
+
+    In adaptive mode the bound moves AIMD style: it grows by one per window of
+    requests answered within the latency target and halves on an error or a slow
+    response. Only requests started after the last decrease can decrease it again,
+    so one burst of failures halves it once.
+    """
+    def __init__(self, host, limit, adaptive=False, minimum=1, maximum=32, latency_target=30):
+        self.host = host
+        self.limit = float(limit)
+        self.adaptive = adaptive
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.in_flight = 0
+        self.peak = 0
+        self.decreased_at = 0
+        self.waiters = deque ()
+        self.lock = threading.Lock ()
+
+    @property
+    def window (self):
+        return max (1, int(self.limit))
+
+    async def acquire (self):
+        loop = asyncio.get_event_loop ()
+        with self.lock:
+            if self.in_flight < self.window and len(self.waiters) == 0:
+                self.take ()
+                return
+            waiter = loop.create_future ()
+            self.waiters.append (waiter)
         try:
-            async with session.request (**kwargs) as http_response:
-                # print(f"[{kwargs['method'].upper()}] requesting at url: {kwargs['url']}")
-                """ Check status and handle response. """
-                if http_response.status == 200 or http_response.status == 202:
-                    response = await http_response.json ()
-                    #logger.error (f" response: {json.dumps(response, indent=2)}")
-                    status = response.get('status', None)
-                    if status == "error":
-                        raise ServiceInvocationError(
-                            f"An error occurred invoking service: {kwargs['url']}.",
-                            response['message'])
-                    # print (f"** asyncio-response: {json.dumps(response,indent=2)}")
-                elif http_response.status == 404:
-                    raise UnknownServiceError (f"Service {url} was not found. Is it misspelled?")
-                else:
-                    http_response.raise_for_status()
-                    # logger.error (f"error {http_response.status} processing request: {message}")
-                # logger.error (http_response.text)
-        except concurrent.futures.TimeoutError as e:
-            errors.append (RequestTimeoutError(f'Timeout error requesting content from url: "{kwargs.get("url","undefined")}"',kwargs))
-        except ServiceInvocationError as e:
-            errors.append (e)
-        except Exception as e:
-            errors.append (e)
-    return {
-        "response" : response,
-        "errors" : errors
-    }
+            await waiter
+        except asyncio.CancelledError:
+            with self.lock:
+                if waiter in self.waiters:
+                    self.waiters.remove (waiter)
+                    raise
+            if not waiter.cancelled ():
+                """ The slot was handed over as we were cancelled. """
+                self.release ()
+            raise
 
-"""
-Concurrently makes all requests from a given pool of requests
+    def release (self):
+        with self.lock:
+            self.in_flight -= 1
+            self.wake ()
 
-Args:
-    requestPool (dict[]): List of **kwarg dictionaries. Keyword arguments will be passed directly to the requests.request call
-        Ex: {"method":"post","url":url} => requests.request(method="post",url=url)
-    maxRequests (int, optional): Maximum number of requests that may be executing at any given time
+    def take (self):
+        self.in_flight += 1
+        self.peak = max (self.peak, self.in_flight)
 
-Returns:
-    Dict containing `responses` and `errors`
-"""
-def async_make_requests (requestPool, maxRequests=3):
+    def wake (self):
+        """ Hand free slots to waiters. Call with the lock held. """
+        while len(self.waiters) > 0 and self.in_flight < self.window:
+            waiter = self.waiters.popleft ()
+            self.take ()
+            waiter.get_loop ().call_soon_threadsafe (self.grant, waiter)
 
-    # Duck test approach
-    try:
+    def grant (self, waiter):
+        if waiter.cancelled ():
+            self.release ()
+        else:
+            waiter.set_result (None)
+
+    def record (self, started, latency, ok):
+        """ Adjust the window given the outcome of a request. """
+        if not self.adaptive:
+            return
+        with self.lock:
+            if ok and latency <= self.latency_target:
+                self.limit = min (self.maximum, self.limit + 1 / self.window)
+            elif started >= self.decreased_at:
+                self.limit = max (self.minimum, self.limit / 2)
+                self.decreased_at = now ()
+                logger.debug (f"{self.host}: window decreased to {self.window} (ok={ok}, latency={latency:.2f}s)")
+            self.wake ()
+
+class ConcurrencyController:
+    """
+    Per host concurrency limits for requests to knowledge providers.
+    Configured by CONCURRENCY in conf.yml.
+    """
+    def __init__(self, default_limit=4, hosts=None, adaptive=False, minimum=1, maximum=32, latency_target=30):
+        self.default_limit = default_limit
+        self.hosts = hosts or {}
+        self.adaptive = adaptive
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.limiters = {}
+        self.lock = threading.Lock ()
+
+    @staticmethod
+    def from_config (config):
+        """ Build a controller from a CONCURRENCY configuration section. """
+        if config is None:
+            return ConcurrencyController ()
+        hosts = config.get ('HOSTS', None)
+        return ConcurrencyController (
+            default_limit=int(config.get ('DEFAULT_LIMIT', 4)),
+            hosts={ host : int(hosts[host]) for host in hosts.conf } if hosts is not None else {},
+            adaptive=str(config.get ('ADAPTIVE', False)).lower () == 'true',
+            minimum=int(config.get ('MIN_LIMIT', 1)),
+            maximum=int(config.get ('MAX_LIMIT', 32)),
+            latency_target=float(config.get ('LATENCY_TARGET', 30)))
+
+    def limiter (self, url):
+        """ Get the limiter for the host serving a url. """
+        host = urlparse (url).netloc
+        with self.lock:
+            limiter = self.limiters.get (host, None)
+            if limiter is None:
+                limiter = HostLimiter (host,
+                                       limit=self.hosts.get (host, self.default_limit),
+                                       adaptive=self.adaptive,
+                                       minimum=self.minimum,
+                                       maximum=self.maximum,
+                                       latency_target=self.latency_target)
+                self.limiters[host] = limiter
+            return limiter
+
+class SessionRegistry:
+    """
+    Long lived HTTP sessions shared by every query a worker runs.
+
+    aiohttp sessions belong to an event loop, so there is one per loop, each with
+    a bounded keep-alive connection pool and a DNS cache. Synchronous fetches,
+    such as schemas, share one requests session. Configured by HTTP_POOL in
+    conf.yml and closed when the worker exits.
+    """
+    def __init__(self, limit=100, limit_per_host=32, dns_cache_ttl=300, keepalive_timeout=60):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.sessions = {}
+        self.http = None
+        self.connections_opened = 0
+        self.pid = os.getpid ()
+        self.lock = threading.Lock ()
+
+    @staticmethod
+    def from_config (config):
+        """ Build a registry from an HTTP_POOL configuration section. """
+        if config is None:
+            return SessionRegistry ()
+        return SessionRegistry (
+            limit=int(config.get ('LIMIT', 100)),
+            limit_per_host=int(config.get ('LIMIT_PER_HOST', 32)),
+            dns_cache_ttl=int(config.get ('DNS_CACHE_TTL', 300)),
+            keepalive_timeout=float(config.get ('KEEPALIVE_TIMEOUT', 60)))
+
+    def check_fork (self):
+        """ Sessions can't cross a fork. A forked worker starts its own. Call with the lock held. """
+        if self.pid != os.getpid ():
+            self.sessions = {}
+            self.http = None
+            self.pid = os.getpid ()
+
+    def session (self):
+        """ The aiohttp session for the running event loop. Call from a coroutine. """
         loop = asyncio.get_event_loop ()
+        with self.lock:
+            self.check_fork ()
+            session = self.sessions.get (loop, None)
+            if session is None or session.closed:
+                """ Forget sessions whose loops are gone. """
+                self.sessions = { l : s for l, s in self.sessions.items () if not l.is_closed () }
+                trace = aiohttp.TraceConfig ()
+                trace.on_connection_create_end.append (self.connection_created)
+                connector = aiohttp.TCPConnector (limit=self.limit,
+                                                  limit_per_host=self.limit_per_host,
+                                                  ttl_dns_cache=self.dns_cache_ttl,
+                                                  keepalive_timeout=self.keepalive_timeout)
+                session = aiohttp.ClientSession (connector=connector,
+                                                 timeout=aiohttp.ClientTimeout (total=60*60),
+                                                 trace_configs=[ trace ])
+                self.sessions[loop] = session
+            return session
+
+    async def connection_created (self, session, context, params):
+        with self.lock:
+            self.connections_opened += 1
+
+    def http_session (self):
+        """ The requests session for synchronous calls. """
+        with self.lock:
+            self.check_fork ()
+            """ Start over if requests_cache has since swapped in its session class. """
+            if self.http is None or type(self.http) is not requests.Session:
+                self.http = requests.Session ()
+                adapter = requests.adapters.HTTPAdapter (pool_connections=self.limit,
+                                                         pool_maxsize=self.limit_per_host)
+                self.http.mount ("http://", adapter)
+                self.http.mount ("https://", adapter)
+            return self.http
 
-    except RuntimeError:
-        loop = asyncio.new_event_loop ()
+    def close (self):
+        """ Close every session. """
+        with self.lock:
+            sessions, self.sessions = self.sessions, {}
+            http, self.http = self.http, None
+        for loop, session in sessions.items ():
+            if session.closed or loop.is_closed ():
+                continue
+            try:
+                if loop.is_running ():
+                    asyncio.run_coroutine_threadsafe (session.close (), loop).result (timeout=5)
+                else:
+                    loop.run_until_complete (session.close ())
+            except Exception as e:
+                logger.warning (f"Unable to close HTTP session: {e}")
+        if http is not None:
+            http.close ()
+
+    def stats (self):
+        return {
+            "sessions" : len(self.sessions),
+            "connections_opened" : self.connections_opened
+        }
+
+class EventLoopThread:
+    """
+    One asyncio event loop per process, running in a daemon thread. Synchronous
+    code, such as Flask handlers on any worker thread, submits coroutines to it
+    and blocks on the result, so concurrent queries share the loop and the
+    connection pools bound to it.
+    """
+    def __init__(self):
+        self.loop = None
+        self.thread = None
+        self.pid = None
+        self.lock = threading.Lock ()
+
+    def get_loop (self):
+        """ Start the loop on first use, and again in a forked worker. """
+        with self.lock:
+            if self.loop is None or self.pid != os.getpid () or self.loop.is_closed ():
+                started = threading.Event ()
+                self.loop = asyncio.new_event_loop ()
+                self.pid = os.getpid ()
+                self.thread = threading.Thread (target=self.serve, args=(self.loop, started),
+                                                name="tranql-event-loop", daemon=True)
+                self.thread.start ()
+                started.wait ()
+            return self.loop
+
+    @staticmethod
+    def serve (loop, started):
         asyncio.set_event_loop (loop)
+        loop.call_soon (started.set)
+        loop.run_forever ()
 
+    def submit (self, coroutine):
+        """ Schedule a coroutine, returning a concurrent.futures.Future for its result. """
+        return asyncio.run_coroutine_threadsafe (coroutine, self.get_loop ())
 
-    semaphore = asyncio.BoundedSemaphore (maxRequests)
+    def run (self, coroutine, timeout=None):
+        """ Run a coroutine on the loop and wait for its result. """
+        if threading.current_thread () is self.thread:
+            coroutine.close ()
+            raise RuntimeError ("Blocking on the event loop from its own thread would deadlock. Await the coroutine instead.")
+        return self.submit (coroutine).result (timeout)
 
-    # tasks = asyncio.gather (*[make_request (**request) for request in requestPool])
+    def stop (self):
+        """ Close the sessions bound to the loop, then stop it. """
+        with self.lock:
+            loop, thread, self.loop = self.loop, self.thread, None
+        if loop is None or loop.is_closed () or self.pid != os.getpid ():
+            return
+        session_registry.close ()
+        loop.call_soon_threadsafe (loop.stop)
+        thread.join (timeout=5)
+        if not loop.is_running ():
+            loop.close ()
+
+session_registry = SessionRegistry.from_config (Config ("conf.yml").get ('HTTP_POOL', None))
+atexit.register (session_registry.close)
+
+event_loop = EventLoopThread ()
+atexit.register (event_loop.stop)
 
-    tasks = asyncio.gather(*[(make_request_async (semaphore, **request)) for request in requestPool])
+concurrency_controller = ConcurrencyController.from_config (Config ("conf.yml").get ('CONCURRENCY', None))
 
-    # for request in requestPool:
-        # tasks.append (asyncio.ensure_future (make_request (semaphore, **request)))
+async def run_blocking (function, *args, **kwargs):
+    """ Run blocking work, such as synchronous requests or merging, in the loop's executor. """
+    loop = asyncio.get_event_loop ()
+    return await loop.run_in_executor (None, functools.partial (function, *args, **kwargs))
 
-    results = loop.run_until_complete(tasks)
+async def make_request_async (semaphore, controller=None, **kwargs):
+    """ Make a request once both the caller's semaphore and the host's limiter admit it. """
+    limiter = (controller or concurrency_controller).limiter (kwargs.get ('url', ''))
+    if semaphore is None:
+        await limiter.acquire ()
+        return await make_limited_request_async (limiter, **kwargs)
+    async with semaphore:
+        await limiter.acquire ()
+        return await make_limited_request_async (limiter, **kwargs)
+
+async def make_limited_request_async (limiter, **kwargs):
+    started = now ()
+    try:
+        result = await make_single_request_async (**kwargs)
+    finally:
+        limiter.release ()
+    result["latency"] = now () - started
+    limiter.record (started, result["latency"], len(result["errors"]) == 0)
+    return result
+
+async def make_single_request_async (**kwargs):
+    response = {}
+    errors = []
+    received = 0
+    session = session_registry.session ()
+    try:
+        async with session.request (**kwargs) as http_response:
+            # print(f"[{kwargs['method'].upper()}] requesting at url: {kwargs['url']}")
+            """ Check status and handle response. """
+            if http_response.status == 200 or http_response.status == 202:
+                received = len(await http_response.read ())
+                response = await http_response.json ()
+                #logger.error (f" response: {json.dumps(response, indent=2)}")
+                status = response.get('status', None)
+                if status == "error":
+                    raise ServiceInvocationError(
+                        f"An error occurred invoking service: {kwargs['url']}.",
+                        response['message'])
+                # print (f"** asyncio-response: {json.dumps(response,indent=2)}")
+            elif http_response.status == 404:
+                raise UnknownServiceError (f"Service {url} was not found. Is it misspelled?")
+            else:
+                http_response.raise_for_status()
+                # logger.error (f"error {http_response.status} processing request: {message}")
+            # logger.error (http_response.text)
+    except concurrent.futures.TimeoutError as e:
+        errors.append (RequestTimeoutError(f'Timeout error requesting content from url: "{kwargs.get("url","undefined")}"',kwargs))
+    except ServiceInvocationError as e:
+        errors.append (e)
+    except Exception as e:
+        errors.append (e)
+    return {
+        "response" : response,
+        "errors" : errors,
+        "bytes" : received
+    }
+
+def async_make_requests (requestPool, maxRequests=3, controller=None):
+    """
+    Concurrently makes all requests from a given pool of requests
+
+    Args:
+        requestPool (dict[]): List of **kwarg dictionaries. Keyword arguments will be passed directly to the requests.request call
+            Ex: {"method":"post","url":url} => requests.request(method="post",url=url)
+        maxRequests (int, optional): Maximum number of requests from this pool that may be executing at any given time.
+            None leaves it to the per host limits.
+        controller (ConcurrencyController, optional): Per host limits. Defaults to the limits in conf.yml.
+
+    Returns:
+        Dict containing `responses` and `errors`
+    """
+    return event_loop.run (make_requests_async (requestPool, maxRequests, controller))
+
+async def make_requests_async (requestPool, maxRequests=3, controller=None, on_response=None):
+    """
+    The coroutine behind async_make_requests, for callers already on an event loop.
+    If given, on_response is called with each successful response as it arrives.
+    """
+    semaphore = asyncio.BoundedSemaphore (maxRequests) if maxRequests else None
+
+    async def make_request (**kwargs):
+        result = await make_request_async (semaphore, controller, **kwargs)
+        if on_response is not None and len(result["errors"]) == 0:
+            on_response (result["response"])
+        return result
+
+    # tasks = asyncio.gather (*[make_request (**request) for request in requestPool])
+
+    results = await asyncio.gather(*[(make_request (**request)) for request in requestPool])
 
     responses = []
     errors = []
@@ -91,6 +414,67 @@ def async_make_requests (requestPool, maxRequests=3):
         "errors" : errors
     }
 
+async def stream_requests_async (requestPool, window=16, controller=None, on_response=None, stop=None, deadline=None,
+                                 keep_responses=True):
+    """
+    Make requests from an iterable, keeping at most window of them in flight and taking the
+    next as each one completes. The pool may be long or generated lazily.
+    on_response is called with each successful response as it arrives. No new requests are
+    taken once stop () returns True, and requests still in flight are abandoned then or at the
+    deadline, a value of the event loop's clock. Unless keep_responses, responses are only
+    handed to on_response, so they can be released once it is done with them.
+    """
+    loop = asyncio.get_event_loop ()
+    requests = iter (requestPool)
+    pending = set ()
+    responses = []
+    errors = []
+    latencies = []
+    received = 0
+    exhausted = False
+    stopped = lambda : stop is not None and stop ()
+
+    def fill ():
+        nonlocal exhausted
+        while not exhausted and len(pending) < window and not stopped ():
+            request = next (requests, None)
+            if request is None:
+                exhausted = True
+            else:
+                pending.add (asyncio.ensure_future (make_request_async (None, controller, **request)))
+
+    fill ()
+    try:
+        while len(pending) > 0:
+            timeout = None if deadline is None else max (0, deadline - loop.time ())
+            done, pending = await asyncio.wait (pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if len(done) == 0:
+                break
+            for task in done:
+                result = task.result ()
+                latencies.append (result["latency"])
+                received += result.get ("bytes", 0)
+                errors.extend (result["errors"])
+                if len(result["errors"]) == 0:
+                    if keep_responses:
+                        responses.append (result["response"])
+                    if on_response is not None:
+                        on_response (result["response"])
+            if stopped ():
+                break
+            fill ()
+    finally:
+        for task in pending:
+            task.cancel ()
+
+    return {
+        "responses" : responses,
+        "errors" : errors,
+        "latencies" : latencies,
+        "bytes" : received,
+        "complete" : exhausted and len(pending) == 0
+    }
+
 if __name__ == "__main__":
     reqs = [
         *[
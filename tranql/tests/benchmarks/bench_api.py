@@ -0,0 +1,85 @@
+"""
+Benchmark per-request interpreter setup in the Flask API against mocked KPs.
+
+    PYTHONPATH=$PWD python tranql/tests/benchmarks/bench_api.py
+
+Runs each endpoint with a fresh TranQL () per request (legacy) and with the
+shared InterpreterPool, reporting mean latency and throughput over a few
+client threads.
+"""
+import argparse
+import json
+import logging
+import statistics
+import time
+import requests_mock
+from concurrent.futures import ThreadPoolExecutor
+from tranql import api
+from tranql.main import TranQL
+from tranql.tests.mocks import MockMap
+
+query = """
+    SELECT chemical_substance->gene->biological_process->anatomical_entity
+      FROM "/graph/gamma/quick"
+     WHERE chemical_substance = 'CHEBI:28177'
+"""
+question_graph = json.dumps ({ "nodes" : [], "edges" : [] })
+messages = [ {
+    "knowledge_graph" : {
+        "nodes" : [ { "id" : "TEST:CS1", "type" : "chemical_substance" },
+                    { "id" : "TEST:G1", "type" : "gene" } ],
+        "edges" : [ { "id" : "e0", "type" : "targets", "source_id" : "TEST:CS1", "target_id" : "TEST:G1" } ]
+    },
+    "knowledge_map" : [],
+    "question_graph" : { "nodes" : [], "edges" : [] }
+} ]
+
+endpoints = {
+    "query" : lambda client: client.post ('/tranql/query', data=query,
+                                          query_string={ "asynchronous" : False }),
+    "parse_incomplete" : lambda client: client.post ('/tranql/parse_incomplete',
+                                                     data="select chemical_substance->",
+                                                     content_type="text/plain"),
+    "merge_messages" : lambda client: client.post ('/tranql/merge_messages', json=messages,
+                                                   query_string={ "question_graph" : question_graph }),
+    "schema" : lambda client: client.get ('/tranql/schema')
+}
+
+def legacy_get (options=None):
+    """ Build a complete interpreter for every request, as the API used to. """
+    return TranQL (options=options or {})
+
+def measure (call, requests, threads):
+    latencies = []
+    def one (i):
+        client = api.app.test_client ()
+        start = time.perf_counter ()
+        response = call (client)
+        latencies.append (time.perf_counter () - start)
+        assert response.status_code == 200, response.data
+    call (api.app.test_client ())
+    start = time.perf_counter ()
+    with ThreadPoolExecutor (max_workers=threads) as executor:
+        list (executor.map (one, range (requests)))
+    elapsed = time.perf_counter () - start
+    return statistics.mean (latencies), requests / elapsed
+
+def main ():
+    arg_parser = argparse.ArgumentParser (description='API interpreter setup benchmark')
+    arg_parser.add_argument ('-n', '--requests', type=int, default=40)
+    arg_parser.add_argument ('-t', '--threads', type=int, default=4)
+    args = arg_parser.parse_args ()
+    logging.disable (logging.WARNING)
+    api.app.config['TESTING'] = False
+    pooled_get = api.interpreter_pool.get
+    with requests_mock.Mocker () as mocker:
+        MockMap (mocker, "workflow-5")
+        for name, call in endpoints.items ():
+            for mode, get in [ ("legacy", legacy_get), ("pooled", pooled_get) ]:
+                api.interpreter_pool.get = get
+                latency, throughput = measure (call, args.requests, args.threads)
+                print (f"{name:>16} {mode:>6}: {latency * 1000:9.2f} ms/request  {throughput:8.1f} requests/s")
+    api.interpreter_pool.get = pooled_get
+
+if __name__ == '__main__':
+    main ()
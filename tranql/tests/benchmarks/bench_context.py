@@ -0,0 +1,76 @@
+"""
+Benchmark Context construction.
+
+Compares three ways of providing the gene and disease vocabularies:
+    legacy - every Context parses its own copy of the sources.
+    shared - the sources are parsed once per process and shared.
+    index  - the compiled, memory-mapped vocabulary index is shared.
+
+    PYTHONPATH=$PWD python tranql/tests/benchmarks/bench_context.py
+
+Each mode runs in its own process so the first-Context time and RSS
+reported belong to that mode alone. `--concurrent` contexts are kept alive at once,
+modelling the requests in flight in a single worker.
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+def rss_mb ():
+    """ Resident set size of this process, falling back to the peak where /proc is unavailable. """
+    try:
+        with open ("/proc/self/statm") as stream:
+            return int (stream.read ().split ()[1]) * resource.getpagesize () / 2**20
+    except OSError:
+        return resource.getrusage (resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def run (mode, iterations, concurrent):
+    from tranql.util import Context, ContextMemory, Vocabulary
+    base_rss = rss_mb ()
+    start = time.perf_counter ()
+    def legacy_context ():
+        context = Context ()
+        context.mem = ContextMemory (Vocabulary.parse ())
+        return context
+    make_context = legacy_context if mode == 'legacy' else Context
+    make_context ()
+    cold = time.perf_counter () - start
+    start = time.perf_counter ()
+    for i in range (iterations):
+        make_context ()
+    elapsed = time.perf_counter () - start
+    live = [ make_context () for i in range (concurrent) ]
+    assert live[0].resolve_arg ("$A1BG") == "HGNC:5"
+    rss = rss_mb ()
+    print (f"{mode:>7}: first Context {cold * 1000:8.1f} ms  "
+           f"{elapsed / iterations * 1000:10.3f} ms/Context  "
+           f"RSS {rss:7.1f} MB (+{rss - base_rss:.1f} MB over imports) "
+           f"with {len(live)} live contexts")
+
+def main ():
+    arg_parser = argparse.ArgumentParser (description='Context construction benchmark')
+    arg_parser.add_argument ('-n', '--iterations', type=int, default=20)
+    arg_parser.add_argument ('-c', '--concurrent', type=int, default=8)
+    arg_parser.add_argument ('-m', '--mode', choices=['legacy', 'shared', 'index'], default=None)
+    args = arg_parser.parse_args ()
+    if args.mode:
+        run (args.mode, args.iterations, args.concurrent)
+        return
+    with tempfile.TemporaryDirectory () as directory:
+        index_path = os.path.join (directory, "vocabulary.idx")
+        from tranql.util import Vocabulary
+        Vocabulary.compile (index_path)
+        for mode in [ 'legacy', 'shared', 'index' ]:
+            env = dict (os.environ)
+            env['TRANQL_VOCABULARY_INDEX'] = index_path if mode == 'index' else \
+                                             os.path.join (directory, "missing.idx")
+            subprocess.run ([ sys.executable, __file__, '--mode', mode,
+                              '-n', str(args.iterations),
+                              '-c', str(args.concurrent) ], check=True, env=env)
+
+if __name__ == '__main__':
+    main ()
@@ -0,0 +1,180 @@
+"""
+Benchmark end to end latency of multi-segment /schema queries.
+
+    PYTHONPATH=$PWD python tranql/tests/benchmarks/bench_engine.py
+
+Runs a local backplane serving the mock schemas, and synthetic knowledge
+providers that answer any question after an injected delay, plus optional jitter. A query planned
+into several segments runs several times:
+
+  blocking    one after another, with synchronous requests
+  sequential  one after another, through the async engine
+  concurrent  all at once, gathered on the shared event loop
+  pipelined   one after another, streaming handoff curies between segments
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse
+
+queries = {
+    "2-hop" : """
+        SELECT chemical_substance->disease->gene
+          FROM '/schema'
+         WHERE chemical_substance = 'CHEBI:28177'
+    """,
+    "3-hop" : """
+        SELECT chemical_substance->disease->phenotypic_feature->gene
+          FROM '/schema'
+         WHERE chemical_substance = 'CHEBI:28177'
+    """
+}
+
+schemas = {
+    "/graph/gamma/predicates" : "predicates.json",
+    "/graph/rtx/predicates" : "rtx_predicates.json",
+    "/graph/roger/predicates" : "rtx_predicates.json",
+    "/clincial/icees/schema" : "icees_predicates.json"
+}
+
+class Backplane(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, delay, answers, jitter=0):
+        super().__init__(("127.0.0.1", 0), Handler)
+        self.delay = delay
+        self.jitter = jitter
+        self.answers = answers
+        self.questions = 0
+        self.lock = threading.Lock ()
+
+    def answer (self, question):
+        """ Bind every question node, and a few synthetic curies for unbound ones. """
+        graph = question["question_graph"]
+        nodes = {}
+        edges = {}
+        answers = []
+        for i in range(self.answers):
+            bindings = {}
+            for node in graph["nodes"]:
+                curie = node.get ("curie", f"{node['type'].upper()}:{i}")
+                curie = curie[0] if isinstance(curie, list) else curie
+                nodes[curie] = { "id" : curie, "type" : node["type"] }
+                bindings[node["id"]] = curie
+            edge_bindings = {}
+            for edge in graph["edges"]:
+                source, target = bindings[edge["source_id"]], bindings[edge["target_id"]]
+                id = f"{source}-{target}"
+                edges[id] = { "id" : id, "source_id" : source, "target_id" : target, "type" : "related_to" }
+                edge_bindings[edge["id"]] = [ id ]
+            answers.append ({ "node_bindings" : bindings, "edge_bindings" : edge_bindings })
+        return {
+            "question_graph" : graph,
+            "knowledge_graph" : { "nodes" : list(nodes.values ()), "edges" : list(edges.values ()) },
+            "knowledge_map" : answers
+        }
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def reply (self, obj, status=200):
+        body = json.dumps (obj).encode ()
+        self.send_response (status)
+        self.send_header ("Content-Type", "application/json")
+        self.send_header ("Content-Length", str(len(body)))
+        self.end_headers ()
+        self.wfile.write (body)
+
+    def do_GET (self):
+        path = urlparse (self.path).path
+        if path in schemas:
+            mock = os.path.join (os.path.dirname (__file__), "..", "mock", schemas[path])
+            with open (mock) as stream:
+                self.reply (json.load (stream))
+        else:
+            self.reply ({ "message" : f"{path} not found" }, status=404)
+
+    def do_POST (self):
+        question = json.loads (self.rfile.read (int(self.headers.get ('Content-Length', 0))))
+        with self.server.lock:
+            self.server.questions += 1
+        time.sleep (self.server.delay + random.uniform (0, self.server.jitter))
+        self.reply (self.server.answer (question))
+
+    def log_message (self, *args):
+        pass
+
+def main ():
+    arg_parser = argparse.ArgumentParser (description='Statement engine benchmark')
+    arg_parser.add_argument ('-Q', '--query', choices=sorted (queries), default="3-hop")
+    arg_parser.add_argument ('-q', '--queries', type=int, default=8)
+    arg_parser.add_argument ('-d', '--delay', type=float, default=0.1, help="KP latency in seconds")
+    arg_parser.add_argument ('-j', '--jitter', type=float, default=0, help="Extra random KP latency in seconds")
+    arg_parser.add_argument ('-a', '--answers', type=int, default=3, help="Answers per question")
+    arg_parser.add_argument ('-l', '--limit', type=int, default=16, help="Requests in flight per host")
+    arg_parser.add_argument ('-w', '--window', type=int, default=2, help="Handoff curies per pipelined window")
+    args = arg_parser.parse_args ()
+
+    backplane = Backplane (args.delay, args.answers, args.jitter)
+    threading.Thread (target=backplane.serve_forever, daemon=True).start ()
+    os.environ["BACKPLANE"] = f"http://127.0.0.1:{backplane.server_address[1]}"
+    os.environ["CONCURRENCY_DEFAULT_LIMIT"] = str(args.limit)
+    logging.disable (logging.WARNING)
+
+    from tranql.main import InterpreterState, TranQL
+    from tranql.request_util import event_loop
+    query = queries[args.query]
+    state = InterpreterState (options={ "recreate_schema" : True })
+    segments = state.parser.parse (query).statements[0].planned
+    print (f"{len(segments)} segments: {' | '.join (s.service for s in segments)}")
+
+    def interpreter (asynchronous, streaming_handoff=False):
+        return TranQL (options={ "asynchronous" : asynchronous,
+                                 "streaming_handoff" : streaming_handoff,
+                                 "handoff_window" : args.window }, state=state)
+
+    async def timed (tranql):
+        start = time.perf_counter ()
+        await tranql.execute_async (query)
+        return time.perf_counter () - start
+
+    def blocking ():
+        latencies = []
+        for i in range(args.queries):
+            start = time.perf_counter ()
+            interpreter (False).execute (query)
+            latencies.append (time.perf_counter () - start)
+        return latencies
+
+    def sequential ():
+        return [ event_loop.run (timed (interpreter (True))) for i in range(args.queries) ]
+
+    def pipelined ():
+        return [ event_loop.run (timed (interpreter (True, True))) for i in range(args.queries) ]
+
+    def concurrent ():
+        async def gather ():
+            return await asyncio.gather (*[ timed (interpreter (True)) for i in range(args.queries) ])
+        return event_loop.run (gather ())
+
+    for mode, run in [ ("blocking", blocking), ("sequential", sequential), ("concurrent", concurrent),
+                       ("pipelined", pipelined) ]:
+        backplane.questions = 0
+        start = time.perf_counter ()
+        latencies = run ()
+        elapsed = time.perf_counter () - start
+        print (f"{mode:>10}: {statistics.mean (latencies) * 1000:8.1f} ms/query, "
+               f"{elapsed:6.2f} s for {args.queries} queries, {backplane.questions} KP questions")
+    backplane.shutdown ()
+
+if __name__ == '__main__':
+    main ()
@@ -0,0 +1,101 @@
+"""
+Benchmark joining the answers of plan segments into complete answers.
+
+    PYTHONPATH=$PWD python tranql/tests/benchmarks/bench_join.py
+
+Builds one response per hop of a chain query, where every curie bound by a hop
+fans out to --fan-out curies in the next, so the number of complete answers is
+sources x fan-out ^ hops. Times connect_knowledge_maps on increasingly wide
+joins and reports the peak memory it allocates.
+
+Every answer is scored, and overlaying those scores on the joined answers is
+timed on its own for each --policy. Scan times overlay scores the way
+connect_knowledge_maps used to, checking every score against every joined
+answer, and are only measured up to --scan-max joined answers.
+"""
+import argparse
+import copy
+import gc
+import time
+import tracemalloc
+from tranql.utils.merge_utils import connect_knowledge_maps, binding_ids, overlay_score
+
+def responses (sources, fan_out, hops):
+    """ One response per hop of c0->c1->...->c<hops>. """
+    result = []
+    curies = [ f"C0:{i}" for i in range(sources) ]
+    for hop in range(hops):
+        source, target = f"c{hop}", f"c{hop + 1}"
+        question_graph = {
+            "nodes" : [ { "id" : source }, { "id" : target } ],
+            "edges" : [ { "id" : f"e{hop}", "source_id" : source, "target_id" : target } ]
+        }
+        answers = []
+        following = []
+        for curie in curies:
+            for i in range(fan_out):
+                next_curie = f"C{hop + 1}:{curie.split (':')[1]}.{i}"
+                following.append (next_curie)
+                answers.append ({
+                    "node_bindings" : { source : [ curie ], target : [ next_curie ] },
+                    "edge_bindings" : { f"e{hop}" : [ f"{curie}-{next_curie}" ] },
+                    "score" : 1 + i % 3
+                })
+        curies = following
+        result.append ({ "question_graph" : question_graph, "knowledge_map" : answers })
+    return result
+
+def scan_overlay (merged_answers, score_table):
+    """ The previous overlay_score: every score key against every answer's rebuilt bindings. """
+    for score_key in score_table:
+        if score_table[score_key] == 0:
+            continue
+        for answer in merged_answers:
+            node_bindings = [ answer['node_bindings'][x][0] for x in answer['node_bindings'] ]
+            edge_bindings = [ answer['edge_bindings'][x][0] for x in answer['edge_bindings'] ]
+            if all (x in node_bindings or x in edge_bindings for x in score_key):
+                answer['score'] = score_table[score_key]
+
+def paused (function, *args):
+    """ Seconds function takes with the collector paused. """
+    gc.collect ()
+    gc.disable ()
+    try:
+        start = time.perf_counter ()
+        function (*args)
+        return time.perf_counter () - start
+    finally:
+        gc.enable ()
+
+def main ():
+    arg_parser = argparse.ArgumentParser (description='Knowledge map join benchmark')
+    arg_parser.add_argument ('-s', '--sources', type=int, default=10)
+    arg_parser.add_argument ('-f', '--fan-out', type=int, nargs='+', default=[ 2, 4, 8, 16 ])
+    arg_parser.add_argument ('-H', '--hops', type=int, default=3)
+    arg_parser.add_argument ('-p', '--policy', nargs='+', default=[ "last", "product" ])
+    arg_parser.add_argument ('-m', '--scan-max', type=int, default=5000, help="Most joined answers to time scans on")
+    args = arg_parser.parse_args ()
+    for fan_out in args.fan_out:
+        data = responses (args.sources, fan_out, args.hops)
+        answers = sum (len(r["knowledge_map"]) for r in data)
+        order = [ f"c{i}" for i in range(args.hops + 1) ]
+        """ Time with the collector paused, then measure memory on a fresh copy. """
+        timed = copy.deepcopy (data)
+        joined = []
+        elapsed = paused (lambda : joined.extend (connect_knowledge_maps (timed, order)))
+        score_table = { frozenset (binding_ids (a)) : a['score'] for r in timed for a in r["knowledge_map"] }
+        data = copy.deepcopy (data)
+        tracemalloc.start ()
+        connect_knowledge_maps (data, order)
+        peak = tracemalloc.get_traced_memory ()[1]
+        tracemalloc.stop ()
+        print (f"fan-out {fan_out:>3}: {answers:>7} answers joined into {len(joined):>7} in {elapsed * 1000:9.1f} ms, "
+               f"peak {peak / 2**20:7.1f} MiB")
+        for policy in args.policy:
+            line = f"  {policy:>8} scores: {paused (overlay_score, joined, score_table, policy) * 1000:9.1f} ms"
+            if policy == "last" and len(joined) <= args.scan_max:
+                line += f", scan {paused (scan_overlay, joined, score_table) * 1000:9.1f} ms"
+            print (line)
+
+if __name__ == '__main__':
+    main ()
@@ -0,0 +1,202 @@
+"""
+Benchmark the stages of merging responses from several knowledge providers.
+
+    PYTHONPATH=$PWD python tranql/tests/benchmarks/bench_merge.py
+
+Builds synthetic responses from 1k to 100k nodes, where a share of nodes is
+reported again by another provider under a different id with an equivalent
+identifier in common, and a share of edges is reported again under a new id.
+Times merging them, per input node to show how it scales:
+
+  canonicalize  merge equivalent nodes, rewrite edge endpoints and node bindings
+  dedup         merge duplicate edges, rewrite edge bindings
+  fold          both, with a MergeAccumulator adding one response at a time
+
+Canonicalize and dedup rewrite ids the way merge_results used to, rescanning
+every edge or answer per replaced id, and are only measured up to --scan-max
+nodes.
+
+Peak memory compares parsing every response before merging them with folding
+each into a MergeAccumulator as it is parsed and letting it go. With --reported
+above 1 responses overlap, as answers to related questions do, and folding only
+keeps one copy of each node and edge.
+"""
+import argparse
+import copy
+import gc
+import json
+import random
+import time
+import tracemalloc
+from tranql.util import light_merge
+from tranql.utils.merge_utils import MergeAccumulator
+
+def responses (nodes, providers, aliases, degree):
+    """
+    nodes synthetic curies split across providers, each response binding edges between its
+    own nodes. An aliases share of nodes, and of edges, is also reported by the next provider
+    under a new id.
+    """
+    result = [ { "knowledge_graph" : { "nodes" : [], "edges" : [] }, "knowledge_map" : [] } for p in range(providers) ]
+    for i in range(nodes):
+        owner = result[i % providers]
+        owner["knowledge_graph"]["nodes"].append ({ "id" : f"N:{i}", "equivalent_identifiers" : [ f"N:{i}", f"X:{i}" ] })
+        if random.random () < aliases:
+            other = result[(i + 1) % providers]
+            other["knowledge_graph"]["nodes"].append ({ "id" : f"A:{i}", "equivalent_identifiers" : [ f"A:{i}", f"X:{i}" ] })
+    for p, response in enumerate (result):
+        ids = [ node["id"] for node in response["knowledge_graph"]["nodes"] ]
+        for e in range(len(ids) * degree):
+            source, target = random.choice (ids), random.choice (ids)
+            id = f"E:{p}:{e}"
+            response["knowledge_graph"]["edges"].append ({ "id" : id, "source_id" : source, "target_id" : target, "type" : [ "related_to" ] })
+            response["knowledge_map"].append ({ "node_bindings" : { "n0" : source, "n1" : target }, "edge_bindings" : { "e0" : [ id ] } })
+            if random.random () < aliases:
+                other = result[(p + 1) % providers]
+                other["knowledge_graph"]["edges"].append ({ "id" : f"D:{p}:{e}", "source_id" : source, "target_id" : target, "type" : [ "related_to" ] })
+                other["knowledge_map"].append ({ "node_bindings" : { "n0" : source, "n1" : target }, "edge_bindings" : { "e0" : [ f"D:{p}:{e}" ] } })
+    return result
+
+def reported (data, times):
+    """ data with the nodes, edges and answers of each response also reported by the next times - 1 responses. """
+    result = copy.deepcopy (data)
+    for p, response in enumerate (data):
+        for k in range(1, times):
+            other = result[(p + k) % len(data)]
+            for key in [ "nodes", "edges" ]:
+                other["knowledge_graph"][key].extend (copy.deepcopy (response["knowledge_graph"][key]))
+            other["knowledge_map"].extend (copy.deepcopy (response["knowledge_map"]))
+    return result
+
+def scan_canonicalize (responses):
+    """ The previous merge_results: collect replaced ids, then rescan edges and answers for each. """
+    eq_ids_to_node_ids_map = {}
+    for r in responses:
+        for node in r['knowledge_graph']['nodes']:
+            for i in node['equivalent_identifiers']:
+                eq_ids_to_node_ids_map.setdefault (i, node['id'])
+    node_map, merged, edges, replace_edge_ids = {}, [], [], []
+    for response in responses:
+        edges.extend (response['knowledge_graph']['edges'])
+        for n in response['knowledge_graph']['nodes']:
+            node = None
+            for id in n['equivalent_identifiers']:
+                node = node_map.get (eq_ids_to_node_ids_map[id], None)
+                if node:
+                    replace_edge_ids.append ([n["id"], node["id"]])
+                    light_merge (node, n)
+                    light_merge (n, node)
+                    break
+            if not node:
+                node_map[n['id']] = n
+                merged.append (n)
+    for old_id, new_id in replace_edge_ids:
+        for edge in edges:
+            if old_id == edge['source_id']:
+                edge['source_id'] = new_id
+            if old_id == edge['target_id']:
+                edge['target_id'] = new_id
+        for response in responses:
+            for answer in response['knowledge_map']:
+                node_bindings = answer.get('node_bindings',{})
+                for concept in node_bindings:
+                    identifier = node_bindings[concept]
+                    identifier = [identifier] if isinstance(identifier, str) else identifier
+                    if identifier == [old_id]:
+                        identifier = [new_id]
+                    node_bindings[concept] = identifier
+    return merged
+
+def scan_dedup (responses):
+    """ The previous merge_results: string keys, then rescan every answer per killed edge. """
+    merged_edges = {}
+    killed_edges = []
+    for response in responses:
+        for e in response['knowledge_graph']['edges']:
+            edge_key = '#'.join(sorted(e['type'])) + e['source_id'] + e['target_id']
+            if edge_key in merged_edges:
+                edge = merged_edges[edge_key]
+                light_merge (edge, e)
+                light_merge (e, edge)
+                killed_edges.append ([e['id'], edge['id']])
+            else:
+                merged_edges[edge_key] = e
+    for old_edge_id, new_edge_id in killed_edges:
+        for response in responses:
+            for answer in response['knowledge_map']:
+                edge_bindings = answer.get('edge_bindings',{})
+                for concept in edge_bindings:
+                    edge_bindings[concept] = [ new_edge_id if i == old_edge_id else i for i in edge_bindings[concept] ]
+    return list(merged_edges.values ())
+
+def fold (responses):
+    accumulator = MergeAccumulator ()
+    for response in responses:
+        accumulator.add (response)
+    return accumulator.nodes
+
+def batch (payloads):
+    """ Parse every response, then merge them. """
+    responses = [ json.loads (payload) for payload in payloads ]
+    fold (responses)
+
+def streamed (payloads):
+    """ Merge each response as it is parsed. """
+    accumulator = MergeAccumulator ()
+    for payload in payloads:
+        accumulator.add (json.loads (payload))
+
+def peak (function, *args):
+    """ Most memory function allocates at once, in MiB. """
+    tracemalloc.start ()
+    try:
+        function (*args)
+        return tracemalloc.get_traced_memory ()[1] / 2**20
+    finally:
+        tracemalloc.stop ()
+
+def timed (stages, data):
+    """
+    Run stages one after another on a copy of data, timing each. The collector is paused so
+    its passes over the copy don't hide how the stages themselves scale.
+    """
+    data = copy.deepcopy (data)
+    times = []
+    gc.collect ()
+    gc.disable ()
+    try:
+        for stage in stages:
+            start = time.perf_counter ()
+            result = stage (data)
+            times.append ((time.perf_counter () - start, len(result)))
+    finally:
+        gc.enable ()
+    return times
+
+def main ():
+    arg_parser = argparse.ArgumentParser (description='Merge stage benchmark')
+    arg_parser.add_argument ('-n', '--nodes', type=int, nargs='+', default=[ 1000, 10000, 100000 ])
+    arg_parser.add_argument ('-p', '--providers', type=int, default=4)
+    arg_parser.add_argument ('-a', '--aliases', type=float, default=0.3, help="Share of nodes reported under a second id")
+    arg_parser.add_argument ('-d', '--degree', type=int, default=2, help="Edges per node")
+    arg_parser.add_argument ('-r', '--reported', type=int, default=1, help="Responses reporting each node and edge")
+    arg_parser.add_argument ('-s', '--scan-max', type=int, default=2000, help="Largest graph to time scans on")
+    args = arg_parser.parse_args ()
+    random.seed (0)
+    for nodes in args.nodes:
+        data = reported (responses (nodes, args.providers, args.aliases, args.degree), args.reported)
+        size = sum (len(r['knowledge_graph']['nodes']) for r in data)
+        edges = sum (len(r['knowledge_graph']['edges']) for r in data)
+        print (f"{size} nodes, {edges} edges")
+        if nodes <= args.scan_max:
+            scanned = timed ([ scan_canonicalize, scan_dedup ], data)
+            for (seconds, merged), name in zip (scanned, [ "canonicalize", "dedup" ]):
+                print (f"  {name:>12}: {seconds * 1000:9.1f} ms, {seconds * 1e6 / size:6.2f} us/node, {merged} left")
+        seconds, merged = timed ([ fold ], data)[0]
+        print (f"  {'fold':>12}: {seconds * 1000:9.1f} ms, {seconds * 1e6 / size:6.2f} us/node, {merged} left")
+        payloads = [ json.dumps (response) for response in data ]
+        print (f"  peak memory: {peak (batch, payloads):7.1f} MiB parsed then merged, "
+               f"{peak (streamed, payloads):7.1f} MiB folded as parsed")
+
+if __name__ == '__main__':
+    main ()
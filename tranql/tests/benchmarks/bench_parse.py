@@ -0,0 +1,61 @@
+"""
+Benchmark parsing and planning the programs in tranql/queries.
+
+    PYTHONPATH=$PWD python tranql/tests/benchmarks/bench_parse.py
+
+Parses every *.tranql program repeatedly with an uncached parser and with a
+ProgramCache, reporting mean time per program and the cache's hit rate.
+"""
+import argparse
+import glob
+import logging
+import os
+import time
+import requests_mock
+from tranql.main import TranQL, TranQLParser, ProgramCache
+from tranql.tests.mocks import MockMap
+
+queries = os.path.join (os.path.dirname (__file__), "..", "..", "queries", "*.tranql")
+
+def load_programs (parser):
+    """ Read the query corpus, skipping programs that don't parse against the mock schema. """
+    programs = {}
+    for path in sorted (glob.glob (queries)):
+        with open (path, "r") as stream:
+            program = stream.read ()
+        try:
+            parser.compile (program)
+            programs[os.path.basename (path)] = program
+        except Exception as e:
+            print (f"skipping {os.path.basename (path)}: {e}")
+    return programs
+
+def measure (parser, programs, rounds):
+    start = time.perf_counter ()
+    for i in range (rounds):
+        for program in programs.values ():
+            ast = parser.parse (program)
+            if parser.cache is None:
+                """ Cached programs come back planned. Plan here to compare like with like. """
+                ast.plan ()
+    return (time.perf_counter () - start) / (rounds * len(programs))
+
+def main ():
+    arg_parser = argparse.ArgumentParser (description='Parse and plan cache benchmark')
+    arg_parser.add_argument ('-r', '--rounds', type=int, default=20)
+    args = arg_parser.parse_args ()
+    logging.disable (logging.WARNING)
+    with requests_mock.Mocker () as mocker:
+        MockMap (mocker, "workflow-5")
+        schema = TranQL ().schema
+        programs = load_programs (TranQLParser (schema, cache=None))
+        uncached = TranQLParser (schema, cache=None)
+        cached = TranQLParser (schema, cache=ProgramCache ())
+        for mode, parser in [ ("uncached", uncached), ("cached", cached) ]:
+            elapsed = measure (parser, programs, args.rounds)
+            print (f"{mode:>8}: {elapsed * 1000:9.3f} ms/program over {len(programs)} programs")
+        stats = cached.cache.stats ()
+        print (f"cache: {stats['hits']} hits, {stats['misses']} misses, {stats['size']}/{stats['maxsize']} entries")
+
+if __name__ == '__main__':
+    main ()
@@ -0,0 +1,92 @@
+"""
+Benchmark a question fan-out with a session per request against the shared pool.
+
+    PYTHONPATH=$PWD python tranql/tests/benchmarks/bench_pool.py
+
+Sends a 50 question fan-out to a local keep-alive HTTP server several times,
+once opening an aiohttp session per request as make_request_async used to and
+once through the shared SessionRegistry, reporting latency and the number of
+connections the server accepted.
+"""
+import aiohttp
+import argparse
+import asyncio
+import json
+import logging
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from tranql.request_util import ConcurrencyController, async_make_requests
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, delay):
+        super().__init__(("127.0.0.1", 0), Handler)
+        self.delay = delay
+        self.lock = threading.Lock ()
+        self.clients = set ()
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST (self):
+        self.rfile.read (int(self.headers.get ('Content-Length', 0)))
+        with self.server.lock:
+            self.server.clients.add (self.client_address)
+        time.sleep (self.server.delay)
+        body = json.dumps ({ "knowledge_map" : [] }).encode ()
+        self.send_response (200)
+        self.send_header ("Content-Type", "application/json")
+        self.send_header ("Content-Length", str(len(body)))
+        self.end_headers ()
+        self.wfile.write (body)
+
+    def log_message (self, *args):
+        pass
+
+async def request_with_new_session (semaphore, **kwargs):
+    """ The previous behaviour: a new session, and so a new connection, per question. """
+    async with semaphore:
+        async with aiohttp.ClientSession () as session:
+            async with session.request (**kwargs) as response:
+                return await response.json ()
+
+def session_per_request (requests, concurrency):
+    loop = asyncio.get_event_loop ()
+    semaphore = asyncio.BoundedSemaphore (concurrency)
+    return loop.run_until_complete (asyncio.gather (*[
+        request_with_new_session (semaphore, **request) for request in requests ]))
+
+def shared_pool (requests, concurrency):
+    controller = ConcurrencyController (default_limit=concurrency)
+    return async_make_requests (requests, maxRequests=None, controller=controller)
+
+def main ():
+    arg_parser = argparse.ArgumentParser (description='Connection pool benchmark')
+    arg_parser.add_argument ('-q', '--questions', type=int, default=50)
+    arg_parser.add_argument ('-c', '--concurrency', type=int, default=8)
+    arg_parser.add_argument ('-r', '--rounds', type=int, default=5)
+    arg_parser.add_argument ('-d', '--delay', type=float, default=0.005, help="Server latency in seconds")
+    args = arg_parser.parse_args ()
+    logging.disable (logging.WARNING)
+    for mode, fan_out in [ ("session per request", session_per_request), ("shared pool", shared_pool) ]:
+        server = Server (args.delay)
+        threading.Thread (target=server.serve_forever, daemon=True).start ()
+        url = f"http://127.0.0.1:{server.server_address[1]}/query"
+        requests = [ { "method" : "post", "url" : url, "json" : { "i" : i } } for i in range(args.questions) ]
+        latencies = []
+        for i in range(args.rounds):
+            start = time.perf_counter ()
+            fan_out (requests, args.concurrency)
+            latencies.append (time.perf_counter () - start)
+        server.shutdown ()
+        server.server_close ()
+        print (f"{mode:>20}: {statistics.mean (latencies) * 1000:8.1f} ms per {args.questions} question fan-out, "
+               f"{len(server.clients)} connections opened over {args.rounds} rounds")
+
+if __name__ == '__main__':
+    main ()
@@ -0,0 +1,65 @@
+"""
+Benchmark multi-statement programs run statement by statement or as a dataflow.
+
+    PYTHONPATH=$PWD python tranql/tests/benchmarks/bench_program.py
+
+Runs the bench_engine backplane and a program of independent selects, with a
+last select reading a variable set by the first. In sequence each select waits
+for the one before it. As a dataflow the independent selects run at once and
+only the last waits, for the first.
+"""
+import argparse
+import logging
+import os
+import statistics
+import threading
+import time
+from tranql.tests.benchmarks.bench_engine import Backplane
+
+def program (selects):
+    """ selects independent one hop queries, then one reading the first's answers. """
+    statements = [ f"""
+        SELECT chemical_substance->disease
+          FROM "/graph/gamma/quick"
+         WHERE chemical_substance = 'CHEBI:{i}'
+           SET '$.knowledge_graph.nodes.[*].id' AS diseases_{i}
+    """ for i in range(selects) ]
+    statements.append ("""
+        SELECT disease->gene
+          FROM "/graph/rtx"
+         WHERE disease = $diseases_0
+    """)
+    return "\n".join (statements)
+
+def main ():
+    arg_parser = argparse.ArgumentParser (description='Statement dataflow benchmark')
+    arg_parser.add_argument ('-s', '--selects', type=int, default=4, help="Independent selects in the program")
+    arg_parser.add_argument ('-q', '--queries', type=int, default=8)
+    arg_parser.add_argument ('-d', '--delay', type=float, default=0.1, help="KP latency in seconds")
+    arg_parser.add_argument ('-a', '--answers', type=int, default=3, help="Answers per question")
+    args = arg_parser.parse_args ()
+
+    backplane = Backplane (args.delay, args.answers)
+    threading.Thread (target=backplane.serve_forever, daemon=True).start ()
+    os.environ["BACKPLANE"] = f"http://127.0.0.1:{backplane.server_address[1]}"
+    logging.disable (logging.WARNING)
+
+    from tranql.main import InterpreterState, TranQL
+    state = InterpreterState (options={ "recreate_schema" : True })
+    source = program (args.selects)
+    print (f"{args.selects + 1} selects, dependencies: {state.parser.parse (source).dependencies ()}")
+
+    for mode, parallel in [ ("sequential", False), ("dataflow", True) ]:
+        backplane.questions = 0
+        latencies = []
+        for i in range(args.queries):
+            tranql = TranQL (options={ "parallel_statements" : parallel }, state=state)
+            start = time.perf_counter ()
+            tranql.execute (source)
+            latencies.append (time.perf_counter () - start)
+        print (f"{mode:>10}: {statistics.mean (latencies) * 1000:8.1f} ms/program, "
+               f"{backplane.questions} KP questions")
+    backplane.shutdown ()
+
+if __name__ == '__main__':
+    main ()
@@ -0,0 +1,79 @@
+"""
+Benchmark question generation for statements with many bound values.
+
+    PYTHONPATH=$PWD python tranql/tests/benchmarks/bench_questions.py
+
+Binds N curies to each end of a three concept query and builds its questions
+the way generate_questions used to, permuting and deep copying the question
+graph for each value, and lazily with iter_questions. Reports time to the first
+question, time to build all of them and peak memory.
+"""
+import argparse
+import copy
+import logging
+import time
+import tracemalloc
+import requests_mock
+from tranql.main import TranQL
+from tranql.tests.mocks import MockMap
+
+def eager_questions (select, nodes, edges, options):
+    """ The previous algorithm: extend every question by each value of the next concept, copying as it goes. """
+    questions = [ select.message (q_nodes=[ node ], q_edges=[], options=options) for node in nodes[0] ]
+    for index, concept_nodes in enumerate (nodes[1:], start=1):
+        new_questions = []
+        for question in questions:
+            for node in concept_nodes:
+                q_nodes = copy.deepcopy (question["question_graph"]['nodes'])
+                q_nodes.append (node)
+                q_edges = copy.deepcopy (question["question_graph"]['edges'])
+                q_edges.append (copy.deepcopy (edges[index-1]))
+                new_questions.append (select.message (q_nodes=q_nodes, q_edges=q_edges, options=options))
+        questions = new_questions
+    for question in questions:
+        select.ast.schema.validate_question (question)
+        yield question
+
+def lazy_questions (select, nodes, edges, options):
+    questions = select.iter_questions (nodes, edges, options)
+    first = next (questions)
+    select.ast.schema.validate_question (first)
+    yield first
+    yield from questions
+
+def measure (generate, select, nodes, edges, options):
+    tracemalloc.start ()
+    start = time.perf_counter ()
+    questions = generate (select, nodes, edges, options)
+    next (questions)
+    first = time.perf_counter () - start
+    count = 1 + sum (1 for question in questions)
+    total = time.perf_counter () - start
+    peak = tracemalloc.get_traced_memory ()[1]
+    tracemalloc.stop ()
+    return count, first, total, peak
+
+def main ():
+    arg_parser = argparse.ArgumentParser (description='Question generation benchmark')
+    arg_parser.add_argument ('-n', '--values', type=int, default=150, help="Curies bound to each end of the query")
+    args = arg_parser.parse_args ()
+    logging.disable (logging.WARNING)
+    with requests_mock.Mocker () as mocker:
+        MockMap (mocker, "workflow-5")
+        tranql = TranQL ()
+        tranql.context.set ("chemicals", [ f"CHEBI:{i}" for i in range(args.values) ])
+        tranql.context.set ("diseases", [ f"MONDO:{i}" for i in range(args.values) ])
+        select = tranql.parse ("""
+            SELECT chemical_substance->gene->disease
+              FROM "/graph/gamma/quick"
+             WHERE chemical_substance = $chemicals
+               AND disease = $diseases
+        """).statements[0]
+        nodes, edges, options = select.prepare_questions (tranql)
+        for mode, generate in [ ("eager", eager_questions), ("lazy", lazy_questions) ]:
+            count, first, total, peak = measure (generate, select, nodes, edges, options)
+            print (f"{mode:>6}: {count} questions, first after {first * 1000:9.1f} ms, "
+                   f"all after {total * 1000:9.1f} ms, peak {peak / 2**20:8.1f} MiB")
+
+if __name__ == '__main__':
+    main ()
@@ -0,0 +1,116 @@
+"""
+Benchmark planning and validating long queries against a large schema.
+
+    PYTHONPATH=$PWD python tranql/tests/benchmarks/bench_schema.py
+
+Expands the mock schema with a registry of synthetic knowledge providers, each
+supporting a random share of the mock transitions, then plans and validates a
+long chain query. Lookups through the schema's TransitionIndex are compared with
+scanning every sub-schema and every schema graph edge, as the planner and
+validator used to. Also times reachable type lookups and proposing multi-hop paths.
+"""
+import argparse
+import logging
+import random
+import time
+import requests_mock
+from tranql.concept import BiolinkModelWalker
+from tranql.main import TranQL
+from tranql.tranql_ast import Query
+from tranql.tests.mocks import MockMap
+
+backplane = "http://localhost:8099"
+
+def register_kps (mocker, transitions, kps, share):
+    """ Serve a registry of kps providers, each answering a random share of the transitions. """
+    names = [ f"kp{i}" for i in range(kps) ]
+    mocker.get (f"{backplane}/graph/automat/registry", json=names)
+    for name in names:
+        schema = {}
+        for source_type, target_type, predicates in random.sample (transitions, int(len(transitions) * share)):
+            schema.setdefault (source_type, {})[target_type] = predicates
+        mocker.get (f"{backplane}/graph/automat/{name}/predicates", json=schema)
+
+def scan_sources (schema, source_type, target_type):
+    """ Candidate sources for an edge found the way plan_edge used to, scanning every sub-schema. """
+    candidates = []
+    for schema_name, sub_schema_package in schema.schema.items ():
+        sub_schema = sub_schema_package['schema']
+        if source_type in sub_schema:
+            if target_type in sub_schema[source_type]:
+                candidates.append ((schema_name, sub_schema_package['url']))
+        else:
+            implicit_conversion = BiolinkModelWalker ()
+            for conv_type in implicit_conversion.get_transitions (source_type):
+                if conv_type in sub_schema and target_type in sub_schema[conv_type]:
+                    candidates.append ((schema_name, sub_schema_package['url']))
+    return candidates
+
+def scan_edge (schema, source_type, target_type):
+    """ The previous NetworkxGraph.get_edge: a linear scan of the schema graph's edges. """
+    for e in schema.schema_graph.net.edges:
+        if e[0] == source_type and e[1] == target_type:
+            return e
+    return None
+
+def chain (schema, concept_model, hops):
+    """ A random walk over supported transitions between known concepts, as a list of types. """
+    edges = sorted (e for e in schema.transitions.edges if e[0] in concept_model and e[1] in concept_model)
+    types = [ random.choice (edges)[0] ]
+    while len(types) <= hops:
+        following = [ t for s, t in edges if s == types[-1] ]
+        types.append (random.choice (following) if following else random.choice (edges)[0])
+    return types
+
+def timed (function, rounds):
+    start = time.perf_counter ()
+    for i in range(rounds):
+        function ()
+    return (time.perf_counter () - start) / rounds
+
+def main ():
+    arg_parser = argparse.ArgumentParser (description='Schema transition index benchmark')
+    arg_parser.add_argument ('-k', '--kps', type=int, default=300, help="Registry knowledge providers")
+    arg_parser.add_argument ('-s', '--share', type=float, default=0.5, help="Share of transitions each supports")
+    arg_parser.add_argument ('-H', '--hops', type=int, default=8)
+    arg_parser.add_argument ('-r', '--rounds', type=int, default=20)
+    args = arg_parser.parse_args ()
+    logging.disable (logging.WARNING)
+    random.seed (0)
+    with requests_mock.Mocker () as mocker:
+        MockMap (mocker, "workflow-5")
+        seed = TranQL (options={ "recreate_schema" : True }).schema.schema["robokop"]["schema"]
+        transitions = [ (s, t, list(p)) for s, targets in seed.items () for t, p in targets.items () ]
+        register_kps (mocker, transitions, args.kps, args.share)
+        start = time.perf_counter ()
+        tranql = TranQL (options={ "registry" : True, "recreate_schema" : True })
+        built = time.perf_counter () - start
+    schema = tranql.schema
+    types = chain (schema, Query.concept_model, args.hops)
+    edges = list (zip (types, types[1:]))
+    print (f"{len(schema.schema)} sub-schemas, {schema.schema_graph.net.number_of_edges ()} schema graph edges, "
+           f"built with index in {built:.2f} s")
+    print (f"{args.hops} hop query: {'->'.join (types)}")
+
+    select = tranql.parse ("SELECT " + "->".join (f"c{i}:{t}" for i, t in enumerate (types)) + " FROM '/schema'").statements[0]
+    question = { "question_graph" : {
+        "nodes" : [ { "id" : f"c{i}", "type" : t } for i, t in enumerate (types) ],
+        "edges" : [ { "id" : f"e{i}", "source_id" : f"c{i}", "target_id" : f"c{i+1}" } for i in range(args.hops) ] } }
+    for name, scan, indexed in [
+            ("edge sources", lambda : [ scan_sources (schema, s, t) for s, t in edges ],
+                             lambda : [ (schema.transitions.sources (s, t), schema.transitions.conversions (s, t)) for s, t in edges ]),
+            ("validate", lambda : [ scan_edge (schema, s, t) for s, t in edges ],
+                         lambda : schema.validate_question (question)) ]:
+        print (f"{name:>13}: scan {timed (scan, args.rounds) * 1000:9.3f} ms, "
+               f"index {timed (indexed, args.rounds) * 1000:9.3f} ms per query")
+    print (f"{'plan':>13}: {timed (lambda : select.planner.plan (select.query), args.rounds) * 1000:9.3f} ms per query")
+    reachability = schema.reachability
+    print (f"{'reachable':>13}: {timed (lambda : reachability.reachable (types[0], 3), args.rounds * 100) * 1e6:9.3f} us per type")
+    far = [ (s, t) for s in sorted (reachability.distance) for t, hops in reachability.reachable (s) if hops == 3 ]
+    if len(far) > 0:
+        source_type, target_type = far[0]
+        print (f"{'3 hop paths':>13}: {timed (lambda : select.planner.propose_paths (source_type, target_type), args.rounds) * 1000:9.3f} ms "
+               f"for {source_type}->{target_type}")
+
+if __name__ == '__main__':
+    main ()
@@ -224,6 +224,44 @@ def test_merge_messages (client):
 
     assert ordered(response.json) == ordered(expected)
 
+    args['score_policy'] = 'median'
+    response = client.post(
+        f'/tranql/merge_messages',
+        query_string=args,
+        data=json.dumps(messages),
+        content_type='application/json'
+    )
+    assert response.status_code == 400
+    assert response.json['message'].startswith('Unknown score_policy')
+
+def test_program_cache (client, requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    program = "select chemical_substance->gene from '/graph/gamma/quick' where chemical_substance = 'CHEBI:28177'"
+    before = client.get('/tranql/cache').json
+    for i in range(2):
+        client.post('/tranql/query', data=program, query_string={ "asynchronous" : False })
+    after = client.get('/tranql/cache').json
+    # Testing recreates the schema per request, and a new schema version invalidates cached plans.
+    assert after['hits'] + after['misses'] == before['hits'] + before['misses'] + 2
+    assert 0 < after['size'] <= after['maxsize']
+
+def test_planner_statistics (client, requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    program = "select chemical_substance->gene from '/graph/gamma/quick' where chemical_substance = 'CHEBI:28177'"
+    client.post('/tranql/query', data=program, query_string={ "asynchronous" : False })
+    rows = client.get('/tranql/statistics').json
+    row = [ r for r in rows if (r['kp'], r['source_type'], r['target_type']) == ("robokop", "chemical_substance", "gene") ][0]
+    assert row['samples'] >= 1 and row['error_rate'] == 0 and not row['pruned']
+
+def test_query_explain (client, requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    program = "select chemical_substance->gene from '/graph/gamma/quick' where chemical_substance = 'CHEBI:28177'"
+    explanation = client.post('/tranql/query', data=program, query_string={ "asynchronous" : False, "explain" : "plan" }).json['explain']
+    assert not explanation['analyze']
+    assert [ s['transitions'] for s in explanation['segments'] ] == [ [ "chemical_substance->gene" ] ]
+    explanation = client.post('/tranql/query', data="explain analyze " + program, query_string={ "asynchronous" : False }).json['explain']
+    assert explanation['analyze'] and explanation['requests'] == 1 and explanation['segments'][0]['bytes'] > 0
+
 """
 [schema]
 """
@@ -233,6 +271,20 @@ def test_schema(client, requests_mock):
     assert 'schema' in response
     assert 'knowledge_graph' in response['schema']
 
+def test_reachable_types(client, requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    entry = client.get('/tranql/schema/reachable', query_string={ "type" : "chemical_substance" }).json['chemical_substance']
+    reachable = { t : hops for t, hops in entry['reachable'] }
+    assert reachable['gene'] == 1 and reachable['anatomical_entity'] == 2
+    assert [ hops for t, hops in entry['reachable'] ] == sorted (reachable.values ())
+    entry = client.get('/tranql/schema/reachable', query_string={ "type" : "chemical_substance", "max_hops" : 1 }).json['chemical_substance']
+    assert 'anatomical_entity' not in [ t for t, hops in entry['reachable'] ]
+    assert 'drug_exposure' in [ t for t, hops in entry['reaching'] ]
+    for max_hops in [ "two", "-1" ]:
+        response = client.get('/tranql/schema/reachable', query_string={ "max_hops" : max_hops })
+        assert response.status_code == 400
+        assert response.json['message'] == "max_hops must be a non-negative integer."
+
 def test_model_concepts(client, requests_mock):
     response = client.post('/tranql/model/concepts')
     assert isinstance(response.json,list)
@@ -304,6 +356,38 @@ def test_query(client, requests_mock):
     assert response.status_code == 500
     assert response.json['status'] == 'Error'
 
+def test_prepared_query(client, requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    response = client.post(
+        '/tranql/prepare',
+        data="""
+            SELECT chemical_substance->gene->biological_process->anatomical_entity
+              FROM "/graph/gamma/quick"
+             WHERE chemical_substance = $chemical
+        """,
+        content_type='text/plain'
+    )
+    assert response.json['parameters'] == ['chemical']
+    id = response.json['id']
+    for i in range(2):
+        response = client.post(
+            f'/tranql/execute/{id}',
+            query_string={ "asynchronous" : False },
+            data=json.dumps({ "chemical" : "CHEBI:28177" }),
+            content_type='application/json'
+        )
+        assert 'errors' not in response.json
+        assert response.json['knowledge_graph']['nodes'][0]['id'] == "CHEBI:28177"
+
+    for bindings in [ { "chemical" : "CHEBI:28177", "backplane" : "http://localhost:1" }, { } ]:
+        response = client.post(f'/tranql/execute/{id}', data=json.dumps(bindings), content_type='application/json')
+        assert response.status_code == 400
+        assert response.json['message'].startswith ("Bindings must set exactly the program's parameters: chemical.")
+
+    response = client.post('/tranql/execute/missing', data='{}', content_type='application/json')
+    assert response.status_code == 404
+    assert response.json['status'] == 'Error'
+
 # def test_root (client):
     # assert client.get('/').status_code == 200
 
@@ -0,0 +1,185 @@
+import asyncio
+import json
+import threading
+import time
+import pytest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from tranql.request_util import async_make_requests, ConcurrencyController, event_loop, session_registry
+from tranql.request_util import stream_requests_async
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    """ A knowledge provider that answers after a delay and records how many requests it serves at once. """
+    daemon_threads = True
+
+    def __init__(self, delay=0.05, fail=lambda server: False):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.delay = delay
+        self.fail = fail
+        self.lock = threading.Lock ()
+        self.active = 0
+        self.peak = 0
+        self.served = 0
+        self.clients = set ()
+
+    @property
+    def url (self):
+        return f"http://127.0.0.1:{self.server_address[1]}/query"
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST (self):
+        server = self.server
+        self.rfile.read (int(self.headers.get ('Content-Length', 0)))
+        with server.lock:
+            server.clients.add (self.client_address)
+            server.active += 1
+            server.peak = max (server.peak, server.active)
+            server.served += 1
+            failed = server.fail (server)
+        time.sleep (server.delay)
+        with server.lock:
+            server.active -= 1
+        body = json.dumps ({ "knowledge_map" : [] }).encode ()
+        self.send_response (503 if failed else 200)
+        self.send_header ("Content-Type", "application/json")
+        self.send_header ("Content-Length", str(len(body)))
+        self.end_headers ()
+        self.wfile.write (body)
+
+    def log_message (self, *args):
+        pass
+
+@pytest.fixture
+def stub_server ():
+    servers = []
+    def start (**kwargs):
+        server = StubServer (**kwargs)
+        threading.Thread (target=server.serve_forever, daemon=True).start ()
+        servers.append (server)
+        return server
+    yield start
+    for server in servers:
+        server.shutdown ()
+        server.server_close ()
+
+def questions (server, n):
+    return [ { "method" : "post", "url" : server.url, "json" : { "i" : i } } for i in range(n) ]
+
+def test_host_limit_is_enforced (stub_server):
+    server = stub_server ()
+    controller = ConcurrencyController (default_limit=3)
+    result = async_make_requests (questions (server, 12), maxRequests=None, controller=controller)
+    assert len(result["responses"]) == 12 and len(result["errors"]) == 0
+    assert server.peak == 3
+    assert controller.limiter (server.url).peak == 3
+    assert controller.limiter (server.url).in_flight == 0
+
+def test_per_call_limit_is_enforced (stub_server):
+    server = stub_server ()
+    controller = ConcurrencyController (default_limit=10)
+    async_make_requests (questions (server, 8), maxRequests=2, controller=controller)
+    assert server.peak == 2
+
+def test_hosts_are_limited_independently (stub_server):
+    fast, slow = stub_server (), stub_server ()
+    fast_host = fast.url.split ('/')[2]
+    controller = ConcurrencyController (default_limit=1, hosts={ fast_host : 4 })
+    async_make_requests (questions (fast, 8) + questions (slow, 3), maxRequests=None, controller=controller)
+    assert fast.peak == 4
+    assert slow.peak == 1
+
+def test_host_limit_is_shared_across_threads (stub_server):
+    server = stub_server (delay=0.1)
+    controller = ConcurrencyController (default_limit=2)
+    threads = [ threading.Thread (target=async_make_requests,
+                                  args=(questions (server, 4),),
+                                  kwargs={ "maxRequests" : None, "controller" : controller })
+                for i in range(3) ]
+    for thread in threads:
+        thread.start ()
+    for thread in threads:
+        thread.join ()
+    assert server.served == 12
+    assert server.peak == 2
+
+def test_adaptive_window (stub_server):
+    server = stub_server (delay=0.01)
+    controller = ConcurrencyController (default_limit=2, adaptive=True, maximum=8, latency_target=5)
+    async_make_requests (questions (server, 60), maxRequests=None, controller=controller)
+    limiter = controller.limiter (server.url)
+    assert limiter.window > 2
+    assert server.peak > 2
+    assert server.peak <= 8
+
+    """ Errors narrow the window, once per burst. """
+    widened = limiter.limit
+    server.fail = lambda server: True
+    result = async_make_requests (questions (server, 4), maxRequests=None, controller=controller)
+    assert len(result["errors"]) == 4
+    assert limiter.limit == pytest.approx (widened / 2)
+
+def test_connections_are_reused (stub_server):
+    server = stub_server (delay=0.01)
+    controller = ConcurrencyController (default_limit=4)
+    before = session_registry.connections_opened
+    for i in range(3):
+        result = async_make_requests (questions (server, 20), maxRequests=None, controller=controller)
+        assert len(result["responses"]) == 20
+    assert len(server.clients) <= 4
+    assert session_registry.connections_opened - before == len(server.clients)
+
+def test_callers_share_one_event_loop (stub_server):
+    server = stub_server (delay=0.05)
+    controller = ConcurrencyController (default_limit=8)
+    loops = []
+    """ Callers start their requests together, so they can only overlap on the loop. """
+    ready = threading.Barrier (4)
+    async def current_loop ():
+        return asyncio.get_event_loop ()
+    def query ():
+        loops.append (event_loop.run (current_loop ()))
+        ready.wait ()
+        async_make_requests (questions (server, 4), maxRequests=None, controller=controller)
+    threads = [ threading.Thread (target=query) for i in range(4) ]
+    for thread in threads:
+        thread.start ()
+    for thread in threads:
+        thread.join ()
+    assert set (loops) == { event_loop.get_loop () }
+    assert event_loop.get_loop () in session_registry.sessions
+    """ Requests from different callers overlap on the shared loop. """
+    assert server.peak > 4
+
+def test_blocking_on_the_loop_thread_is_refused ():
+    async def nested ():
+        event_loop.run (asyncio.sleep (0))
+    with pytest.raises (RuntimeError):
+        event_loop.run (nested ())
+
+def test_stream_requests_window_and_budgets (stub_server):
+    """ A stream keeps at most a window of requests in flight, and stops on request or at its deadline. """
+    server = stub_server (delay=0.05)
+    controller = ConcurrencyController (default_limit=8)
+    def stream (**kwargs):
+        async def run ():
+            return await stream_requests_async (iter (questions (server, 12)), controller=controller, **kwargs)
+        return event_loop.run (run ())
+    result = stream (window=3)
+    assert len(result["responses"]) == 12 and result["complete"]
+    assert server.peak == 3
+    server.served = 0
+    seen = []
+    result = stream (window=2, on_response=seen.append, stop=lambda : len(seen) >= 4)
+    assert len(result["responses"]) == 4 and not result["complete"]
+    assert server.served <= 6
+    """ Responses can be left to on_response alone. """
+    seen = []
+    result = stream (window=3, on_response=seen.append, keep_responses=False)
+    assert len(seen) == 12 and len(result["responses"]) == 0 and result["complete"]
+    async def deadline ():
+        return asyncio.get_event_loop ().time () + 0.12
+    result = stream (window=1, deadline=event_loop.run (deadline ()))
+    assert 1 <= len(result["responses"]) <= 3 and not result["complete"]
@@ -8,16 +8,20 @@ from pprint import pprint
 from deepdiff import DeepDiff
 from functools import reduce
 from tranql.main import TranQL
-from tranql.main import TranQLParser, set_verbose
-from tranql.tranql_ast import SetStatement, SelectStatement, custom_functions
-from tranql.tests.util import assert_lists_equal, set_mock, ordered
+from tranql.main import InterpreterPool, ProgramCache, TranQLParser, set_verbose
+from tranql.util import Context, ContextMemory, Vocabulary, VocabularyIndex
+from tranql.tranql_ast import SetStatement, SelectStatement, QueryPlanStrategy, custom_functions
+from tranql.kp_statistics import KPStatistics, kp_statistics
+from tranql.tests.util import assert_lists_equal, set_mock, mock_disease_services, ordered
 from tranql.tests.mocks import MockHelper
 from tranql.tests.mocks import MockMap
-from tranql.tranql_schema import SchemaFactory
+from tranql.tranql_schema import SchemaFactory, TransitionIndex
+from tranql.request_util import event_loop
+import asyncio
 import requests_mock
 from unittest.mock import patch
-import copy, time
-from tranql.utils.merge_utils import connect_knowledge_maps, find_all_paths
+import copy, time, threading
+from tranql.utils.merge_utils import connect_knowledge_maps, iter_paths, MergeAccumulator
 
 #set_verbose ()
 
@@ -1282,6 +1286,536 @@ def test_interpreter_set (requests_mock):
     assert output['disease'] == "asthma"
     assert output['cohort'] == "COHORT:22"
 
+def test_interpreter_pool (requests_mock):
+    """ Pooled interpreters share schema and parser but keep their own context and options. """
+    set_mock(requests_mock, "workflow-5")
+    pool = InterpreterPool ()
+    first = pool.get (options={ "asynchronous" : False })
+    second = pool.get (options={ "asynchronous" : True, "dynamic_id_resolution" : True })
+    assert first.schema is second.schema
+    assert first.parser is second.parser
+    assert first.context is not second.context
+    assert not first.asynchronous and second.asynchronous
+    assert second.dynamic_id_resolution
+    first.context.set ("x", 1)
+    assert second.context.resolve_arg ("$x") is None
+    assert pool.get (options={ "recreate_schema" : True }).parser is not first.parser
+    # New requests pick up a refreshed schema snapshot; existing interpreters keep theirs.
+    refreshed = SchemaFactory.refresh ("http://localhost:8099", use_registry=False)
+    third = pool.get ()
+    assert third.schema is refreshed and third.parser.schema is refreshed
+    assert first.schema is not refreshed
+
+def test_program_cache (requests_mock):
+    """ Programs differing only in whitespace, comments and keyword case share one planned entry. """
+    set_mock(requests_mock, "workflow-5")
+    tranql = TranQL ()
+    parser = TranQLParser (tranql.schema, cache=ProgramCache (maxsize=2))
+    program = """
+        select chemical_substance->gene->disease
+          from "/schema"
+         where disease = "MONDO:0004979"
+    """
+    first = parser.parse (program)
+    second = parser.parse ("SELECT chemical_substance->gene->disease FROM '/schema' -- asthma\n WHERE disease = 'MONDO:0004979'")
+    assert parser.cache.stats () == { "size" : 2, "maxsize" : 2, "hits" : 0, "misses" : 2 }
+    second = parser.parse ('SELECT chemical_substance->gene->disease FROM "/schema"   WHERE disease = "MONDO:0004979"')
+    assert parser.cache.stats ()["hits"] == 1
+    # Each parse gets its own planned statements to mutate.
+    assert first.statements[0].planned is not None
+    assert first.statements[0].planned[0] is not second.statements[0].planned[0]
+    assert first.statements[0].query.concepts["gene"] is not second.statements[0].query.concepts["gene"]
+    assert first.schema is second.schema
+    first.statements[0].query.concepts["disease"].set_nodes (["MONDO:1"])
+    assert second.statements[0].query.concepts["disease"].nodes == ["MONDO:0004979"]
+    # Quoted strings are not normalized, and the cache stays within its bound.
+    assert ProgramCache.normalize ("SET x = 'A  B'") != ProgramCache.normalize ("SET x = 'a b'")
+    parser.parse ("select gene from '/schema' where gene = 'HGNC:5'")
+    parser.parse ("select disease from '/schema' where disease = 'MONDO:1'")
+    assert parser.cache.stats ()["size"] == 2
+
+def test_prepared_program (requests_mock):
+    """ A prepared program is planned once and executed with different bindings. """
+    set_mock(requests_mock, "workflow-5")
+    tranql = TranQL ()
+    prepared = tranql.prepare ("""
+        set disease = 'MONDO:0004979'
+        select chemical_substance->gene->disease
+          from "/schema"
+         where chemical_substance = $drug
+           and disease = $disease
+    """)
+    assert prepared.parameters == [ "drug" ]
+    assert prepared.id == tranql.prepare ("SET disease = 'MONDO:0004979' SELECT chemical_substance->gene->disease FROM \"/schema\" WHERE chemical_substance = $drug AND disease = $disease").id
+    planned = prepared.ast.statements[1].planned
+    assert len(planned) > 0
+    # Executions work on copies and leave the prepared plan untouched.
+    for drug in [ "CHEBI:28177", "PUBCHEM:2083" ]:
+        interpreter = TranQL ()
+        prepared.execute (interpreter, { "drug" : drug })
+        assert interpreter.context.resolve_arg ("$drug") == drug
+        assert 'result' in interpreter.context.mem
+    assert prepared.ast.statements[1].planned is planned
+    assert prepared.ast.statements[1].query.concepts["chemical_substance"].nodes == [ "$drug" ]
+    # Variables read by SET values and FROM clauses are parameters too.
+    assert tranql.prepare ("""
+        set disease = $disease_id
+        select chemical_substance->gene->disease
+          from "$service"
+         where chemical_substance = $drug
+           and disease = $disease
+    """).parameters == [ "disease_id", "drug", "service" ]
+
+def test_cached_program_replans_on_statistics (requests_mock):
+    """ Cached and prepared programs are planned again once statistics would change their plan. """
+    set_mock(requests_mock, "workflow-5")
+    kp_statistics.clear ()
+    tranql = TranQL ()
+    parser = TranQLParser (tranql.schema, cache=ProgramCache (maxsize=4))
+    program = """
+        SELECT chemical_substance->disease->gene
+          FROM '/schema'
+         WHERE chemical_substance = 'CHEBI:28177'
+    """
+    services = lambda ast : [ s.service for s in ast.statements[0].planned ]
+    prepared = tranql.prepare (program)
+    assert "/graph/roger" in services (parser.parse (program)) and "/graph/roger" in services (prepared.ast)
+    generation = kp_statistics.generation ()
+    try:
+        """ Too few observations to trust don't change the plan, or the generation. """
+        kp_statistics.record ("roger", "chemical_substance", None, "disease", requests=1, errors=0, latency=1, inputs=1, answers=0)
+        assert kp_statistics.generation () == generation
+        parser.parse (program)
+        assert parser.cache.stats ()["hits"] == 1
+        """ Roger answering nothing over enough questions is pruned from the next plan. """
+        kp_statistics.record ("roger", "chemical_substance", None, "disease", requests=kp_statistics.min_samples,
+                              errors=0, latency=1, inputs=kp_statistics.min_samples, answers=0)
+        assert kp_statistics.generation () != generation
+        assert "/graph/roger" not in services (parser.parse (program))
+        assert parser.cache.stats ()["misses"] == 2
+        with patch.object (TranQL, "execute"):
+            prepared.execute (TranQL (), { })
+        assert "/graph/roger" not in services (prepared.ast)
+        """ Pruned transitions are planned again once their observations expire. """
+        generation = kp_statistics.generation ()
+        kp_statistics.expiry = 0
+        assert kp_statistics.generation () != generation
+    finally:
+        kp_statistics.clear ()
+
+def test_execute_async (requests_mock):
+    """ Programs awaited together on the event loop give the same results as the blocking API. """
+    set_mock(requests_mock, "workflow-5")
+    program = """
+        SELECT chemical_substance->gene->biological_process->anatomical_entity
+          FROM "/graph/gamma/quick"
+         WHERE chemical_substance = 'CHEBI:28177'
+    """
+    expected = TranQL (options={ "asynchronous" : False }).execute (program).mem['result']
+    interpreters = [ TranQL (options={ "asynchronous" : False }) for i in range(3) ]
+    async def run_all ():
+        return await asyncio.gather (*[ tranql.execute_async (program) for tranql in interpreters ])
+    contexts = event_loop.run (run_all ())
+    for context in contexts:
+        assert ordered (context.mem['result']) == ordered (expected)
+    """ Statements keep their blocking interface. """
+    statement = SetStatement (variable="x", value="y")
+    assert statement.execute (interpreters[0]) == "y"
+
+def test_plan_schedule (requests_mock):
+    """ Alternatives for a hop run together; a hop waits only on the hop it takes bindings from. """
+    set_mock(requests_mock, "workflow-5")
+    tranql = TranQL ()
+    select = tranql.parse ("""
+        SELECT chemical_substance->disease->gene
+          FROM '/schema'
+         WHERE chemical_substance = 'CHEBI:28177'
+    """).statements[0]
+    services = [ statement.service for statement in select.planned ]
+    assert services == [ "/graph/gamma/quick", "/graph/rtx", "/graph/roger", "/graph/gamma/quick" ]
+    assert select.schedule (select.planned) == [
+        { "members" : [ 0, 1, 2 ], "depends" : None, "name" : None },
+        { "members" : [ 3 ], "depends" : 0, "name" : "disease" }
+    ]
+    """ A hop whose shared concept the query binds doesn't wait. """
+    select = tranql.parse ("""
+        SELECT chemical_substance->disease->gene
+          FROM '/schema'
+         WHERE chemical_substance = 'CHEBI:28177'
+           AND disease = 'MONDO:0004979'
+    """).statements[0]
+    assert [ group['depends'] for group in select.schedule (select.planned) ] == [ None, None ]
+
+def test_streaming_handoff (requests_mock):
+    """ Handoff curies stream downstream in windows, and each curie is queried once. """
+    set_mock(requests_mock, "workflow-5")
+    diseases = { "/graph/gamma/quick" : [ "MONDO:1", "MONDO:2" ],
+                 "/graph/rtx" : [ "MONDO:2", "MONDO:3" ],
+                 "/graph/roger" : [ "MONDO:3", "MONDO:4", "MONDO:5" ] }
+    queried = []
+    mock_disease_services (requests_mock, diseases, queried)
+    tranql = TranQL (options={ "asynchronous" : False, "streaming_handoff" : True, "handoff_window" : 2 })
+    select = tranql.parse ("""
+        SELECT chemical_substance->disease->gene
+          FROM '/schema'
+         WHERE chemical_substance = 'CHEBI:28177'
+    """).statements[0]
+    windows = []
+    fork = SelectStatement.fork
+    def record (statement):
+        forked = fork (statement)
+        windows.append (forked)
+        return forked
+    with patch.object (SelectStatement, "fork", record):
+        result = event_loop.run (select.execute_async (tranql))
+    assert sorted (queried) == [ "MONDO:1", "MONDO:2", "MONDO:3", "MONDO:4", "MONDO:5" ]
+    assert all (len(statement.query.concepts["disease"].nodes) <= 2 for statement in windows)
+    assert "HGNC:5" in [ node["id"] for node in result["knowledge_graph"]["nodes"] ]
+    """ Segments in the plan keep their own bindings. """
+    assert not any ("curie" in node for node in select.planned[3].query.concepts["disease"].nodes)
+    """ Flags set in the environment are strings. """
+    for value, expected in [ ("false", False), ("False", False), ("true", True) ]:
+        with patch.dict (os.environ, { "STREAMING_HANDOFF" : value }):
+            assert TranQL ().streaming_handoff is expected
+
+def test_batched_questions (requests_mock):
+    """ Services declaring a batch_size get many curies per question node; caps on questions are reported. """
+    set_mock(requests_mock, "workflow-5")
+    curies = [ f"CHEBI:{i}" for i in range(5) ]
+    tranql = TranQL ()
+    ast = tranql.parse (f"""
+        SET chemicals = {curies}
+        SELECT chemical_substance->gene
+          FROM "/graph/gamma/quick"
+         WHERE chemical_substance = $chemicals
+    """)
+    ast.statements[0].execute (tranql)
+    select = ast.statements[1]
+    assert select.get_batch_size (tranql) == 1
+    assert len(select.generate_questions (tranql)) == 5
+    with patch.object (SelectStatement, "get_batch_size", return_value=2):
+        questions = select.generate_questions (tranql)
+    assert [ q['question_graph']['nodes'][0]['curie'] for q in questions ] == [ curies[0:2], curies[2:4], curies[4:] ]
+    assert all (len(q['question_graph']['nodes']) == 2 for q in questions)
+
+def test_lazy_questions (requests_mock):
+    """ Questions are generated lazily, one per permutation, sharing the parts that don't vary. """
+    set_mock(requests_mock, "workflow-5")
+    tranql = TranQL ()
+    tranql.context.set ("chemicals", [ "CHEBI:1", "CHEBI:2", "CHEBI:3" ])
+    tranql.context.set ("diseases", [ "MONDO:1", "MONDO:2" ])
+    select = tranql.parse ("""
+        SELECT chemical_substance->gene<-disease
+          FROM "/graph/gamma/quick"
+         WHERE chemical_substance = $chemicals
+           AND disease = $diseases
+    """).statements[0]
+    nodes, edges, options = select.prepare_questions (tranql)
+    questions = select.iter_questions (nodes, edges, options)
+    assert next (questions)['question_graph']['nodes'][2]['curie'] == "MONDO:1"
+    questions = list (select.iter_questions (nodes, edges, options))
+    assert len(questions) == 6
+    assert [ (q['question_graph']['nodes'][0]['curie'], q['question_graph']['nodes'][2]['curie']) for q in questions ] == \
+        list (itertools.product ([ "CHEBI:1", "CHEBI:2", "CHEBI:3" ], [ "MONDO:1", "MONDO:2" ]))
+    assert all (q['question_graph']['edges'] is edges for q in questions)
+    assert [ (e['source_id'], e['target_id']) for e in edges ] == [ ("chemical_substance", "gene"), ("disease", "gene") ]
+    assert ordered (select.generate_questions (tranql)) == ordered (questions)
+
+def test_question_fanout (requests_mock):
+    """ Every question is sent, unless a budget in the where clause says enough; progress is reported. """
+    set_mock(requests_mock, "workflow-5")
+    curies = [ f"CHEBI:{i}" for i in range(60) ]
+    program = f"""
+        SET chemicals = {curies}
+        SELECT chemical_substance->gene
+          FROM "/graph/gamma/quick"
+         WHERE chemical_substance = $chemicals
+    """
+    posts = lambda : len([ r for r in requests_mock.request_history if r.method == "POST" ])
+    kp_statistics.clear ()
+    tranql = TranQL (options={ "asynchronous" : False })
+    context = tranql.execute (program)
+    assert posts () == 60
+    progress = context.mem['progress'][-1]
+    assert (progress['questions'], progress['done'], progress['answers'], progress['complete']) == (60, 60, 60, True)
+    """ Each gamma_quick.json response has one answer. """
+    tranql = TranQL (options={ "asynchronous" : False })
+    context = tranql.execute (program + " AND answer_budget = 5")
+    assert posts () == 65
+    progress = context.mem['progress'][-1]
+    assert (progress['done'], progress['answers'], progress['complete']) == (5, 5, False)
+    assert not "answer_budget" in requests_mock.request_history[-1].json ()["options"]
+    """ Each question was credited to the provider's statistics. """
+    estimate = kp_statistics.get ("robokop", "chemical_substance", None, "gene")
+    assert estimate['samples'] == 65 and estimate['error_rate'] == 0 and estimate['fan_out'] == 1
+    """ Failed requests are errors, not answered questions. """
+    requests_mock.post (requests_mock.request_history[-1].url, status_code=500)
+    tranql = TranQL (options={ "asynchronous" : False })
+    context = tranql.execute (program)
+    progress = context.mem['progress'][-1]
+    assert (progress['done'], progress['answers']) == (0, 0)
+    assert any ("No valid results" in str (e) for e in context.mem['requestErrors'])
+    kp_statistics.clear ()
+
+def plan_with_statistics (tranql, program, statistics):
+    """ Plan a program's first select with a planner using the given KP statistics. """
+    select = tranql.parse (program).statements[0]
+    select.planner = QueryPlanStrategy (select.planner.schema, statistics=statistics)
+    return select.plan (select.planner.plan (select.query))
+
+def test_cost_based_plan (requests_mock, tmp_path):
+    """ Observed KP statistics order alternatives, drop useless ones and choose where to start. """
+    set_mock(requests_mock, "workflow-5")
+    tranql = TranQL ()
+    statistics = KPStatistics (min_samples=2)
+    plan = lambda program : plan_with_statistics (tranql, program, statistics)
+    program = """
+        SELECT chemical_substance->disease->gene
+          FROM '/schema'
+         WHERE chemical_substance = 'CHEBI:28177'
+    """
+    assert [ s.service for s in plan (program) ] == [ "/graph/gamma/quick", "/graph/rtx", "/graph/roger", "/graph/gamma/quick" ]
+    statistics.record ("rtx", "chemical_substance", None, "disease", requests=4, errors=0, latency=0.4, inputs=4, answers=8)
+    statistics.record ("robokop", "chemical_substance", None, "disease", requests=4, errors=0, latency=8, inputs=4, answers=8)
+    statistics.record ("roger", "chemical_substance", None, "disease", requests=4, errors=0, latency=0.4, inputs=4, answers=0)
+    """ Roger is left out and rtx goes first. Robokop answers both hops, so its segments join. """
+    assert [ (s.service, s.query.order) for s in plan (program) ] == [
+        ("/graph/rtx", [ "chemical_substance", "disease" ]),
+        ("/graph/gamma/quick", [ "chemical_substance", "disease", "gene" ]) ]
+    """ Statistics persist between runs. """
+    statistics.path = str(tmp_path / "statistics.json")
+    statistics.save ()
+    restored = KPStatistics (path=statistics.path, min_samples=2)
+    assert restored.explain () == statistics.explain ()
+    assert [ row['kp'] for row in restored.explain () if row['pruned'] ] == [ "roger" ]
+    """ With both ends bound, start from the end that hands on fewer curies. """
+    statistics = KPStatistics (min_samples=2)
+    for kp in [ "robokop", "rtx", "roger" ]:
+        statistics.record (kp, "chemical_substance", None, "disease", requests=4, errors=0, latency=0.4, inputs=4, answers=400)
+    statistics.record ("robokop", "disease", None, "gene", requests=4, errors=0, latency=0.4, inputs=4, answers=2)
+    assert [ s.query.order for s in plan (program) ][0] == [ "chemical_substance", "disease" ]
+    assert [ s.query.order for s in plan (program + " AND gene = 'HGNC:5'") ][0] == [ "disease", "gene" ]
+
+def test_multi_hop_plan (requests_mock):
+    """ Types no reasoner connects are bridged through intermediate types, cheapest path first. """
+    set_mock(requests_mock, "workflow-5")
+    tranql = TranQL ()
+    statistics = KPStatistics (min_samples=2)
+    plan = lambda program : plan_with_statistics (tranql, program, statistics)
+    reachability = tranql.schema.reachability
+    assert reachability.hops ("chemical_substance", "anatomical_entity") == 2
+    assert [ t for t, hops in reachability.reachable ("chemical_substance", 1) ] == \
+        sorted (t for s, t in tranql.schema.transitions.edges if s == "chemical_substance")
+    assert all (len(path) == 3 for path in reachability.paths ("chemical_substance", "anatomical_entity", 2))
+    assert reachability.paths ("chemical_substance", "anatomical_entity", 1) == []
+    program = "SELECT chemical_substance->anatomical_entity FROM '/schema' WHERE chemical_substance = 'CHEBI:28177'"
+    planned = plan (program)
+    assert [ s.service for s in planned ] == [ "/graph/gamma/quick" ]
+    assert [ planned[0].query[name].type_name for name in planned[0].query.order ] == \
+        [ "chemical_substance", "biological_process", "anatomical_entity" ]
+    """ Slow hops make a path more expensive. """
+    statistics.record ("robokop", "chemical_substance", None, "biological_process", requests=4, errors=0, latency=40, inputs=4, answers=4)
+    statistics.record ("robokop", "chemical_substance", None, "biological_process_or_activity", requests=4, errors=0, latency=40, inputs=4, answers=4)
+    """ Several reasoners answer chemical_substance->disease, each in a segment of its own. """
+    assert [ (s.service, [ s.query[name].type_name for name in s.query.order ]) for s in plan (program) ] == [
+        ("/graph/gamma/quick", [ "chemical_substance", "disease" ]),
+        ("/graph/rtx", [ "chemical_substance", "disease" ]),
+        ("/graph/roger", [ "chemical_substance", "disease" ]),
+        ("/graph/gamma/quick", [ "disease", "anatomical_entity" ]) ]
+    """ Backward arrows are bridged too, keeping the query's order. """
+    planned = plan ("SELECT anatomical_entity<-chemical_substance FROM '/schema'")
+    assert [ planned[0].query[name].type_name for name in planned[0].query.order ] == \
+        [ "anatomical_entity", "disease", "chemical_substance" ]
+    """ An explicit predicate can't be satisfied by a path. """
+    assert plan ("SELECT chemical_substance-[treats]->anatomical_entity FROM '/schema'") == []
+    """ Paths through a hop no reasoner answers are skipped. """
+    planner = QueryPlanStrategy (tranql.schema, statistics=statistics)
+    transitions = tranql.schema.transitions
+    sources = transitions.sources
+    with patch.object (transitions, "sources", lambda s, t : [] if t == "biological_process" else sources (s, t)):
+        proposed = planner.propose_paths ("chemical_substance", "anatomical_entity")
+    assert len(proposed) > 0 and all ("biological_process" not in path for cost, path in proposed)
+
+def test_explain (requests_mock):
+    """ EXPLAIN describes the plan without running it. EXPLAIN ANALYZE runs it and reports what each segment did. """
+    set_mock(requests_mock, "workflow-5")
+    diseases = { "/graph/gamma/quick" : [ "MONDO:1", "MONDO:2" ],
+                 "/graph/rtx" : [ "MONDO:3" ],
+                 "/graph/roger" : [ "MONDO:4", "MONDO:5" ] }
+    mock_disease_services (requests_mock, diseases)
+    posts = lambda : len([ r for r in requests_mock.request_history if r.method == "POST" ])
+    program = """
+        SELECT chemical_substance->disease->gene
+          FROM '/schema'
+         WHERE chemical_substance = 'CHEBI:28177'
+    """
+    tranql = TranQL (options={ "asynchronous" : False, "streaming_handoff" : True })
+    assert tranql.parse ("Explain Analyze " + program).statements[0].explain == "analyze"
+    sent = posts ()
+    explanation = tranql.execute ("EXPLAIN " + program).mem['result']['explain']
+    assert posts () == sent and not explanation['analyze']
+    assert [ (s['kp'], s['transitions'], s['depends_on'], s['handoff'], s['estimated_questions']) for s in explanation['segments'] ] == [
+        ("robokop", [ "chemical_substance->disease" ], [], None, 1),
+        ("rtx", [ "chemical_substance->disease" ], [], None, 1),
+        ("roger", [ "chemical_substance->disease" ], [], None, 1),
+        ("robokop", [ "disease->gene" ], [ 0, 1, 2 ], "disease", None) ]
+    assert explanation['estimated_questions'] is None
+    """ Trusted statistics estimate the curies handed downstream. """
+    kp_statistics.clear ()
+    try:
+        for kp in [ "robokop", "rtx", "roger" ]:
+            kp_statistics.record (kp, "chemical_substance", None, "disease", requests=20, errors=0, latency=2, inputs=20, answers=40)
+        explanation = tranql.execute ("explain " + program).mem['result']['explain']
+        assert [ s['estimated_questions'] for s in explanation['segments'] ] == [ 1, 1, 1, 6 ]
+        assert explanation['estimated_questions'] == 9
+    finally:
+        kp_statistics.clear ()
+
+    sent = posts ()
+    context = tranql.execute ("EXPLAIN ANALYZE " + program)
+    explanation = context.mem['result']['explain']
+    assert explanation['analyze'] and context.mem['explain'][-1] is explanation
+    assert explanation['requests'] == posts () - sent == 8
+    assert [ (s['requests'], s['answers'], s['handoff_curies']) for s in explanation['segments'] ] == [
+        (1, 2, None), (1, 1, None), (1, 2, None), (5, 5, 5) ]
+    assert all (s['complete'] and s['errors'] == 0 and s['bytes'] > 0 for s in explanation['segments'])
+    """ The merged answers are those the statement would have returned. """
+    assert explanation['answers'] == len(tranql.execute (program).mem['result']['knowledge_map'])
+    """ Analyzed statements still set their variables for the statements after them. """
+    setting = program + " SET '$.knowledge_graph.nodes.[*].id' AS {}"
+    expected = tranql.execute (setting.format ("kg")).mem['kg']
+    context = tranql.execute ("EXPLAIN ANALYZE " + setting.format ("analyzed_kg"))
+    assert len(expected) > 0 and sorted (context.mem.get ('analyzed_kg', [])) == sorted (expected)
+    assert context.mem['result']['explain']['analyze']
+    kp_statistics.clear ()
+
+def test_statement_dependencies (requests_mock):
+    """ Statements wait only for earlier statements sharing a variable they read or set. """
+    set_mock(requests_mock, "workflow-5")
+    tranql = TranQL (options={ "asynchronous" : False })
+    ast = tranql.parse ("""
+        SET id_filters = "SCTID,rxcui,CAS,SMILES,umlscui"
+        SELECT population_of_individual_organisms->drug
+          FROM "/clinical/cohort/disease_to_chemical_exposure?provider=icees"
+         WHERE EstResidentialDensity < '2'
+           SET '$.knowledge_graph.nodes.[*].id' AS chemical_exposures
+        SELECT chemical_substance->gene
+          FROM "/graph/gamma/quick"
+         WHERE chemical_substance = $chemical_exposures
+           SET knowledge_graph
+        SET diseases = ["MONDO:1", "MONDO:2"]
+        SELECT disease->gene
+          FROM "/graph/gamma/quick"
+         WHERE disease = $diseases
+    """)
+    assert [ s.writes () for s in ast.statements ] == [
+        { "id_filters" }, { "chemical_exposures" }, { "knowledge_graph" }, { "diseases" }, set () ]
+    assert ast.statements[2].reads () >= { "chemical_exposures", "id_filters" }
+    assert ast.dependencies () == [ [], [ 0 ], [ 0, 1 ], [], [ 0, 3 ] ]
+
+def test_parallel_statements (requests_mock):
+    """ Independent selects run concurrently, a select reading another's variable runs after it. """
+    set_mock(requests_mock, "workflow-5")
+    def answer (curie):
+        def respond (request, context):
+            graph = request.json ()["question_graph"]
+            source, target = [ node["id"] for node in graph["nodes"] ]
+            binding = { source : graph["nodes"][0].get ("curie", "CHEBI:1"), target : curie }
+            return {
+                "question_graph" : graph,
+                "knowledge_graph" : { "nodes" : [ { "id" : v, "type" : k } for k, v in binding.items () ], "edges" : [] },
+                "knowledge_map" : [ { "node_bindings" : binding, "edge_bindings" : {} } ]
+            }
+        return respond
+    requests_mock.post ("http://localhost:8099/graph/gamma/quick", json=answer ("MONDO:1"))
+    requests_mock.post ("http://localhost:8099/graph/rtx", json=answer ("HGNC:1"))
+    """ requests_mock serializes requests, so overlap is observed around whole statements. """
+    state = { "active" : 0, "peak" : 0, "events" : [] }
+    execute_async = SelectStatement.execute_async
+    async def tracked (self, interpreter, context={}, on_response=None):
+        name = "->".join (self.query.order)
+        state['active'] += 1
+        state['peak'] = max (state['peak'], state['active'])
+        state['events'].append (("start", name))
+        try:
+            await asyncio.sleep (0.1)
+            return await execute_async (self, interpreter, context, on_response)
+        finally:
+            state['active'] -= 1
+            state['events'].append (("end", name))
+    program = """
+        SELECT chemical_substance->disease
+          FROM "/graph/gamma/quick"
+         WHERE chemical_substance = 'CHEBI:1'
+           SET '$.knowledge_graph.nodes.[*].id' AS diseases
+        SELECT chemical_substance->gene
+          FROM "/graph/rtx"
+         WHERE chemical_substance = 'CHEBI:2'
+           SET genes
+        SELECT disease->gene
+          FROM "/graph/rtx"
+         WHERE disease = $diseases
+    """
+    with patch.object (SelectStatement, "execute_async", tracked):
+        context = TranQL (options={ "asynchronous" : False }).execute (program)
+        events = state['events']
+        assert state['peak'] == 2
+        assert events[:2] == [ ("start", "chemical_substance->disease"), ("start", "chemical_substance->gene") ]
+        assert events.index (("end", "chemical_substance->disease")) < events.index (("start", "disease->gene"))
+        nodes = lambda graph : set (node['id'] for node in graph['knowledge_graph']['nodes'])
+        assert nodes (context.resolve_arg ("$genes")) == { "CHEBI:2", "HGNC:1" }
+        """ The program's result is the last select's, though another may finish after it. """
+        assert nodes (context.mem['result']) == { "CHEBI:1", "MONDO:1", "HGNC:1" }
+
+        state.update ({ "active" : 0, "peak" : 0, "events" : [] })
+        TranQL (options={ "asynchronous" : False, "parallel_statements" : False }).execute (program)
+        assert state['peak'] == 1
+
+        state.update ({ "active" : 0, "peak" : 0, "events" : [] })
+        with patch.dict (os.environ, { "PARALLEL_STATEMENTS" : "false" }):
+            TranQL (options={ "asynchronous" : False }).execute (program)
+        assert state['peak'] == 1
+
+def test_context_shares_vocabulary ():
+    """ Contexts share one read-only vocabulary; variables set on one context stay local to it. """
+    first = Context ()
+    second = Context ()
+    assert first.mem.vocabulary is second.mem.vocabulary
+    assert first.resolve_arg ("$A1BG") == "HGNC:5"
+    first.set ("A1BG", "x")
+    assert first.resolve_arg ("$A1BG") == "x"
+    assert second.resolve_arg ("$A1BG") == "HGNC:5"
+    assert Vocabulary.get_instance ()["A1BG"] == "HGNC:5"
+    assert json.loads (json.dumps (first.mem)) == { "A1BG" : "x" }
+
+def test_vocabulary_index (tmp_path):
+    """ A compiled vocabulary index answers lookups like the symbol map it was built from. """
+    symbols = { "A1BG" : "HGNC:5", "asthma" : "MONDO:0004979", "ZZZ3" : "HGNC:24523", "ÅB" : "X:1" }
+    path = str(tmp_path / "vocabulary.idx")
+    VocabularyIndex.write (symbols, path)
+    index = VocabularyIndex (path)
+    assert len(index) == len(symbols)
+    for symbol, curie in symbols.items ():
+        assert index[symbol] == curie
+    assert index.get ("missing") is None
+    assert "A1B" not in index
+    assert dict(index) == symbols
+    context = Context ()
+    context.mem = ContextMemory (index)
+    assert context.resolve_arg ("$asthma") == "MONDO:0004979"
+    """ An index is stale once a source it wasn't compiled from appears. """
+    genes, diseases = tmp_path / "genes.txt", tmp_path / "disease_vocab.py"
+    genes.write_text ("HGNC:5\tA1BG\n")
+    sources = [ str(genes), str(diseases) ]
+    VocabularyIndex.write (symbols, path, [ str(genes) ])
+    assert VocabularyIndex (path).sources == [ "genes.txt" ]
+    assert VocabularyIndex.is_current (path, sources)
+    diseases.write_text ("")
+    os.utime (str(diseases), (0, 0))
+    assert not VocabularyIndex.is_current (path, sources)
+    VocabularyIndex.write (symbols, path, sources)
+    assert VocabularyIndex.is_current (path, sources)
+
 def test_program (requests_mock):
     print ("test_program ()")
     mock_map = MockMap (requests_mock, "workflow-5")
@@ -1536,8 +2070,12 @@ def test_schema_should_not_change_once_initilalized():
             )
             schema1 = schema_factory.get_instance()
             schema2 = schema_factory.get_instance()
-            # Doing something on second  schema instance should not affect the first.
-            schema2.schema['Lets add something'] = {'add some thing': 'dsds'}
+            # Readers share one snapshot, which can't be modified.
+            assert schema1 is schema2
+            with pytest.raises(TypeError):
+                schema2.schema['Lets add something'] = {'add some thing': 'dsds'}
+            with pytest.raises(TypeError):
+                schema2.schema['automat_kp1']['schema']['type1']['type3'] = ['related_to']
             assert 'Lets add something' not in schema1.schema
 
         with requests_mock.mock() as m:
@@ -1547,13 +2085,37 @@ def test_schema_should_not_change_once_initilalized():
                 m.get(f'{backplane}/graph/automat/{kp}/predicates', json=mock_schema_response[kp])
             # Now we change what registry returns and wait for update
             m.get(f'{backplane}/graph/automat/registry', json=['kp2'])
-            # lets wait for next updated and request a new object
+            # refresh the way the update thread does and request a new object
             # testing to see if our new request results will affect the
             # the original schema
-            time.sleep(update_interval + 1) # sleeping to ensure update thread is working
+            SchemaFactory.refresh(backplane, use_registry=True)
             schema2 = schema_factory.get_instance()
             # original reference to Schema should be different from second.
             assert schema1 != schema2
+            assert schema2.version > schema1.version
+            assert 'automat_kp2' in schema2.schema
+            # the snapshot held by an in-flight query is unchanged.
+            assert 'automat_kp1' in schema1.schema and 'automat_kp2' not in schema1.schema
+
+def test_schema_transition_index():
+    schema = {
+        'a': { 'url': '/a', 'schema': { 'gene': { 'disease': [ 'causes', 'treats' ] } } },
+        'b': { 'url': '/b', 'schema': { 'gene': { 'disease': 'related_to', 'cell': [] } } },
+        'c': { 'url': '/c', 'schema': { 'disease': { 'gene': [ 'related_to' ] } } }
+    }
+    class Walker:
+        concept_map = { 'phenotypic_feature' : None, 'gene' : None }
+        def get_transitions (self, source_type):
+            return [ 'disease' ] if source_type == 'phenotypic_feature' else []
+    index = TransitionIndex (schema, walker=Walker ())
+    assert index.sources ('gene', 'disease') == [ ('a', '/a', ('causes', 'treats')), ('b', '/b', ('related_to',)) ]
+    """ String predicates are kept whole. """
+    assert index.predicates ('gene', 'disease') == [ 'causes', 'treats', 'related_to' ]
+    assert index.sources ('disease', 'cell') == []
+    """ Transitions without predicates aren't valid edges. """
+    assert index.has_edge ('gene', 'disease') and not index.has_edge ('gene', 'cell')
+    assert index.conversions ('phenotypic_feature', 'gene') == [ ('c', '/c', 'disease') ]
+    assert index.conversions ('gene', 'gene') == []
 
 # ---------------- Knowledge map merge tests ----------
 
@@ -1570,15 +2132,7 @@ def test_find_paths_linear_graph():
             'node3': edge_set_2
         }
     }
-    paths = []
-    find_all_paths(
-        graph=linear_graph,
-        start='node1',
-        edge=None, # first incoming edge
-        visited=set(),
-        stack=[],
-        paths=paths
-    )
+    paths = list(iter_paths(linear_graph, 'node1'))
     assert len(paths) == 1
     # not the structure of paths is
     # [[node, edge], [node, edge]....]
@@ -1591,7 +2145,7 @@ def test_find_paths_linear_graph():
     assert edge_set_1 in edges_from_path
     assert edge_set_2 in edges_from_path
 
-def test_find_all_paths_branching_graph():
+def test_iter_paths_branching_graph():
     # things get tricky here
     edge_set= [
         ['e1', 'e2'],
@@ -1611,15 +2165,7 @@ def test_find_all_paths_branching_graph():
         'c': {'e': edge_set[3]},
         'd': {'f': edge_set[4]}
     }
-    paths = []
-    find_all_paths(
-        graph=branching_graph_diff_terminal_nodes,
-        start='a',
-        edge=None,
-        visited=set(),
-        stack=[],
-        paths=paths
-    )
+    paths = list(iter_paths(branching_graph_diff_terminal_nodes, 'a'))
     # we have two paths
     # a - b - c - e, a - b - d - f
     assert len(paths) == 2
@@ -1633,15 +2179,7 @@ def test_find_all_paths_branching_graph():
     branching_graph_same_terminal_nodes['d'] = {
         'e': edge_set[4]
     }
-    paths = []
-    find_all_paths(
-        graph=branching_graph_same_terminal_nodes,
-        start='a',
-        edge=None,
-        visited=set(),
-        stack=[],
-        paths=paths
-    )
+    paths = list(iter_paths(branching_graph_same_terminal_nodes, 'a'))
     assert len(paths) == 2
     nodes_paths = list(map(lambda x: set(map(lambda item: item[0], x)), paths))
     assert set(['a', 'b', 'c', 'e']) in nodes_paths
@@ -2181,3 +2719,195 @@ def test_merged_node_ids_should_be_updated_in_knowledge_map():
     assert node_bindings_by_edge_kg_id['e_kg_id_22']['n1'] == ['kg_id_3']
     assert node_bindings_by_edge_kg_id['e_kg_id_2']['n0'] == ['kg_id_1']
     assert node_bindings_by_edge_kg_id['e_kg_id_2']['n1'] == ['kg_id_3']
+
+def test_merge_accumulator_merges_equivalent_nodes_transitively():
+    # kg_id_c shares an identifier with each of kg_id_a and kg_id_b, so all three are one node
+    q_graph = {
+        'nodes': [{'id': 'n0', 'type': 'type1'}, {'id': 'n1', 'type': 'type2'}],
+        'edges': [{'id': 'e0', 'type': 'related_to', 'source_id': 'n0', 'target_id': 'n1'}]
+    }
+    kg_1 = {
+        'nodes': [
+            {'id': 'kg_id_a', 'equivalent_identifiers': ['kg_id_a', 'curie_x'], 'name': 'a'},
+            {'id': 'kg_id_b', 'equivalent_identifiers': ['kg_id_b', 'curie_y'], 'name': 'b'},
+            {'id': 'kg_id_d', 'equivalent_identifiers': [], 'name': 'd'}
+        ],
+        'edges': [
+            {'id': 'e_1', 'source_id': 'kg_id_b', 'target_id': 'kg_id_d', 'type': 'related_to'}
+        ]
+    }
+    kg_2 = {
+        'nodes': [
+            {'id': 'kg_id_c', 'equivalent_identifiers': ['kg_id_c', 'curie_x', 'curie_y'], 'name': 'c'},
+            {'id': 'kg_id_d', 'equivalent_identifiers': [], 'name': 'd'}
+        ],
+        'edges': [
+            {'id': 'e_2', 'source_id': 'kg_id_d', 'target_id': 'kg_id_c', 'type': 'related_to'}
+        ]
+    }
+    knowledge_map_1 = [{'node_bindings': {'n0': 'kg_id_b', 'n1': 'kg_id_d'}, 'edge_bindings': {'e0': ['e_1']}}]
+    knowledge_map_2 = [{'node_bindings': {'n0': ['kg_id_d'], 'n1': ['kg_id_c']}, 'edge_bindings': {'e0': ['e_2']}}]
+    responses = [
+        {'question_graph': q_graph, 'knowledge_map': knowledge_map_1, 'knowledge_graph': kg_1},
+        {'question_graph': q_graph, 'knowledge_map': knowledge_map_2, 'knowledge_graph': kg_2},
+    ]
+    accumulator = MergeAccumulator(name_based_merging=False)
+    for kg in copy.deepcopy([kg_1, kg_2]):
+        accumulator.add({'knowledge_graph': kg})
+    nodes = accumulator.snapshot()['knowledge_graph']['nodes']
+    assert [node['id'] for node in nodes] == ['kg_id_a', 'kg_id_d']
+    assert accumulator.node_ids == {'kg_id_b': 'kg_id_a', 'kg_id_c': 'kg_id_a'}
+    assert set(nodes[0]['equivalent_identifiers']) == {'kg_id_a', 'kg_id_b', 'kg_id_c', 'curie_x', 'curie_y'}
+
+    tranql = TranQL()
+    merged_response = SelectStatement.merge_results(responses, tranql, q_graph, ['n0', 'n1'])
+    assert [node['id'] for node in merged_response['knowledge_graph']['nodes']] == ['kg_id_a', 'kg_id_d']
+    edges_by_id = {edge['id']: edge for edge in merged_response['knowledge_graph']['edges']}
+    assert (edges_by_id['e_1']['source_id'], edges_by_id['e_1']['target_id']) == ('kg_id_a', 'kg_id_d')
+    assert (edges_by_id['e_2']['source_id'], edges_by_id['e_2']['target_id']) == ('kg_id_d', 'kg_id_a')
+    assert knowledge_map_1[0]['node_bindings'] == {'n0': ['kg_id_a'], 'n1': ['kg_id_d']}
+    assert knowledge_map_2[0]['node_bindings'] == {'n0': ['kg_id_d'], 'n1': ['kg_id_a']}
+
+def test_merge_accumulator_merges_duplicate_edges():
+    # keys are (types, source, target) tuples, so 'bc'->'d' and 'b'->'cd' stay apart
+    edges = [
+        {'id': 'e_1', 'source_id': 'bc', 'target_id': 'd', 'type': ['related_to'], 'publications': ['PMID:1']},
+        {'id': 'e_2', 'source_id': 'b', 'target_id': 'cd', 'type': ['related_to']},
+        {'id': 'e_3', 'source_id': 'bc', 'target_id': 'd', 'type': ['related_to'], 'publications': ['PMID:2']},
+        {'id': 'e_1', 'source_id': 'bc', 'target_id': 'd', 'type': ['related_to']},
+        {'id': 'e_4', 'source_id': 'bc', 'target_id': 'd', 'type': ['treats', 'related_to']}
+    ]
+    answer_1 = {'node_bindings': {}, 'edge_bindings': {'e0': ['e_3'], 'e1': ['e_2']}}
+    answer_2 = {'node_bindings': {}, 'edge_bindings': {'e0': 'e_3'}}
+    answer_3 = {'node_bindings': {}, 'edge_bindings': {'e0': ['e_4']}}
+    accumulator = MergeAccumulator()
+    # answer_1 binds e_3 before it is merged away, answer_3 arrives after
+    accumulator.add({'knowledge_graph': {'edges': edges[:2]}, 'knowledge_map': [answer_1, answer_2]})
+    accumulator.add({'knowledge_graph': {'edges': edges[2:]}, 'knowledge_map': [answer_3]})
+    merged = accumulator.snapshot()['knowledge_graph']['edges']
+    assert [edge['id'] for edge in merged] == ['e_1', 'e_2', 'e_4']
+    assert accumulator.edge_ids == {'e_3': 'e_1'}
+    assert set(merged[0]['publications']) == {'PMID:1', 'PMID:2'}
+    assert answer_1['edge_bindings'] == {'e0': ['e_1'], 'e1': ['e_2']}
+    assert answer_2['edge_bindings'] == {'e0': 'e_1'}
+    assert answer_3['edge_bindings'] == {'e0': ['e_4']}
+    index = accumulator.edge_bindings
+    assert index.referencing('e_3') == [] and index.referencing('e_1') == [answer_1, answer_2]
+
+def test_connect_knowledge_maps_long_chain():
+    # joins are iterative, so chains longer than the recursion limit still connect
+    hops = 2000
+    responses = [{
+        'question_graph': {
+            'nodes': [{'id': f'n{i}'}, {'id': f'n{i + 1}'}],
+            'edges': [{'id': f'e{i}', 'source_id': f'n{i}', 'target_id': f'n{i + 1}'}]
+        },
+        'knowledge_map': [
+            {'node_bindings': {f'n{i}': f'CURIE:{i}', f'n{i + 1}': f'CURIE:{i + 1}'}, 'edge_bindings': {f'e{i}': [f'E:{i}']}}
+        ]
+    } for i in range(hops)]
+    merged = connect_knowledge_maps(responses, [])
+    assert len(merged) == 1
+    assert merged[0]['node_bindings'] == {f'n{i}': [f'CURIE:{i}'] for i in range(hops + 1)}
+    assert merged[0]['edge_bindings'] == {f'e{i}': [f'E:{i}'] for i in range(hops)}
+
+    # two answers into a shared node, two out of it, and one that nothing extends
+    q_graph = {'nodes': [{'id': 'a'}, {'id': 'b'}, {'id': 'c'}],
+               'edges': [{'id': 'ab', 'source_id': 'a', 'target_id': 'b'}, {'id': 'bc', 'source_id': 'b', 'target_id': 'c'}]}
+    responses = [
+        {'question_graph': q_graph, 'knowledge_map': [
+            {'node_bindings': {'a': 'A:1', 'b': 'B:1'}, 'edge_bindings': {'ab': ['AB:1']}},
+            {'node_bindings': {'a': 'A:2', 'b': 'B:1'}, 'edge_bindings': {'ab': ['AB:2']}}]},
+        {'question_graph': q_graph, 'knowledge_map': [
+            {'node_bindings': {'b': 'B:1', 'c': 'C:1'}, 'edge_bindings': {'bc': ['BC:1']}},
+            {'node_bindings': {'b': 'B:1', 'c': 'C:2'}, 'edge_bindings': {'bc': ['BC:2']}},
+            {'node_bindings': {'b': 'B:2', 'c': 'C:3'}, 'edge_bindings': {'bc': ['BC:3']}}]}
+    ]
+    merged = connect_knowledge_maps(responses, ['a', 'b', 'c'])
+    assert [sorted(answer['edge_bindings'].values()) for answer in merged] == [
+        [['AB:1'], ['BC:1']], [['AB:1'], ['BC:2']], [['AB:2'], ['BC:1']], [['AB:2'], ['BC:2']], [['BC:3']]]
+    # joined answers don't share binding lists with each other or with the responses
+    assert merged[0]['edge_bindings']['ab'] is not merged[1]['edge_bindings']['ab']
+    assert merged[0]['edge_bindings']['ab'] is not responses[0]['knowledge_map'][0]['edge_bindings']['ab']
+
+def test_score_policies():
+    # answers joined from a 2 scored a->b and a 3 scored b->c, and one only a->b
+    q_graph = {'nodes': [{'id': 'a'}, {'id': 'b'}, {'id': 'c'}],
+               'edges': [{'id': 'ab', 'source_id': 'a', 'target_id': 'b'}, {'id': 'bc', 'source_id': 'b', 'target_id': 'c'}]}
+    def responses():
+        return [
+            {'question_graph': q_graph, 'knowledge_map': [
+                {'node_bindings': {'a': 'A:1', 'b': 'B:1'}, 'edge_bindings': {'ab': ['AB:1']}, 'score': 2},
+                {'node_bindings': {'a': 'A:2', 'b': 'B:2'}, 'edge_bindings': {'ab': ['AB:2']}, 'score': 4}]},
+            {'question_graph': q_graph, 'knowledge_map': [
+                {'node_bindings': {'b': 'B:1', 'c': 'C:1'}, 'edge_bindings': {'bc': ['BC:1']}, 'score': 3}]}
+        ]
+    expected = {'last': [3, 4], 'max': [3, 4], 'sum': [5, 4], 'product': [6, 4]}
+    for policy, scores in expected.items():
+        merged = connect_knowledge_maps(responses(), ['a', 'b', 'c'], policy)
+        assert [answer['score'] for answer in merged] == scores
+    with pytest.raises(ValueError):
+        connect_knowledge_maps(responses(), ['a', 'b', 'c'], 'median')
+
+    tranql = TranQL(options={'score_policy': 'product'})
+    merged = SelectStatement.merge_results(responses(), tranql, q_graph, ['a', 'b', 'c'])
+    assert [answer['score'] for answer in merged['knowledge_map']] == [6, 4]
+
+def test_merge_accumulator():
+    # A:3 arrives last and bridges the clusters of A:1 and A:2, so their edges to B:1 become duplicates
+    q_graph = {'nodes': [{'id': 'a'}, {'id': 'b'}], 'edges': [{'id': 'ab', 'source_id': 'a', 'target_id': 'b'}]}
+    def response(node, equivalent_identifiers, edge):
+        return {
+            'question_graph': q_graph,
+            'knowledge_graph': {
+                'nodes': [{'id': node, 'equivalent_identifiers': equivalent_identifiers}, {'id': 'B:1'}],
+                'edges': [{'id': edge, 'source_id': node, 'target_id': 'B:1', 'type': 'related_to'}]
+            },
+            'knowledge_map': [{'node_bindings': {'a': node, 'b': 'B:1'}, 'edge_bindings': {'ab': [edge]}}]
+        }
+    responses = [response('A:1', ['X:1'], 'E:1'), response('A:2', ['Y:1'], 'E:2'), response('A:3', ['X:1', 'Y:1'], 'E:3')]
+    tranql = TranQL()
+    accumulator = SelectStatement.merge_accumulator(tranql, q_graph, ['a', 'b'])
+    for count, folded in enumerate(copy.deepcopy(responses), 1):
+        accumulator.add(folded)
+        # a snapshot at any point is what merging the responses so far at once gives
+        merged = SelectStatement.merge_results(copy.deepcopy(responses[:count]), tranql, q_graph, ['a', 'b'])
+        snapshot = accumulator.snapshot()
+        assert [n['id'] for n in snapshot['knowledge_graph']['nodes']] == [n['id'] for n in merged['knowledge_graph']['nodes']]
+        assert [(e['id'], e['source_id'], e['target_id']) for e in snapshot['knowledge_graph']['edges']] == \
+            [(e['id'], e['source_id'], e['target_id']) for e in merged['knowledge_graph']['edges']]
+        assert snapshot['knowledge_map'] == merged['knowledge_map']
+    assert [n['id'] for n in snapshot['knowledge_graph']['nodes']] == ['A:1', 'B:1']
+    assert [e['id'] for e in snapshot['knowledge_graph']['edges']] == ['E:1']
+    assert snapshot['knowledge_map'] == [{'node_bindings': {'a': ['A:1'], 'b': ['B:1']}, 'edge_bindings': {'ab': ['E:1']}, 'score': 0}]
+    # merged away nodes and edges aren't kept
+    assert list(accumulator.nodes) == ['A:1', 'B:1'] and len(accumulator.edges) == 1
+
+def test_responses_merge_off_the_loop (requests_mock):
+    """ Responses are merged in the executor, so the shared loop keeps serving other queries. """
+    set_mock(requests_mock, "workflow-5")
+    def respond (request, context):
+        graph = request.json ()["question_graph"]
+        source, target = [ node["id"] for node in graph["nodes"] ]
+        binding = { source : "CHEBI:1", target : "MONDO:1" }
+        return {
+            "question_graph" : graph,
+            "knowledge_graph" : { "nodes" : [ { "id" : v, "type" : k } for k, v in binding.items () ], "edges" : [] },
+            "knowledge_map" : [ { "node_bindings" : binding, "edge_bindings" : {} } ]
+        }
+    requests_mock.post ("http://localhost:8099/graph/gamma/quick", json=respond)
+    folded = []
+    add = MergeAccumulator.add
+    def tracked (self, response):
+        folded.append (threading.current_thread ())
+        return add (self, response)
+    with patch.object (MergeAccumulator, 'add', tracked):
+        context = TranQL (options={ "asynchronous" : False, "recreate_schema" : True }).execute ("""
+            SELECT chemical_substance->disease
+              FROM "/graph/gamma/quick"
+             WHERE chemical_substance = 'CHEBI:1'
+        """)
+    result = context.mem['result']
+    assert len(folded) > 0
+    assert all (thread is not event_loop.thread for thread in folded)
+    assert [ node['id'] for node in result['knowledge_graph']['nodes'] ] == [ "CHEBI:1", "MONDO:1" ]
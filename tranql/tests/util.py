@@ -21,6 +21,36 @@ def set_mock (requests_mock, name):
     adapter = r_mock.Adapter()
     session.mount('requests_mock', adapter)
 
+def mock_disease_services (requests_mock, diseases, queried=None):
+    """
+    Answer chemical_substance->disease questions posted to each service in diseases with
+    the diseases listed for it, and questions with a disease bound with gene HGNC:5. If
+    given, queried collects the diseases bound in the questions.
+    """
+    def answer (service):
+        def respond (request, context):
+            graph = request.json ()["question_graph"]
+            nodes = { node["id"] : node for node in graph["nodes"] }
+            if "curie" in nodes["disease"]:
+                """ The gene hop, with the disease bound. """
+                if queried is not None:
+                    queried.append (nodes["disease"]["curie"])
+                bindings = [ { "disease" : nodes["disease"]["curie"], "gene" : "HGNC:5" } ]
+            else:
+                bindings = [ { "chemical_substance" : "CHEBI:28177", "disease" : disease }
+                             for disease in diseases[service] ]
+            return {
+                "question_graph" : graph,
+                "knowledge_graph" : {
+                    "nodes" : [ { "id" : curie, "type" : id } for binding in bindings for id, curie in binding.items () ],
+                    "edges" : []
+                },
+                "knowledge_map" : [ { "node_bindings" : binding, "edge_bindings" : {} } for binding in bindings ]
+            }
+        return respond
+    for service in diseases:
+        requests_mock.post (f"http://localhost:8099{service}", json=answer (service))
+
 def ordered(obj):
     if isinstance(obj, dict):
         return sorted((k, ordered(v)) for k, v in obj.items())
@@ -1,6 +1,9 @@
+import asyncio
 import copy
+import itertools
 import json
 import logging
+import math
 import requests
 import requests_cache
 import traceback
@@ -13,14 +16,16 @@ from tranql.concept import BiolinkModelWalker
 from tranql.util import Concept
 from tranql.util import JSONKit
 from tranql.util import deep_merge, light_merge
-from tranql.request_util import async_make_requests
+from tranql.request_util import event_loop, run_blocking, session_registry, stream_requests_async
+from tranql.kp_statistics import kp_statistics
+from tranql.config import Config
 from tranql.util import Text
 from tranql.exception import ServiceInvocationError
 from tranql.exception import UndefinedVariableError
 from tranql.exception import IllegalConceptIdentifierError
 from tranql.exception import UnknownServiceError
 from tranql.exception import InvalidTransitionException
-from tranql.utils.merge_utils import connect_knowledge_maps
+from tranql.utils.merge_utils import connect_knowledge_maps, MergeAccumulator
 from functools import reduce
 
 logger = logging.getLogger (__name__)
@@ -112,8 +117,26 @@ def mirror(x):
 class Statement:
     """ The interface contract for a statement. """
     def execute (self, interpreter, context={}):
+        """ Execute the statement on the interpreter's event loop, waiting for the result. """
+        return event_loop.run (self.execute_async (interpreter, context))
+
+    async def execute_async (self, interpreter, context={}):
         pass
 
+    def reads (self):
+        """ Names of the context variables executing this statement reads. """
+        return set ()
+
+    def writes (self):
+        """ Names of the context variables executing this statement sets. """
+        return set ()
+
+    @staticmethod
+    def variables (value):
+        """ Names of the $variables in a value or list of values. """
+        values = value if isinstance(value, list) else [ value ]
+        return set (v[1:] for v in values if isinstance(v, str) and v.startswith ("$"))
+
     def resolve_backplane_url(self, url, interpreter):
         result = url
         if url.startswith ('/'):
@@ -138,13 +161,13 @@ class Statement:
             "options" : options
         }
 
-    def request (self, url, message):
-        """ Make a web request to a service (url) posting a message. """
+    def request (self, url, message, metrics=None):
+        """ Make a web request to a service (url) posting a message. Counts bytes received in metrics, if given. """
         logger.debug (f"request({url})> {json.dumps(message, indent=2)}")
         response = {}
         unknown_service = False
         try:
-            http_response = requests.post (
+            http_response = session_registry.http_session ().post (
                 url = url,
                 json = message,
                 headers = {
@@ -152,6 +175,8 @@ class Statement:
                 })
             """ Check status and handle response. """
             if http_response.status_code == 200 or http_response.status_code == 202:
+                if metrics is not None:
+                    metrics['bytes'] += len(http_response.content)
                 response = http_response.json ()
                 #logger.error (f" response: {json.dumps(response, indent=2)}")
                 status = response.get('status', None)
@@ -183,7 +208,7 @@ class SetStatement(Statement):
         self.value = value
         self.jsonpath_query = jsonpath_query
         self.jsonkit = JSONKit ()
-    def execute (self, interpreter, context={}):
+    async def execute_async (self, interpreter, context={}):
         logger.debug (f"set-statement: {self.variable}={self.value}")
         return_val = None
         if self.value:
@@ -210,6 +235,12 @@ class SetStatement(Statement):
                 return_val = result
         return return_val
 
+    def reads (self):
+        return self.variables (self.value)
+
+    def writes (self):
+        return { self.variable }
+
     def __repr__(self):
         result = f"SET {self.variable}"
         if self.jsonpath_query is not None:
@@ -227,17 +258,22 @@ class CreateGraphStatement(Statement):
         self.name = name
     def __repr__(self):
         return f"CREATE GRAPH {self.graph} AT {self.service} AS {self.name}"
-    def execute (self, interpreter):
+    def reads (self):
+        return self.variables (self.graph) | self.variables (self.service)
+    def writes (self):
+        return { self.name }
+    async def execute_async (self, interpreter, context={}):
         """ Execute the statement. """
         self.service = self.resolve_backplane_url(self.service,
                                                   interpreter)
         graph = interpreter.context.resolve_arg (self.graph)
         logger.debug (f"------- {type(graph).__name__}")
         logger.debug (f"--- create graph {self.service} graph-> {json.dumps(graph, indent=2)}")
-        response = None
-        with requests_cache.disabled ():
-            response = self.request (url=self.service,
+        def create ():
+            with requests_cache.disabled ():
+                return self.request (url=self.service,
                                      message=graph)
+        response = await run_blocking (create)
         interpreter.context.set (self.name, response)
         return response
 
@@ -266,10 +302,29 @@ class SelectStatement(Statement):
         self.set_statements = []
         self.jsonkit = JSONKit ()
         self.planner = QueryPlanStrategy (ast.schema)
+        self.planned = None
+        """ None, "plan" to explain the plan instead of running it or "analyze" to run it and explain it. """
+        self.explain = None
+        self.metrics = None
 
     def __repr__(self):
         return f"SELECT {self.query} from:{self.service} where:{self.where} set:{self.set_statements}"
 
+    """ Variables every select reads while building its questions, set or not. """
+    implicit_reads = { "backplane", "id_filters" }
+
+    def reads (self):
+        """ Variables bound to concepts, used in constraints or naming the service, and those read implicitly. """
+        names = set (self.implicit_reads) | self.variables (self.service)
+        for name, op, value in self.where:
+            names |= self.variables (value)
+        for concept in self.query.concepts.values ():
+            names |= self.variables (concept.nodes)
+        return names
+
+    def writes (self):
+        return set (statement.variable for statement in self.set_statements)
+
     def edge (self, index, source, target, type_name=None):
         """ Generate a question edge. """
         e = {
@@ -377,13 +432,11 @@ class SelectStatement(Statement):
         sorted_plan = []
         is_bound = False
         start = None
-        # find a bound plan
-        for p in plan:
-            start = p[2]
-            # is bound if the start  or the end of the plan is bound
-            is_bound = len(start[0][0].nodes) or len(start[-1][2].nodes)
-            if is_bound:
-                break
+        # find a bound plan, the cheapest to start from if the query binds several concepts
+        bound = [ p for p in plan if len(p[2][0][0].nodes) or len(p[2][-1][2].nodes) ]
+        if len(bound) > 0:
+            start = min (bound, key=self.planner.start_cost)[2]
+            is_bound = True
         if is_bound:
             # find plans bound to the same concept that add them as starting queries
             for other_plan in plan:
@@ -443,6 +496,18 @@ class SelectStatement(Statement):
         self.query.disable = True # = Query ()
         return statements
 
+    def isolate (self):
+        """ Copy the concepts and constraints this segment shares with others so they can run concurrently. """
+        self.query.concepts = { name : copy.copy (concept) for name, concept in self.query.concepts.items () }
+        self.where = list (self.where)
+
+    def fork (self):
+        """ A copy of this segment with its own query, to execute with different bindings. """
+        statement = copy.copy (self)
+        statement.query = copy.copy (self.query)
+        statement.isolate ()
+        return statement
+
     def format_constraints(self,interpreter):
         schema = self.get_schema_name(interpreter)
         for enum, constraint in enumerate(self.where):
@@ -460,6 +525,15 @@ class SelectStatement(Statement):
         Given an archetype question graph and values, generate question
         instances for each value permutation.
         """
+        nodes, edges, options = self.prepare_questions (interpreter)
+        return list (self.iter_questions (nodes, edges, options))
+
+    def prepare_questions (self, interpreter):
+        """
+        Bind values to each concept and build the parts of the question graph that all
+        permutations share. Returns the question nodes to permute for each concept in query
+        order, the question edges and the options for the service.
+        """
         for index, name in enumerate(self.query.order):
             """ Convert literals into nodes in the message's question graph. """
             concept = self.query[name]
@@ -493,81 +567,240 @@ class SelectStatement(Statement):
             logger.debug (f"manage constraint: {constraint}")
             name, op, value = constraint
             value = interpreter.context.resolve_arg (value)
-            if not name in self.query:
+            if not name in self.query and not name in self.fanout_options:
                 """
                 This is not constraining a concept name in the graph query.
                 So interpret it as an option to the underlying service.
                 """
                 options[name] = constraint[1:]
-        edges = []
-        questions = []
+
+        batch_size = self.get_batch_size (interpreter)
         logger.debug (f"concept order> {self.query.order}")
-        for index, name in enumerate (self.query.order):
-            concept = self.query[name]
-            previous = self.query.order[index-1] if index > 0 else None
-            logger.debug (f"query:{self.query}")
-            #logger.debug (f"questions:{index} ==>> {json.dumps(questions, indent=2)}")
-            if index == 0:
-                """ Model the first step. """
-                if len(concept.nodes) > 0:
-                    """ The first concept is bound. """
-                    for node in concept.nodes:
-                        questions.append (self.message (
-                            q_nodes = [ node ],
-                            q_edges = [],
-                            options = options))
-                else:
-                    """ No nodes specified for the first concept. """
-                    questions.append (self.message (options=options))
+        nodes = [ self.batch_nodes (self.query[name].nodes, batch_size) for name in self.query.order ]
+        """ Question node ids are concept names, so every permutation has the same edges. """
+        edges = []
+        for index, name in enumerate (self.query.order[1:], start=1):
+            previous = self.query.order[index-1]
+            edge_spec = self.query.arrows[index-1]
+            if edge_spec.direction == self.query.forward_arrow:
+                source, target = previous, name
             else:
-                """ Not the first concept - permute relative to previous. """
-                new_questions = []
-                for question in questions:
-                    if len(concept.nodes) > 0:
-                        for node in concept.nodes:
-                            """ Permute each question. """
-                            nodes = copy.deepcopy (question["question_graph"]['nodes'])
-                            if len(nodes) == 0:
-                                logger.debug (f"No values in concept {concept.name}")
-                                continue
-                            lastnode = nodes[-1]
-                            nodes.append (node)
-                            edges = copy.deepcopy (question["question_graph"]['edges'])
-                            edge_spec = self.query.arrows[index-1]
-                            if edge_spec.direction == self.query.forward_arrow:
-                                edge_id = f'{index}_{lastnode["id"]}_{node["id"]}'
-                                edges.append (self.edge (
-                                    index = edge_id,
-                                    source=lastnode['id'],
-                                    target=node['id'],
-                                    type_name = edge_spec.predicate))
-                            else:
-                                edge_id = f'{index}_{node["id"]}_{lastnode["id"]}'
-                                edges.append (self.edge (
-                                    index = edge_id,
-                                    source=node['id'],
-                                    target=lastnode['id'],
-                                    type_name = edge_spec.predicate))
-                            new_questions.append (self.message (
-                                q_nodes = nodes,
-                                options = options,
-                                q_edges = edges))
-                    else:
-                        query_nodes = question['question_graph']['nodes']
-                        question['question_graph']['nodes'].append (
-                            self.node (index = name, #index,
-                                       type_name = concept.type_name))
-                        source_id = query_nodes[-2]['id']
-                        target_id = query_nodes[-1]['id']
-                        edge_id = f'{index}_{source_id}_{target_id}'
-                        question['question_graph']['edges'].append (
-                            self.edge (
-                                index = edge_id,
-                                source = source_id,
-                                target = target_id))
-                        new_questions.append (self.message (options=options))
-                questions = new_questions
-        return questions
+                source, target = name, previous
+            edges.append (self.edge (
+                index = f'{index}_{source}_{target}',
+                source = source,
+                target = target,
+                type_name = edge_spec.predicate))
+        return nodes, edges, options
+
+    def iter_questions (self, nodes, edges, options):
+        """
+        Lazily yield a question for each permutation of the concepts' nodes. Questions share
+        their node, edge and option objects, so treat them as read only.
+        """
+        for permutation in itertools.product (*nodes):
+            yield self.message (
+                q_nodes = list (permutation),
+                q_edges = edges,
+                options = options)
+
+    @staticmethod
+    def batch_nodes (nodes, batch_size):
+        """
+        Pack bound question nodes into nodes with a list valued curie, up to batch_size
+        curies each, so a service that accepts them answers many curies in one question.
+        """
+        if batch_size <= 1 or len(nodes) <= 1:
+            return nodes
+        batches = []
+        for start in range (0, len(nodes), batch_size):
+            batch = nodes[start:start+batch_size]
+            node = copy.deepcopy (batch[0])
+            node['curie'] = [ n['curie'] for n in batch ]
+            batches.append (node)
+        return batches
+
+    def transitions (self):
+        """ The (source_type, predicate, target_type) of each hop, oriented as the planner looks them up. """
+        for index, arrow in enumerate (self.query.arrows):
+            source_type = self.query[self.query.order[index]].type_name
+            target_type = self.query[self.query.order[index+1]].type_name
+            if arrow.direction == self.query.back_arrow:
+                source_type, target_type = target_type, source_type
+            yield source_type, arrow.predicate, target_type
+
+    def record_statistics (self, interpreter, nodes, requests, errors, latency, answers):
+        """ Credit the outcome of this statement's questions to each transition it asked its service about. """
+        kp = self.get_schema_name (interpreter)
+        if kp is None or requests == 0:
+            return
+        """ Bound curies per question, counting each curie of a batched node. """
+        curies = sum (
+            sum (len(n['curie']) if isinstance(n['curie'], list) else 1 for n in concept_nodes if 'curie' in n) / len(concept_nodes)
+            for concept_nodes in nodes if len(concept_nodes) > 0) or 1
+        for source_type, predicate, target_type in self.transitions ():
+            self.planner.statistics.record (kp, source_type, predicate, target_type,
+                                            requests=requests, errors=errors, latency=latency,
+                                            inputs=requests * curies, answers=answers)
+
+    @staticmethod
+    def timed (questions, metrics):
+        """ Pass questions through, adding the time spent generating them to metrics. """
+        while True:
+            generating = time.time ()
+            question = next (questions, None)
+            metrics['question_seconds'] += time.time () - generating
+            if question is None:
+                return
+            yield question
+
+    @staticmethod
+    def count_values (interpreter, concept):
+        """ How many curies are bound to a concept, resolving variables. """
+        count = 0
+        for value in concept.nodes:
+            if isinstance(value, str) and value.startswith ("$"):
+                resolved = interpreter.context.resolve_arg (value)
+                count += len(resolved) if isinstance(resolved, list) else int(resolved is not None)
+            else:
+                count += 1
+        return count
+
+    def explain_plan (self, interpreter):
+        """
+        Describe what executing this statement would do: the segments it is planned into,
+        the reasoner answering each, where each gets its bindings from, and the questions,
+        answers and seconds per question to expect, where bound values and statistics tell.
+        Unknown estimates are None.
+        """
+        if self.service == "/schema":
+            if self.planned is None:
+                self.planned = self.plan (self.planner.plan (self.query))
+            segments = self.planned
+        else:
+            segments = [ self ]
+        groups = self.schedule (segments)
+        handoffs = {}
+        rows = []
+        for g, group in enumerate (groups):
+            handed_on = 0
+            handoff = group['name'] if group['depends'] is not None else None
+            for i in group['members']:
+                statement = segments[i]
+                kp = statement.get_schema_name (interpreter)
+                batch_size = statement.get_batch_size (interpreter)
+                counts = [ handoffs[group['depends']] if name == handoff else self.count_values (interpreter, statement.query[name])
+                           for name in statement.query.order ]
+                questions = curies = None
+                if None not in counts:
+                    bound = [ count for count in counts if count > 0 ]
+                    questions = reduce (lambda n, count: n * math.ceil (count / batch_size), bound, 1)
+                    curies = reduce (lambda n, count: n * count, bound, 1)
+                fan_out = 1
+                cost = 0
+                transitions = []
+                for source_type, predicate, target_type in statement.transitions ():
+                    estimate = self.planner.statistics.fan_out (kp, source_type, predicate, target_type)
+                    fan_out = None if estimate is None or fan_out is None else fan_out * estimate
+                    cost += self.planner.statistics.cost (kp, source_type, predicate, target_type)
+                    transitions.append (f"{source_type}-[{predicate}]->{target_type}" if predicate else f"{source_type}->{target_type}")
+                answers = None if curies is None or fan_out is None else curies * fan_out
+                handed_on = None if answers is None or handed_on is None else handed_on + answers
+                rows.append ({
+                    "segment" : i,
+                    "kp" : kp,
+                    "service" : statement.service,
+                    "question_order" : statement.query.order,
+                    "transitions" : transitions,
+                    "implicit_conversion" : kp == "implicit_conversion",
+                    "depends_on" : groups[group['depends']]['members'] if handoff is not None else [],
+                    "handoff" : handoff,
+                    "batch_size" : batch_size,
+                    "estimated_questions" : questions,
+                    "estimated_answers" : answers,
+                    "estimated_seconds_per_question" : cost
+                })
+            handoffs[g] = None if handed_on is None else math.ceil (handed_on)
+        estimates = [ row['estimated_questions'] for row in rows ]
+        return {
+            "analyze" : False,
+            "service" : self.service,
+            "question_order" : self.query.order,
+            "segments" : rows,
+            "estimated_questions" : None if None in estimates else sum (estimates)
+        }
+
+    @staticmethod
+    def combine_metrics (executions):
+        """ Add up the metrics of each execution of a segment. Pipelined segments run once per window. """
+        combined = { "executions" : len(executions) }
+        for key in [ "questions", "question_seconds", "http_seconds", "latency_seconds", "requests",
+                     "errors", "bytes", "answers", "merge_seconds" ]:
+            combined[key] = sum (metrics[key] for metrics in executions)
+        combined['complete'] = len(executions) > 0 and all (metrics['complete'] for metrics in executions)
+        return combined
+
+    def explain_analysis (self, explanation, result, seconds):
+        """ Add what executing the statement actually did, per segment, to the explanation of its plan. """
+        if explanation['service'] == "/schema":
+            executions = self.metrics['segments']
+            handoffs = self.metrics['handoffs']
+        else:
+            executions = [ [ self.metrics ] ]
+            handoffs = [ None ]
+        for row in explanation['segments']:
+            handoff = handoffs[row['segment']] or {}
+            row.update (self.combine_metrics (executions[row['segment']]))
+            row['handoff_curies'] = handoff.get ('curies', None)
+            row['handoff_merge_seconds'] = handoff.get ('merge_seconds', 0)
+        explanation.update ({
+            "analyze" : True,
+            "seconds" : seconds,
+            "merge_seconds" : self.metrics['merge_seconds'],
+            "answers" : len(result.get ('knowledge_map', [])),
+            "requests" : sum (row['requests'] for row in explanation['segments']),
+            "errors" : sum (row['errors'] for row in explanation['segments']),
+            "bytes" : sum (row['bytes'] for row in explanation['segments'])
+        })
+        return explanation
+
+    def explained (self, interpreter, explanation):
+        """ Make an explanation this statement's result, and keep it with the others the program made. """
+        result = { "explain" : explanation }
+        interpreter.context.set ('result', result)
+        if interpreter.context.mem.get ('explain') is None:
+            interpreter.context.set ('explain', [])
+        interpreter.context.mem['explain'].append (explanation)
+        return result
+
+    fanout_options = [ "question_window", "answer_budget", "time_budget" ]
+
+    def fanout_settings (self, interpreter):
+        """
+        How to send this statement's questions: how many to keep in flight, and optionally
+        how many answers or seconds are enough. Where clause constraints on question_window,
+        answer_budget and time_budget override the interpreter's settings.
+        """
+        settings = {
+            "question_window" : interpreter.question_window,
+            "answer_budget" : interpreter.answer_budget,
+            "time_budget" : interpreter.time_budget
+        }
+        for name, op, value in self.where:
+            if name in self.fanout_options and not name in self.query:
+                settings[name] = interpreter.context.resolve_arg (value)
+        return {
+            "question_window" : max (1, int(settings['question_window'])),
+            "answer_budget" : int(settings['answer_budget'] or 0) or None,
+            "time_budget" : float(settings['time_budget'] or 0) or None
+        }
+
+    def get_batch_size (self, interpreter):
+        """ The number of curies the service accepts per question node, from batch_size in its schema config. """
+        schema = self.get_schema_name (interpreter)
+        if schema is None:
+            return 1
+        return int(self.planner.schema.config["schema"][schema].get ("batch_size", 1))
 
     """
     Decorates a result message
@@ -635,16 +868,25 @@ class SelectStatement(Statement):
                 break
         return schema
 
-    def execute (self, interpreter, context={}):
+    async def execute_async (self, interpreter, context={}, on_response=None):
         """
         Execute all statements in the abstract syntax tree.
         - Generate questions by permuting bound values.
         - Resolve the service name.
         - Execute the questions.
+        Blocking work runs in the event loop's executor so other queries keep going.
+        If given, on_response is called with each service response as it arrives.
+        Responses are merged into the result as they arrive, rather than once all are in.
         """
+        if self.explain == "plan":
+            return self.explained (interpreter, await run_blocking (self.explain_plan, interpreter))
+        started = time.time ()
+        explanation = None
+        if self.explain == "analyze":
+            explanation = await run_blocking (self.explain_plan, interpreter)
         result = None
         if self.service == "/schema":
-            result = self.execute_plan (interpreter)
+            result = await self.execute_plan_async (interpreter)
         else:
             """ We want to find what schema name corresponds to the url we are querying.
             Then we can format the constraints accordingly (e.g. the ICEES schema name is 'icces'). """
@@ -652,11 +894,29 @@ class SelectStatement(Statement):
             self.format_constraints(interpreter)
 
             self.service = self.resolve_backplane_url (self.service, interpreter)
-            questions = self.generate_questions (interpreter)
+            generating = time.time ()
+            nodes, edges, options = await run_blocking (self.prepare_questions, interpreter)
+            metrics = self.metrics = {
+                "questions" : 0,
+                "question_seconds" : time.time () - generating,
+                "http_seconds" : 0,
+                "latency_seconds" : 0,
+                "requests" : 0,
+                "errors" : 0,
+                "bytes" : 0,
+                "answers" : 0,
+                "merge_seconds" : 0,
+                "complete" : False
+            }
+            question_count = reduce (lambda count, concept_nodes: count * len(concept_nodes), nodes, 1)
+            root_question = next (self.iter_questions (nodes, edges, options), None)
+            if root_question is None:
+                raise ServiceInvocationError (f"No values left to query {self.service} with after filtering {self.query}")
 
-            [self.ast.schema.validate_question(question) for question in questions]
+            """ Questions differ only in their curies, so validating one validates them all. """
+            self.ast.schema.validate_question (root_question)
 
-            root_question_graph = questions[0]['question_graph']
+            root_question_graph = copy.deepcopy (root_question['question_graph'])
 
             service = interpreter.context.resolve_arg (self.service)
 
@@ -669,114 +929,353 @@ class SelectStatement(Statement):
             logger.debug (f"Starting queries on service: {service} (asynchronous={interpreter.asynchronous})")
             logger.setLevel (logging.INFO)
             prev = time.time ()
-            # We don't want to flood the service so we cap the maximum number of requests we can make to it.
-            maximumQueryRequests = 50
-            interpreter.context.set('requestErrors',[])
-            if interpreter.asynchronous:
-                maximumParallelRequests = 4
-                responses = async_make_requests ([
-                    {
-                        "method" : "post",
-                        "url" : service,
-                        "json" : q,
-                        "headers" : {
-                            "accept": "application/json"
-                        }
-                    }
-                    for q in questions[:maximumQueryRequests]
-                ],maximumParallelRequests)
-                errors = responses["errors"]
-                responses = responses["responses"]
-                interpreter.context.mem.get('requestErrors', []).extend(errors)
+            """ Stream every question through a window of requests in flight, stopping early if a budget runs out. """
+            settings = self.fanout_settings (interpreter)
+            answer_budget = settings['answer_budget']
+            progress = {
+                "service" : service,
+                "question_order" : self.query.order,
+                "questions" : question_count,
+                "done" : 0,
+                "answers" : 0,
+                "complete" : False
+            }
+            if interpreter.context.mem.get ('progress') is None:
+                interpreter.context.set ('progress', [])
+            interpreter.context.mem['progress'].append (progress)
+            decoration = { "schema" : self.get_schema_name(interpreter) }
+            merger = self.merge_accumulator (interpreter, root_question_graph, self.query.order)
+
+            def received (response):
+                progress['done'] += 1
+                progress['answers'] += len(response.get('knowledge_map', []))
+                if progress['done'] % settings['question_window'] == 0 or progress['done'] == progress['questions']:
+                    logger.info (f"{service}: {progress['done']}/{progress['questions']} questions, " +
+                                 f"{progress['answers']} answers")
+                if on_response is not None:
+                    on_response (response)
+                folding.put_nowait (response)
+
+            def fold (response):
+                response['question_order'] = self.query.order
+                self.decorate_result (response, decoration)
+                merger.add (response)
 
-            else:
-                responses = []
-                for index, q in enumerate(questions):
-                    logger.debug (f"executing question {json.dumps(q, indent=2)}")
-                    response = self.request (service, q)
-                    # TODO - add a parameter to limit service invocations.
-                    # Until we parallelize requests, cap the max number we attempt for performance reasons.
-                    #logger.debug (f"response: {json.dumps(response, indent=2)}")
-                    responses.append (response)
-
-                    if index >= maximumQueryRequests:
+            async def fold_all ():
+                """
+                Merge responses in the executor, in the order they arrive, while the rest are still
+                in flight. Each can be let go once merged.
+                """
+                while True:
+                    response = await folding.get ()
+                    if response is None:
                         break
+                    merging = time.time ()
+                    await run_blocking (fold, response)
+                    metrics['merge_seconds'] += time.time () - merging
+
+            folding = asyncio.Queue ()
+            folder = asyncio.ensure_future (fold_all ())
+
+            def exhausted ():
+                return answer_budget is not None and progress['answers'] >= answer_budget
+
+            if interpreter.context.mem.get ('requestErrors') is None:
+                interpreter.context.set ('requestErrors', [])
+            try:
+                if interpreter.asynchronous:
+                    """ Parallelism is also bounded per host by the CONCURRENCY settings in conf.yml. """
+                    loop = asyncio.get_event_loop ()
+                    deadline = None if settings['time_budget'] is None else loop.time () + settings['time_budget']
+                    streamed = await stream_requests_async ((
+                        {
+                            "method" : "post",
+                            "url" : service,
+                            "json" : q,
+                            "headers" : {
+                                "accept": "application/json"
+                            }
+                        }
+                        for q in self.timed (self.iter_questions (nodes, edges, options), metrics)
+                    ), window=settings['question_window'], on_response=received, stop=exhausted, deadline=deadline,
+                       keep_responses=False)
+                    metrics['bytes'] = streamed["bytes"]
+                    errors = streamed["errors"]
+                    progress['complete'] = streamed["complete"]
+                    requests_sent, latency = len(streamed["latencies"]), sum (streamed["latencies"])
+                    failures = requests_sent - progress['done']
+                    interpreter.context.mem.get('requestErrors', []).extend(errors)
+
+                else:
+                    deadline = None if settings['time_budget'] is None else time.time () + settings['time_budget']
+                    requests_sent, failures, latency = 0, 0, 0
+                    for q in self.timed (self.iter_questions (nodes, edges, options), metrics):
+                        if exhausted () or (deadline is not None and time.time () > deadline):
+                            break
+                        logger.debug (f"executing question {json.dumps(q, indent=2)}")
+                        sent = time.time ()
+                        response = await run_blocking (self.request, service, q, metrics)
+                        latency += time.time () - sent
+                        requests_sent += 1
+                        #logger.debug (f"response: {json.dumps(response, indent=2)}")
+                        if response:
+                            received (response)
+                        else:
+                            """ Failed requests return nothing; like the asynchronous path, only count them. """
+                            failures += 1
+                    else:
+                        progress['complete'] = True
+            except BaseException:
+                folder.cancel ()
+                raise
+            folding.put_nowait (None)
+            self.record_statistics (interpreter, nodes, requests_sent, failures, latency, progress['answers'])
+            metrics.update ({
+                "questions" : question_count,
+                "http_seconds" : time.time () - prev,
+                "latency_seconds" : latency,
+                "requests" : requests_sent,
+                "errors" : failures,
+                "answers" : progress['answers'],
+                "complete" : progress['complete']
+            })
+            if not progress['complete']:
+                logger.info (f"{service}: stopped after {progress['done']}/{progress['questions']} questions " +
+                             f"with {progress['answers']} answers (budget {answer_budget} answers, " +
+                             f"{settings['time_budget']} s)")
 
             logger.info (f"Making requests to {service} took {time.time()-prev} s (asynchronous = {interpreter.asynchronous})")
-            total_results = reduce(lambda x, y: x + len(y.get('knowledge_map',[])), responses, 0)
-            logger.info(f"Got {total_results} results from {service}. for {self.query.order} ")
-            for response in responses:
-                response['question_order'] = self.query.order
+            logger.info(f"Got {progress['answers']} results from {service}. for {self.query.order} ")
 
-            if len(responses) == 0:
+            if progress['done'] == 0:
                 interpreter.context.mem.get('requestErrors',[]).append(ServiceInvocationError(
                     f"No valid results from {self.service} with query {self.query}"
                 ))
-            else:
-                self.decorate_results(responses, {
-                    "schema" : self.get_schema_name(interpreter)
-                })
-            result = self.merge_results (responses, interpreter, root_question_graph, self.query.order)
+            await folder
+            merging = time.time ()
+            result = await run_blocking (merger.snapshot)
+            metrics['merge_seconds'] += time.time () - merging
         interpreter.context.set('result', result)
         """ Execute set statements associated with this statement. """
         for set_statement in self.set_statements:
             logger.debug (f"{set_statement}")
-            set_statement.execute (interpreter, context = { "result" : result })
+            await set_statement.execute_async (interpreter, context = { "result" : result })
+        if self.explain == "analyze":
+            """ Analyzed statements still set their variables; their result is the explanation. """
+            return self.explained (interpreter, self.explain_analysis (explanation, result, time.time () - started))
         return result
 
     def execute_plan (self, interpreter):
-        """ Execute a query using a schema based query planning strategy. """
+        """ Execute a query using a schema based query planning strategy, waiting for the result. """
+        return event_loop.run (self.execute_plan_async (interpreter))
+
+    async def execute_plan_async (self, interpreter):
+        """
+        Execute a query using a schema based query planning strategy.
+        Segments run as a dependency graph: alternatives for the same hop run together, and a
+        segment starts as soon as the segments it takes bindings from have finished.
+        """
         self.service = ''
-        plan = self.planner.plan (self.query)
-        statements = self.plan (plan)
-        responses = []
-        duplicate_statements = []
-        first_concept = None
+        statements = self.planned
+        if statements is None:
+            plan = self.planner.plan (self.query)
+            statements = self.plan (plan)
 
         # Generate the root statement's question graph
-        root_question_graph = self.generate_questions(interpreter)[0]['question_graph']
+        nodes, edges, options = await run_blocking (self.prepare_questions, interpreter)
+        root_question_graph = copy.deepcopy (next (self.iter_questions (nodes, edges, options))['question_graph'])
+
+        for statement in statements:
+            statement.isolate ()
+        groups = self.schedule (statements)
+        responses = [ None ] * len(statements)
+        """ What each segment did, per execution of it, and how many curies were handed to it. """
+        self.metrics = {
+            "segments" : [ [] for statement in statements ],
+            "handoffs" : [ None ] * len(statements),
+            "merge_seconds" : 0
+        }
 
-        for index, statement in enumerate(statements):
+        async def execute_segment (index, statement):
             logger.debug (f" -- {statement.query}")
-            response = statement.execute (interpreter)
+            response = await statement.execute_async (interpreter)
             response['question_order'] = statement.query.order
             response['service'] = statement.get_schema_name(interpreter)
-            responses.append (response)
-            duplicate_statements.append (response)
-            if index < len(statements) - 1:
-                """ Implement handoff. Finds the type name of the first element of the
-                next plan segment, looks up values for that type from the answer bindings of the
-                last response, and transfers values to the new question. TODO: incorporate
-                user specified namnes. """
-                next_statement = statements[index+1]
-                if statements[index].query.order == next_statement.query.order:
-                    name = next_statement.query.order[0]
-                    first_concept = next_statement.query.concepts[name]
-                    first_concept.set_nodes (statements[index].query.concepts[name].nodes)
-                else:
-                    name = [name for name in statements[index].query.order if name in next_statement.query.order][0]
-                    first_concept = next_statement.query.concepts[name]
-                    values = self.jsonkit.select(f"$.knowledge_map.[*].[*].node_bindings.{name}",
-                                                  self.merge_results(duplicate_statements,
-                                                                     interpreter,
-                                                                     root_question_graph,
-                                                                     statements[index].query.order)
-                                                  )
-                    tried_kps = list(map(lambda x: x['service'], duplicate_statements))
-                    if len(values) == 0:
+            self.metrics['segments'][index].append (statement.metrics)
+            return response
+
+        async def execute_group (group):
+            if group['depends'] is not None:
+                """ Implement handoff. Look up values for the shared concept in the merged
+                answers of the segments this one depends on and bind them to its questions. """
+                await tasks[group['depends']]
+                source = groups[group['depends']]['members']
+                name = group['name']
+                merging = time.time ()
+                merged = await run_blocking (self.merge_results,
+                                             [ responses[i] for i in source ],
+                                             interpreter,
+                                             root_question_graph,
+                                             statements[source[0]].query.order)
+                values = self.jsonkit.select(f"$.knowledge_map.[*].[*].node_bindings.{name}", merged)
+                if len(values) == 0:
+                    tried_kps = [ responses[i]['service'] for i in source ]
+                    message = f"No valid results from service { ','.join(tried_kps) } executing " + \
+                              f"query {statements[source[-1]].query}. Unable to continue query. Exiting."
+                    raise ServiceInvocationError (
+                        message = message,
+                        details = Text.short (obj=f"{json.dumps(responses[source[-1]], indent=2)}", limit=1000))
+                for i in group['members']:
+                    statements[i].query.concepts[name].set_nodes (values)
+                    self.metrics['handoffs'][i] = { "concept" : name, "curies" : len(values), "merge_seconds" : time.time () - merging }
+            results = await asyncio.gather (*[ execute_segment (i, statements[i]) for i in group['members'] ])
+            for i, response in zip (group['members'], results):
+                responses[i] = response
+
+        if interpreter.streaming_handoff:
+            responses = await self.execute_pipelined (interpreter, statements, groups)
+        else:
+            tasks = [ asyncio.ensure_future (execute_group (group)) for group in groups ]
+            try:
+                await asyncio.gather (*tasks)
+            except Exception:
+                for task in tasks:
+                    task.cancel ()
+                raise
+        merging = time.time ()
+        merged = await run_blocking (self.merge_results, responses, interpreter, root_question_graph, self.query.order)
+        self.metrics['merge_seconds'] = time.time () - merging
+        return merged
+
+    async def execute_pipelined (self, interpreter, statements, groups):
+        """
+        Execute scheduled segments with streaming handoff. Bindings for a shared concept are
+        passed downstream as each upstream response arrives, instead of after the upstream group
+        has finished and been merged. Downstream segments query new values in windows of
+        interpreter.handoff_window curies, and query each curie once.
+        Returns the responses of every window, in plan order.
+        """
+        window_size = max (1, int(interpreter.handoff_window))
+        channels = [ asyncio.Queue () for group in groups ]
+        dependents = [ [ d for d, other in enumerate (groups) if other['depends'] == index ]
+                       for index in range(len(groups)) ]
+        responses = [ [] for statement in statements ]
+
+        def emitter (index):
+            def emit (response):
+                for d in dependents[index]:
+                    values = self.handoff_values (response, groups[d]['name'])
+                    if len(values) > 0:
+                        channels[d].put_nowait (values)
+            return emit
+
+        async def execute_segment (index, statement, emit):
+            logger.debug (f" -- {statement.query}")
+            response = await statement.execute_async (interpreter, on_response=emit)
+            response['question_order'] = statement.query.order
+            response['service'] = statement.get_schema_name(interpreter)
+            responses[index].append (response)
+            self.metrics['segments'][index].append (statement.metrics)
+
+        async def execute_group (index, group):
+            emit = emitter (index)
+            if group['depends'] is None:
+                await asyncio.gather (*[ execute_segment (i, statements[i], emit) for i in group['members'] ])
+            else:
+                name = group['name']
+                seen = set ()
+                window = []
+                windows = []
+                def dispatch (values):
+                    for i in group['members']:
+                        statement = statements[i].fork ()
+                        statement.query.concepts[name].set_nodes (values)
+                        windows.append (asyncio.ensure_future (execute_segment (i, statement, emit)))
+                try:
+                    while True:
+                        values = await channels[index].get ()
+                        if values is None:
+                            break
+                        for value in values:
+                            if value not in seen:
+                                seen.add (value)
+                                window.append (value)
+                        while len(window) >= window_size:
+                            dispatch (window[:window_size])
+                            window = window[window_size:]
+                    if len(window) > 0:
+                        dispatch (window)
+                    for i in group['members']:
+                        self.metrics['handoffs'][i] = { "concept" : name, "curies" : len(seen) }
+                    if len(seen) == 0:
+                        source = groups[group['depends']]['members']
+                        tried_kps = [ statements[i].get_schema_name(interpreter) for i in source ]
                         message = f"No valid results from service { ','.join(tried_kps) } executing " + \
-                                  f"query {statement.query}. Unable to continue query. Exiting."
+                                  f"query {statements[source[-1]].query}. Unable to continue query. Exiting."
+                        details = responses[source[-1]][-1] if len(responses[source[-1]]) > 0 else {}
                         raise ServiceInvocationError (
                             message = message,
-                            details = Text.short (obj=f"{json.dumps(response, indent=2)}", limit=1000))
-                    duplicate_statements = []
-                    first_concept.set_nodes(values)
-        merged = self.merge_results (responses, interpreter, root_question_graph, self.query.order)
-        return merged
+                            details = Text.short (obj=f"{json.dumps(details, indent=2)}", limit=1000))
+                    await asyncio.gather (*windows)
+                except BaseException:
+                    for task in windows:
+                        task.cancel ()
+                    raise
+            """ End of stream for the groups that take bindings from this one. """
+            for d in dependents[index]:
+                channels[d].put_nowait (None)
+
+        tasks = [ asyncio.ensure_future (execute_group (index, group)) for index, group in enumerate (groups) ]
+        try:
+            await asyncio.gather (*tasks)
+        except Exception:
+            for task in tasks:
+                task.cancel ()
+            raise
+        return [ response for segment in responses for response in segment ]
 
     @staticmethod
-    def merge_results (responses, interpreter, question_graph, root_order=None):
-        """ Merge results. """
+    def handoff_values (response, name):
+        """ The curies a single service response binds to the concept name. """
+        values = []
+        for answer in response.get ('knowledge_map', []):
+            value = answer.get ('node_bindings', {}).get (name, None)
+            if isinstance (value, list):
+                values.extend (value)
+            elif value:
+                values.append (value)
+        return values
+
+    @staticmethod
+    def schedule (statements):
+        """
+        Group plan segments into a dependency graph. Consecutive segments with the same
+        concept order answer the same hop from different sources, so they form one group.
+        A group depends on the latest earlier group it shares a concept with, unless the
+        query already binds that concept.
+        """
+        groups = []
+        for index, statement in enumerate (statements):
+            if len(groups) > 0 and statements[groups[-1]['members'][0]].query.order == statement.query.order:
+                groups[-1]['members'].append (index)
+                continue
+            group = { "members" : [ index ], "depends" : None, "name" : None }
+            for previous in reversed (range (len(groups))):
+                order = statements[groups[previous]['members'][0]].query.order
+                shared = [ name for name in order if name in statement.query.order ]
+                if len(shared) > 0:
+                    group['name'] = shared[0]
+                    concept = statement.query.concepts[shared[0]]
+                    bound = any (node.get ('curie') if isinstance(node, dict) else node for node in concept.nodes)
+                    if not bound:
+                        group['depends'] = previous
+                    break
+            groups.append (group)
+        return groups
+
+    @staticmethod
+    def merge_accumulator (interpreter, question_graph, root_order=None):
+        """ Create a MergeAccumulator to merge responses into as they arrive. """
 
         """
         If True, SelectStatement::resolve_name (and therefore the Bionames API) will be called on every node that does not already possess the `equivalent_identifiers` property.
@@ -785,239 +1284,38 @@ class SelectStatement(Statement):
         RESOLVE_EQUIVALENT_IDENTIFIERS = interpreter.resolve_names
         """
         If True, all nodes that have identical names will be assumed to be identical nodes and will consequently be merged together.
+        Note: this infers that if a node has the same `name` property as another, then it be the other. If this ever becomes untrue, it needs to be updated.
         """
         NAME_BASED_MERGING = interpreter.name_based_merging
 
-        # result = responses[0] if len(responses) > 0 else None
-        result = {
-                "knowledge_graph": {
-                    "nodes": [],
-                    "edges": []
-                },
-                "knowledge_map": [],
-                "question_graph": question_graph
-        }
-        # if not 'knowledge_graph' in result:
-        #     message = "Malformed response does not contain knowledge_graph element."
-        #     logger.error (f"{message} svce: {service}: {json.dumps(result, indent=2)}")
-        #     raise MalformedResponseError (message)
-        kg = result['knowledge_graph']
-        #answers = result['answers']
-        answers = result['knowledge_map']
-
-        node_map = {}
-
-        replace_edge_ids = []
-        if RESOLVE_EQUIVALENT_IDENTIFIERS:
-            logger.info ('Starting to fetch equivalent identifiers')
-        total_requests = 0
-        prev_time = time.time()
-        """
-        Fetch/create equivalent identifiers for all nodes in the responses.
-
-        Convert the type property on all nodes and edges to a list if it is not already one.
         """
-        for response in responses:
-            if 'knowledge_graph' in response:
-                nodes = response['knowledge_graph'].get('nodes',[])
-                edges = response['knowledge_graph'].get('edges',[])
-                for node in nodes:
-                    """
-                    Convert the `type` property of all nodes into a list. Create it if they do not already have it.
-                    """
-                    if 'type' not in node:
-                        node['type'] = []
-                    if (not isinstance(node['type'],list)):
-                        node['type'] = [node['type']]
-
-                    """
-                    Create the `equivalent_identifiers` property on all nodes that do not already have it.
-                    """
-                    if 'equivalent_identifiers' not in node:
-                        ids = [node['id']]
-                        if RESOLVE_EQUIVALENT_IDENTIFIERS:
-                            ids = SelectStatement.resolve_name (node.get('name',None), node.get('type',''))
-                        node['equivalent_identifiers'] = ids
-                        total_requests += 1
-                    """
-                    Give the node its own identifier inside its equivalent identifiers if it doesn't already have it.
-                    """
-                    # Convert these to arrays.
-                    if isinstance(node['equivalent_identifiers'], str):
-                        if node['equivalent_identifiers'] == 'None':
-                            node['equivalent_identifiers'] = []
-                        else:
-                            node['equivalent_identifiers'] = [node['equivalent_identifiers']]
-
-                    if node['id'] not in node['equivalent_identifiers']:
-                        node['equivalent_identifiers'].append(node['id'])
-
-                for edge in edges:
-                    """
-                    Convert the `type` property of all edges into a list. Create it if they do not already have it.
-                    """
-                    if 'type' not in edge:
-                        edge['type'] = []
-                    if (not isinstance(edge['type'],list)):
-                        edge['type'] = [edge['type']]
-
-        if RESOLVE_EQUIVALENT_IDENTIFIERS:
-            logger.info (f'Finished fetching equivalent identifiers for {total_requests} nodes ({time.time()-prev_time}s).')
-
+        If possible, try to convert all nodes to a single identifier so that we don't end up with multiple separate nodes that are actually the same in the graph.
+        Example: https://i.imgur.com/Z76R1wZ.png. The node on left is called "citric acid," and the node on right is called "anhydrous citric acid."
+        The left node's id is "CHEBI:30769" and the right node's id is "CHEMBL:CHEMBL1261." These identifiers are actually equivalent to each other.
+        Duplicate edges are merged into the winning edge once their nodes are merged, and answers are joined across responses when a snapshot is taken.
         """
-        For instances where multiple nodes have the same name, infer that they are equivalent and give each equivalent identifiers to one another.
-        Note: this infers that if a node has the same `name` property as another, then it be the other. If this ever becomes untrue, it needs to be updated.
-        """
-        if NAME_BASED_MERGING:
-            node_name_map = {}
-            for response in responses:
-                if 'knowledge_graph' in response:
-                    nodes = response['knowledge_graph'].get('nodes',[])
-                    for node in nodes:
-                        """
-                        Add to the node_name_map of duplicate names to nodes
-                        """
-                        name = node.get('name',None)
-                        if name != None:
-                            if name not in node_name_map:
-                                node_name_map[name] = [node]
-                            else:
-                                node_name_map[name].append(node)
-
-            for i in node_name_map:
-                """
-                Assign every node the equivalent_identifiers property of all other nodes with the same name
-                """
-                nodes = node_name_map[i]
-                all_equivalent_identifiers = []
-                [all_equivalent_identifiers.extend(node['equivalent_identifiers']) for node in nodes]
-                # Filter out all duplicates
-                all_equivalent_identifiers = list(set(all_equivalent_identifiers))
-                for node in nodes:
-                    node['equivalent_identifiers'] = all_equivalent_identifiers
-        # Uses more space but less cpu
-        # Using a reverse lookup for equivalent to map
-        eq_ids_to_node_ids_map = {}
-        for r in responses:
-            for nodes in r['knowledge_graph']['nodes']:
-                for i in nodes['equivalent_identifiers']:
-                    if i not in eq_ids_to_node_ids_map:
-                        eq_ids_to_node_ids_map[i] = nodes['id']
+        return MergeAccumulator (
+            question_graph = question_graph,
+            root_order = root_order,
+            name_based_merging = NAME_BASED_MERGING,
+            resolve_name = SelectStatement.resolve_name if RESOLVE_EQUIVALENT_IDENTIFIERS else None,
+            score_policy = interpreter.score_policy)
 
-
-        for response in responses:
-            #logger.error (f"   -- Response message: {json.dumps(result, indent=2)}")
-            # TODO: Preserve reasoner provenance. This treats nodes as equal if
-            # their ids are equal. Consider merging provenance/properties.
-            # Edges, we may keep distinct and whole or merge to some tbd extent.
-            if 'knowledge_graph' in response:
-                rkg = response['knowledge_graph']
-                #result['answers'] += response['answers']
-                [kg['edges'].append(e) for e in rkg.get('edges',[])]
-                # qg = response.get('question_graph',{})
-                # result['question_graph']['nodes'].extend(qg.get('nodes',[]))
-                # result['question_graph']['edges'].extend(qg.get('edges',[]))
-                other_nodes = rkg['nodes'] if 'nodes' in rkg else []
-                for n in other_nodes:
-                    """
-                    If possible, try to convert all nodes to a single identifier so that we don't end up with multiple separate nodes that are actually the same in the graph.
-                    Example: https://i.imgur.com/Z76R1wZ.png. The node on left is called "citric acid," and the node on right is called "anhydrous citric acid."
-                    The left node's id is "CHEBI:30769" and the right node's id is "CHEMBL:CHEMBL1261." These identifiers are actually equivalent to each other.
-                    """
-                    ids = n['equivalent_identifiers']
-                    exists = False
-                    for id in ids:
-                        if id in eq_ids_to_node_ids_map:
-                            main_id = eq_ids_to_node_ids_map[id]
-                            node = node_map.get(main_id, None)
-                            if node:
-                                exists = True
-                        if exists:
-                            replace_edge_ids.append([n["id"], node["id"]])
-                            # Ensure that both nodes' properties are represented in the new node.
-                            light_merge(node,n)
-                            light_merge(n,node)
-                            break
-                    if not exists:
-                        node_map[n['id']] = n
-                        kg['nodes'].append (n)
-        # We need to update the edges' ids if we changed any node ids.
-        for old_id, new_id in replace_edge_ids:
-            for edge in result['knowledge_graph'].get('edges',[]):
-                if old_id == edge['source_id']:
-                    edge['source_id'] = new_id
-                if old_id == edge['target_id']:
-                    edge['target_id'] = new_id
-            # We also need to replace these old identifiers within the knowledge map or bad things will happen.
-            for response in responses:
-                old_id_as_list = [old_id] if isinstance(old_id, str) else old_id
-                new_id_as_list = [new_id] if isinstance(new_id, str) else new_id
-                for answer in response['knowledge_map']:
-                    node_bindings = answer.get('node_bindings',{})
-
-                    for concept in node_bindings:
-                        identifier = node_bindings[concept]
-                        # convert identifier to list
-                        identifier = [identifier] if isinstance(identifier, str) else identifier
-                        if identifier == old_id_as_list:
-                            identifier = new_id_as_list
-                        node_bindings[concept] = identifier
-                    answer['node_bindings'] = node_bindings
-
-
-        # Kill all duplicate edges. Merge them into the winning edge.
-        # This has to occur after edge ids are replaced so that we can more succesfully detect duplicate edges, since nodes will have been merged into one another.
-        merged_edges = {}
-        killed_edges = []
+    @staticmethod
+    def merge_results (responses, interpreter, question_graph, root_order=None):
+        """ Merge results. """
+        merger = SelectStatement.merge_accumulator (interpreter, question_graph, root_order)
+        if interpreter.resolve_names:
+            logger.info ('Starting to fetch equivalent identifiers')
+        prev_time = time.time()
         for response in responses:
-            if 'knowledge_graph' in response:
-                rkg = response['knowledge_graph']
-                other_edges = rkg['edges'] if 'edges' in rkg else []
-                for e in other_edges:
-                    exists = False
-                    e_type = e.get('type',None)
-                    edge_key = '#'.join(sorted(e_type)) + e['source_id'] + e['target_id']
-                    if edge_key in merged_edges:
-                        exists = True
-                        edge = merged_edges[edge_key]
-                    if exists:
-                        id_1, id_2 = edge['id'], e['id']
-                        light_merge(edge,e)
-                        light_merge(e,edge)
-                        killed_edges.append ([id_2, id_1])
-                    else:
-                        merged_edges[edge_key] = e
-
-        # For each killed edge, go through the knowledge_map and replace the dead edge's id with the new edge's id.
-        for old_edge_id, new_edge_id in killed_edges:
-            for response in responses:
-                for answer in response['knowledge_map']:
-                    edge_bindings = answer.get('edge_bindings',{})
-                    delete = False
-                    for concept in edge_bindings:
-                        if isinstance(edge_bindings[concept], list):
-                            identifiers = []
-                            for identifier in edge_bindings[concept]:
-                                if identifier == old_edge_id:
-                                    identifier = new_edge_id
-                                identifiers.append(identifier)
-                            edge_bindings[concept] = identifiers
-                        else:
-                            identifier = edge_bindings[concept]
-                            if identifier == old_edge_id:
-                                identifier = new_edge_id
-                            edge_bindings[concept] = identifier
-
-        kg['edges'] = [merged_edges[edge_key] for edge_key in merged_edges]
-
-
-        result['knowledge_map'] = SelectStatement.connect_knowledge_maps(responses, root_order)
-
-
-        return result
+            merger.add (response)
+        if interpreter.resolve_names:
+            logger.info (f'Finished fetching equivalent identifiers ({time.time()-prev_time}s).')
+        return merger.snapshot ()
 
     @staticmethod
-    def connect_knowledge_maps(responses, root_order):
+    def connect_knowledge_maps(responses, root_order, score_policy='last'):
         # Now that all the merging in the knowledge graph is completed, the answers in the knowledge maps must be merged.
         # We need to connect answers from each response together with answers from every other response.
         # For example, given the query `select population_of_individual_organisms->disease->gene`, which is split
@@ -1025,7 +1323,7 @@ class SelectStatement(Statement):
         # an answer with `population_of_individual_organisms : "COHORT:X" -> disease : "MONDO:Y"``
         # must be connected to another answer with `disease : "MONDO:Y" -> gene : "HGNC:Z"` in order to form a complete answer.
         # We need the entire path of a query in each answer.
-        return connect_knowledge_maps(responses, root_order)
+        return connect_knowledge_maps(responses, root_order, score_policy)
 
 
 class TranQL_AST:
@@ -1037,6 +1335,8 @@ class TranQL_AST:
         self.schema = schema
         self.statements = []
         self.parse_tree = parse_tree
+        """ Programs calling user defined functions are evaluated at parse time and can't be reused. """
+        self.cacheable = True
         logger.debug (f"{json.dumps(self.parse_tree, indent=2)}")
         for index, element in enumerate(self.parse_tree):
             if isinstance (element, list):
@@ -1051,6 +1351,9 @@ class TranQL_AST:
                     command = statement[0]
                     if command == 'select':
                         self.parse_select (element)
+                    elif command == 'explain':
+                        self.parse_select (element)
+                        self.statements[-1].explain = "analyze" if "analyze" in statement else "plan"
                     elif command == 'create':
                         self.parse_create (element)
 
@@ -1091,6 +1394,7 @@ class TranQL_AST:
                             var, op, val = condition
                             if isinstance(val, dict):
                                 val = custom_functions.resolve_function(val)
+                                self.cacheable = False
                             select.where.append ([var, op, val])
 
                             if var in select.query:
@@ -1120,6 +1424,33 @@ class TranQL_AST:
                             SetStatement (variable=element[0]))
         self.statements.append (select)
 
+    def plan (self):
+        """ Plan select statements against the schema ahead of execution. """
+        for statement in self.statements:
+            if isinstance(statement, SelectStatement) and statement.service == "/schema":
+                statement.planned = statement.plan (statement.planner.plan (statement.query))
+
+    def dependencies (self):
+        """
+        For each statement, the earlier statements it has to wait for: those setting a variable
+        it reads, reading a variable it sets, or setting a variable it sets too. Statements
+        that share no variables can run concurrently.
+        """
+        reads = [ statement.reads () for statement in self.statements ]
+        writes = [ statement.writes () for statement in self.statements ]
+        return [
+            [ earlier for earlier in range(index)
+              if writes[earlier] & (reads[index] | writes[index]) or reads[earlier] & writes[index] ]
+            for index in range(len(self.statements))
+        ]
+
+    def clone (self):
+        """ Copy this program for a single execution. The schema and parse tree are shared. """
+        return copy.deepcopy (self, {
+            id(self.schema) : self.schema,
+            id(self.parse_tree) : self.parse_tree
+        })
+
     def is_command (self, e):
         """ Is this structured like a command? """
         return isinstance(e, list) and len(e) > 0
@@ -1216,12 +1547,20 @@ class QueryPlan:
                     [ source, predicate, target ]
                 ]])
 
+planner_config = Config ("conf.yml").get ('PLANNER', None)
+
 class QueryPlanStrategy:
     """ A strategy for developing a query plan given a schema. """
 
-    def __init__(self, schema):
-        """ Construct a query strategy, specifying the schema. """
+    """ The most transitions to bridge a pair of types no reasoner connects directly. """
+    max_path_hops = int(planner_config.get ('MAX_PATH_HOPS', 3)) if planner_config is not None else 3
+
+    def __init__(self, schema, statistics=None, max_path_hops=None):
+        """ Construct a query strategy, specifying the schema and observed KP statistics. """
         self.schema = schema
+        self.statistics = statistics if statistics is not None else kp_statistics
+        if max_path_hops is not None:
+            self.max_path_hops = max_path_hops
 
     def plan (self, query):
         """
@@ -1254,51 +1593,53 @@ class QueryPlanStrategy:
         if predicate.direction == Query.back_arrow:
             source_type, target_type = target_type, source_type
 
-        for schema_name, sub_schema_package in self.schema.schema.items ():
-            """ Look for a path satisfying this edge in each schema. """
-            sub_schema = sub_schema_package ['schema']
-            sub_schema_url = sub_schema_package ['url']
-
-            if source_type in sub_schema:
-                logger.debug (f"  --{schema_name} - {source_type} => {target_type}")
-                if target_type in sub_schema[source_type]:
-                    """ Matching path. Write it to the plan. """
-                    top_schema = None
-                    if len(plan) > 0:
-                        top = plan[-1]
-                        top_schema = top[0]
-                    if top_schema == schema_name:
-                        # this is the next edge in an ongoing segment.
-                        top[2].append ([ source, predicate, target ])
-                    else:
-                        plan.append ([ schema_name, sub_schema_url, [
-                            [ source, predicate, target ]
-                        ]])
-                    converted = True
+        transitions = self.schema.transitions
+        logger.debug (f"  --{source_type} => {target_type}")
+        candidates = [ (schema_name, url) for schema_name, url, predicates in transitions.sources (source_type, target_type) ]
+        conversions = []
+        for schema_name, sub_schema_url, conv_type in transitions.conversions (source_type, target_type):
+            """ No explicit matching plan for this edge in this schema, but an implicit conversion makes it work. """
+            logger.debug (f"  --impconv: {schema_name} - {conv_type} => {target_type}")
+            implicit_conversion_schema = "implicit_conversion"
+            implicit_conversion_url = self.schema.schema[implicit_conversion_schema]['url']
+            conversions.append ([
+                implicit_conversion_schema,
+                implicit_conversion_url, [
+                    [ source, predicate, Concept(name=conv_type,
+                                                 type_name=conv_type,
+                                                 include_patterns=target.include_patterns,
+                                                 exclude_patterns=target.exclude_patterns) ]
+                ]])
+            conversions.append ([ schema_name, sub_schema_url, [
+                [ Concept(name=conv_type,
+                          type_name=conv_type,
+                          include_patterns=source.include_patterns,
+                          exclude_patterns=source.exclude_patterns), predicate, target ]
+            ]])
+
+        for schema_name, sub_schema_url in self.rank (candidates, source_type, predicate.predicate, target_type):
+            """ Write matching paths to the plan, cheapest first. """
+            top_schema = None
+            if len(plan) > 0:
+                top = plan[-1]
+                top_schema = top[0]
+            if top_schema == schema_name:
+                # this is the next edge in an ongoing segment.
+                top[2].append ([ source, predicate, target ])
             else:
-                """ No explicit matching plan for this edge. Do implicit conversions make it work? """
-                implicit_conversion = BiolinkModelWalker ()
-                for conv_type in implicit_conversion.get_transitions (source_type):
-                    implicit_conversion_schema = "implicit_conversion"
-                    implicit_conversion_url = self.schema.schema[implicit_conversion_schema]['url']
-                    if conv_type in sub_schema:
-                        logger.debug (f"  --impconv: {schema_name} - {conv_type} => {target_type}")
-                        if target_type in sub_schema[conv_type]:
-                            plan.append ([
-                                implicit_conversion_schema,
-                                implicit_conversion_url, [
-                                    [ source, predicate, Concept(name=conv_type,
-                                                                 type_name=conv_type,
-                                                                 include_patterns=target.include_patterns,
-                                                                 exclude_patterns=target.exclude_patterns) ]
-                                ]])
-                            plan.append ([ schema_name, sub_schema_url, [
-                                [ Concept(name=conv_type,
-                                          type_name=conv_type,
-                                          include_patterns=source.include_patterns,
-                                          exclude_patterns=source.exclude_patterns), predicate, target ]
-                            ]])
-                            converted = True
+                plan.append ([ schema_name, sub_schema_url, [
+                    [ source, predicate, target ]
+                ]])
+        plan.extend (conversions)
+        converted = len(candidates) > 0 or len(conversions) > 0
+        if not converted and predicate.predicate is None:
+            """ No reasoner connects the types. Bridge them through intermediate types instead. """
+            paths = self.propose_paths (source_type, target_type)
+            if len(paths) > 0:
+                cost, path = paths[0]
+                logger.info (f"Planning {source_type}->{target_type} as {'->'.join (path)}")
+                self.plan_path (plan, source, target, predicate, path)
+                converted = True
         if not converted:
             source_target_predicates = self.explain_predicates (source_type, target_type)
             target_source_predicates = self.explain_predicates (target_type, source_type)
@@ -1313,9 +1654,74 @@ class QueryPlanStrategy:
             #         f"{target_type}->{source_type}: {json.dumps(target_source_predicates, indent=2)} "
             #     ]))
 
+    def propose_paths (self, source_type, target_type, max_hops=None, limit=16):
+        """
+        Paths of intermediate types from source_type to target_type, each transition of
+        which some reasoner answers, as (estimated cost, [ types ]) cheapest first. A path
+        costs the questions each hop asks, multiplied by the answers expected per curie
+        before it.
+        """
+        max_hops = max_hops if max_hops is not None else self.max_path_hops
+        proposals = []
+        for path in self.schema.reachability.paths (source_type, target_type, max_hops, limit=limit):
+            cost = 0
+            curies = 1
+            for s, t in zip (path, path[1:]):
+                sources = [ schema_name for schema_name, url, predicates in self.schema.transitions.sources (s, t) ]
+                if len(sources) == 0:
+                    """ The schema graph links the types, but no reasoner answers the hop. """
+                    break
+                hop = min (sources, key=lambda schema_name: self.statistics.cost (schema_name, s, None, t))
+                cost += curies * self.statistics.cost (hop, s, None, t)
+                fan_out = self.statistics.fan_out (hop, s, None, t)
+                curies *= fan_out if fan_out is not None else 1
+            else:
+                proposals.append ((cost, path))
+        return sorted (proposals, key=lambda proposal: proposal[0])
+
+    def plan_path (self, plan, source, target, predicate, path):
+        """
+        Plan the transition from source to target through the types of path, oriented
+        from the planned source type, as hops between intermediate concepts.
+        """
+        types = path if predicate.direction != Query.back_arrow else list(reversed (path))
+        concepts = [ source ] + [
+            Concept (name=f"{source.name}_{target.name}_{type_name}", type_name=type_name)
+            for type_name in types[1:-1] ] + [ target ]
+        for hop_source, hop_target in zip (concepts, concepts[1:]):
+            self.plan_edge (plan, hop_source, hop_target, Edge (direction=predicate.direction))
+
+    def rank (self, candidates, source_type, predicate, target_type):
+        """
+        Order the (schema_name, url) sources able to answer a transition by estimated cost,
+        leaving out those the statistics show add nothing but latency, unless all of them do.
+        With no statistics the order of the schema is kept.
+        """
+        useful = [ candidate for candidate in candidates
+                   if not self.statistics.useless (candidate[0], source_type, predicate, target_type) ]
+        if len(useful) < len(candidates):
+            logger.info (f"Leaving out {[ c[0] for c in candidates if c not in useful ]} for " +
+                         f"{source_type}-{predicate}->{target_type}: no answers or mostly errors recently.")
+        if len(useful) == 0:
+            useful = candidates
+        return sorted (useful, key=lambda candidate: self.statistics.cost (candidate[0], source_type, predicate, target_type))
+
+    def start_cost (self, segment):
+        """
+        Estimate how expensive a planned segment is to start a query from: the curies it is
+        expected to hand on per input curie, then the cost of asking its questions.
+        """
+        schema_name, url, steps = segment
+        fan_out = 1
+        cost = 0
+        for source, predicate, target in steps:
+            source_type, target_type = source.type_name, target.type_name
+            if predicate.direction == Query.back_arrow:
+                source_type, target_type = target_type, source_type
+            estimate = self.statistics.fan_out (schema_name, source_type, predicate.predicate, target_type)
+            fan_out *= estimate if estimate is not None else 1
+            cost += self.statistics.cost (schema_name, source_type, predicate.predicate, target_type)
+        return (fan_out, cost)
+
     def explain_predicates (self, source_type, target_type):
-        list_of_lists = [
-            sub_schema_package['schema'].get (source_type,{}).get (target_type, [])
-            for schema_name, sub_schema_package in self.schema.schema.items ()
-        ]
-        return [ i for li in list_of_lists for i in li ]
+        return self.schema.transitions.predicates (source_type, target_type)
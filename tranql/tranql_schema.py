@@ -6,7 +6,10 @@ import logging
 import requests
 import requests_cache
 import os
+import itertools
 from tranql.concept import BiolinkModelWalker
+from tranql.util import deep_freeze
+from tranql.request_util import session_registry
 from collections import defaultdict
 from tranql.exception import TranQLException, InvalidTransitionException
 from tranql.redis_graph import RedisGraph
@@ -24,17 +27,12 @@ class NetworkxGraph:
     def has_node (self, identifier):
         return identifier in self.net.nodes
     def get_node (self, identifier, properties=None):
-        nodes = self.net.nodes(data=True)
-        filtered = [i for i in nodes if i[0] == identifier]
-        return filtered[0] if len(filtered) > 0 else None
+        if identifier in self.net.nodes:
+            return (identifier, self.net.nodes[identifier])
+        return None
     def get_edge (self, start, end, properties=None):
-        result = None
-        for e in self.net.edges:
-            #print (f"-----    {start} {end} | {e[0]} {e[2]}")
-            if e[0] == start and e[1] == end:
-                result = e
-                break
-        return result
+        edges = self.net.get_edge_data (start, end)
+        return (start, end, next (iter (edges))) if edges else None
     def get_nodes (self,**kwargs):
         return self.net.nodes(**kwargs)
     def get_edges (self,**kwargs):
@@ -114,7 +112,7 @@ class RegistryAdapter:
             self.base_url = url.rstrip('/')
 
         def __get_registry(self):
-            response = requests.get(self.base_url + '/registry')
+            response = session_registry.http_session ().get(self.base_url + '/registry')
             if response.status_code == 200:
                 return response.json()
             else:
@@ -132,7 +130,7 @@ class RegistryAdapter:
             filtered_registry = filter(lambda x: x not in exclusion_list, registry)
             for path in filtered_registry:
                 graph_schema_path = f'{self.base_url}/{path}/predicates'
-                graph_schema = requests.get(graph_schema_path).json()
+                graph_schema = session_registry.http_session ().get(graph_schema_path).json()
                 # since we have a backplane proxy that is able to query
                 # automat kps in /graph/automat/<path> we will use that pattern as url
                 kp_url = f'/graph/automat/{path}'
@@ -146,10 +144,13 @@ class RegistryAdapter:
 
 class SchemaFactory:
     """
-    Keeps a single SchemaInstance object till next update.
+    Publishes the current Schema snapshot. Snapshots are immutable, so readers
+    share them without copying. The update thread builds a new snapshot and
+    swaps it in; queries already running keep the snapshot they started with.
     """
     _cached = None
     _update_thread = None
+    _lock = threading.Lock ()
 
     def __init__(self, backplane, use_registry, update_interval, create_new=False):
         """
@@ -159,30 +160,198 @@ class SchemaFactory:
         :param use_registry:
         """
 
-        if not SchemaFactory._cached or create_new:
-            SchemaFactory._cached = Schema(backplane, use_registry)
+        with SchemaFactory._lock:
+            if not SchemaFactory._cached or create_new:
+                SchemaFactory._cached = Schema(backplane, use_registry)
 
-        if not SchemaFactory._update_thread:
-            # avoid creating multiple threads.
-            SchemaFactory._update_thread = threading.Thread(
-                target=SchemaFactory.update_cache_loop,
-                args=(backplane, use_registry , update_interval),
-                daemon=True)
-            SchemaFactory._update_thread.start()
+            if not SchemaFactory._update_thread:
+                # avoid creating multiple threads.
+                SchemaFactory._update_thread = threading.Thread(
+                    target=SchemaFactory.update_cache_loop,
+                    args=(backplane, use_registry , update_interval),
+                    daemon=True)
+                SchemaFactory._update_thread.start()
 
     @staticmethod
     def get_instance():
-        return copy.deepcopy(SchemaFactory._cached)
+        return SchemaFactory._cached
+
+    @staticmethod
+    def refresh(backplane, use_registry):
+        """ Build a new snapshot and publish it. """
+        schema = Schema(backplane, use_registry)
+        SchemaFactory._cached = schema
+        return schema
 
     @staticmethod
     def update_cache_loop(backplane, use_registry, update_interval=20*60):
         while True:
-            SchemaFactory._cached = Schema(backplane, use_registry)
             time.sleep(update_interval)
+            SchemaFactory.refresh(backplane, use_registry)
+
+
+class TransitionIndex:
+    """
+    The transitions a schema's reasoners support, compiled once per schema snapshot so
+    planning and validation look them up instead of scanning every sub-schema:
+
+        (source_type, target_type) -> [ (schema_name, url, predicates) ]
+
+    in schema order, and the implicit conversions that make a transition work by first
+    converting the source to a type another reasoner takes:
+
+        (source_type, target_type) -> [ (schema_name, url, conversion_type) ]
+    """
+    def __init__(self, schema, walker=None):
+        walker = walker if walker is not None else BiolinkModelWalker ()
+        self.explicit = defaultdict (list)
+        self.implicit = defaultdict (list)
+        self.edges = set ()
+        source_types = {}
+        for schema_name, sub_schema_package in schema.items ():
+            sub_schema = sub_schema_package['schema']
+            source_types[schema_name] = set (sub_schema.keys ())
+            for source_type, targets in sub_schema.items ():
+                for target_type, predicates in targets.items ():
+                    predicates = ( predicates, ) if isinstance (predicates, str) else tuple (predicates)
+                    self.explicit[(source_type, target_type)].append (
+                        (schema_name, sub_schema_package['url'], predicates))
+                    if len(predicates) > 0:
+                        self.edges.add ((source_type, target_type))
+
+        """ Conversions apply to reasoners that don't take the source type themselves. """
+        order = { schema_name : index for index, schema_name in enumerate (schema.keys ()) }
+        for source_type in walker.concept_map:
+            for conv_type in walker.get_transitions (source_type):
+                for (from_type, target_type), entries in list(self.explicit.items ()):
+                    if from_type != conv_type:
+                        continue
+                    for schema_name, url, predicates in entries:
+                        if source_type not in source_types[schema_name]:
+                            self.implicit[(source_type, target_type)].append ((schema_name, url, conv_type))
+        for entries in self.implicit.values ():
+            entries.sort (key=lambda entry: order[entry[0]])
+
+        self.explicit = dict(self.explicit)
+        self.implicit = dict(self.implicit)
+
+    def sources (self, source_type, target_type):
+        """ The reasoners answering source_type -> target_type directly. """
+        return self.explicit.get ((source_type, target_type), [])
+
+    def conversions (self, source_type, target_type):
+        """ The reasoners answering source_type -> target_type after an implicit conversion. """
+        return self.implicit.get ((source_type, target_type), [])
+
+    def predicates (self, source_type, target_type):
+        """ Every predicate any reasoner offers for source_type -> target_type. """
+        return [ predicate for schema_name, url, predicates in self.sources (source_type, target_type)
+                 for predicate in predicates ]
+
+    def has_edge (self, source_type, target_type):
+        return (source_type, target_type) in self.edges
+
+class ReachabilityIndex:
+    """
+    Shortest hop counts between the types of a schema graph, compiled once per schema
+    snapshot. Lets the planner bridge types no single reasoner connects through
+    intermediate types, and clients offer the types reachable from, or reaching, a type
+    without searching the graph.
+    """
+    def __init__(self, net):
+        self.successors = { t : tuple (sorted (set (net.successors (t)))) for t in net.nodes }
+        predecessors = { t : tuple (sorted (set (net.predecessors (t)))) for t in net.nodes }
+        """ source_type -> { target_type : hops } """
+        self.distance = { t : self.search (t, self.successors) for t in net.nodes }
+        self.reverse_distance = { t : self.search (t, predecessors) for t in net.nodes }
+        self.forward = { t : self.by_hops (d) for t, d in self.distance.items () }
+        self.backward = { t : self.by_hops (d) for t, d in self.reverse_distance.items () }
 
+    @staticmethod
+    def search (start, neighbours):
+        """ Breadth first hop counts from start to every type it reaches. """
+        distance = {}
+        frontier = [ start ]
+        hops = 0
+        while len(frontier) > 0:
+            hops += 1
+            following = []
+            for t in frontier:
+                for n in neighbours[t]:
+                    if n not in distance:
+                        distance[n] = hops
+                        following.append (n)
+            frontier = following
+        return distance
+
+    @staticmethod
+    def by_hops (distance):
+        """
+        Reached types ordered by hop count then name, with where each hop count's run ends
+        so a bounded prefix can be sliced off directly. Breadth first hop counts have no gaps.
+        """
+        reached = tuple (sorted (distance.items (), key=lambda item: (item[1], item[0])))
+        ends = [ 0 ]
+        for index, (t, hops) in enumerate (reached):
+            if hops == len(ends):
+                ends.append (index + 1)
+            else:
+                ends[hops] = index + 1
+        return reached, ends
+
+    @staticmethod
+    def bounded (entry, max_hops):
+        reached, ends = entry
+        if max_hops is None:
+            return reached
+        return reached[:ends[max (0, min (max_hops, len(ends) - 1))]]
+
+    def reachable (self, source_type, max_hops=None):
+        """ (type, hops) pairs reachable from source_type, nearest first. """
+        return self.bounded (self.forward.get (source_type, ((), [ 0 ])), max_hops)
+
+    def reaching (self, target_type, max_hops=None):
+        """ (type, hops) pairs from which target_type is reachable, nearest first. """
+        return self.bounded (self.backward.get (target_type, ((), [ 0 ])), max_hops)
+
+    def hops (self, source_type, target_type):
+        """ The fewest transitions from source_type to target_type, or None. """
+        return self.distance.get (source_type, {}).get (target_type, None)
+
+    def paths (self, source_type, target_type, max_hops, limit=16):
+        """
+        Up to limit simple paths of at most max_hops transitions from source_type to
+        target_type, as lists of types, shortest first.
+        """
+        paths = []
+        shortest = self.hops (source_type, target_type)
+        if shortest is None:
+            return paths
+        def extend (path, remaining):
+            for n in self.successors[path[-1]]:
+                if len(paths) >= limit:
+                    return
+                if n == target_type:
+                    if remaining == 1:
+                        paths.append (path + [ n ])
+                    continue
+                """ Only follow types that can still get to the target in time. """
+                to_target = self.hops (n, target_type)
+                if n in path or to_target is None or to_target > remaining - 1:
+                    continue
+                path.append (n)
+                extend (path, remaining - 1)
+                path.pop ()
+        for length in range(shortest, max_hops + 1):
+            extend ([ source_type ], length)
+        return paths[:limit]
 
 class Schema:
-    """ A schema for a distributed knowledge network. """
+    """
+    A schema for a distributed knowledge network.
+    Once built, a schema is a read-only snapshot identified by its version.
+    """
+    _versions = itertools.count (1)
 
     def __init__(self, backplane, use_registry):
         """
@@ -209,6 +378,10 @@ class Schema:
                     new_schemas = self.registry_adapter.get_schemas(registry_name,
                                                                     backplane + registry_url,
                                                                     exclusion_list)
+                    if 'batch_size' in metadata:
+                        """ KPs behind a registry take the registry's batch size. """
+                        for kp_metadata in new_schemas.values ():
+                            kp_metadata.setdefault ('batch_size', metadata['batch_size'])
                     self.config['schema'].update(new_schemas)
                     # remove registry entry
                 del self.config['schema'][schema_name]
@@ -220,7 +393,7 @@ class Schema:
                 # If schema_data is a URL
                 try:
                     old_s_d = schema_data
-                    response = requests.get (schema_data)
+                    response = session_registry.http_session ().get (schema_data)
                     schema_data = response.json()
                     if 'message' in schema_data:
                         raise Exception(schema_data['message'])
@@ -254,6 +427,15 @@ class Schema:
 
         self.schema_graph.commit ()
 
+        """ Freeze the snapshot. """
+        self.config = deep_freeze (self.config)
+        self.schema = self.config['schema']
+        self.loadErrors = tuple (self.loadErrors)
+        self.transitions = TransitionIndex (self.schema)
+        self.schema_graph.net = nx.freeze (self.schema_graph.net)
+        self.reachability = ReachabilityIndex (self.schema_graph.net)
+        self.version = next (Schema._versions)
+
     def add_layer (self, layer, name=None):
         """
         :param layer: Knowledge schema metadata layers.
@@ -375,8 +557,7 @@ class Schema:
         :param source_type: A source type.
         :param target_type: A target type.
         """
-        edge = self.schema_graph.get_edge (start=source_type, end=target_type)
-        if not edge:
+        if not self.transitions.has_edge (source_type, target_type):
             raise InvalidTransitionException (source_type, target_type, explanation=f'No valid transitions exist between {source_type} and {target_type} in this schema.')
 
     def validate_question (self, message):
@@ -1,17 +1,22 @@
+import argparse
 import copy
 import logging
 import logging.config
 import importlib
 import json
+import mmap
+import struct
 import traceback
 import unittest
 import datetime
 import os
 import re
+import threading
 from collections import Iterable
 from collections import namedtuple
-from tranql.disease_vocab import DiseaseVocab
+from collections.abc import Mapping
 from jinja2 import Template
+from types import MappingProxyType
 import copy
 import yaml
 from jsonpath_rw import parse
@@ -166,15 +171,212 @@ class JSONKit:
         values = [ match.value for match in jsonpath_query.find (graph) ]
         return [ val for val in values if target is None or val[field] in target ]
 
+class VocabularyIndex(Mapping):
+    """
+    A compiled vocabulary: a read-only symbol to curie map backed by a memory
+    mapped file. Lookups binary search a sorted key table in place, so no dict is
+    materialized and worker processes share the pages through the OS page cache.
+
+    Layout (little endian):
+        magic     8 bytes
+        count     uint32
+        length    uint32, length of the sources section
+        sources   names of the source files compiled in, newline separated
+        offsets   (count + 1) x uint32, record offsets relative to the data section
+        data      records of b"symbol\\0curie", sorted by symbol bytes
+    """
+    MAGIC = b"TQLVOC02"
+    HEADER = struct.Struct ("<8sII")
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as stream:
+            self.buf = mmap.mmap (stream.fileno (), 0, access=mmap.ACCESS_READ)
+        magic, self.count, length = self.HEADER.unpack_from (self.buf, 0)
+        if magic != self.MAGIC:
+            raise ValueError (f"{path} is not a vocabulary index.")
+        sources = self.buf[self.HEADER.size:self.HEADER.size + length].decode ("utf-8")
+        self.sources = sources.split ("\n") if sources else []
+        self.offsets = self.HEADER.size + length
+        self.data = self.offsets + (self.count + 1) * 4
+
+    def _offset (self, i):
+        return self.data + struct.unpack_from ("<I", self.buf, self.offsets + i * 4)[0]
+
+    def _record (self, i):
+        start = self._offset (i)
+        end = self._offset (i + 1)
+        split = self.buf.find (b"\0", start, end)
+        return start, split, end
+
+    def _find (self, key):
+        """ Binary search for a symbol, returning its curie or None. """
+        target = key.encode ("utf-8")
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start, split, end = self._record (mid)
+            symbol = self.buf[start:split]
+            if symbol == target:
+                return self.buf[split+1:end].decode ("utf-8")
+            elif symbol < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def __getitem__(self, key):
+        value = self._find (key) if isinstance(key, str) else None
+        if value is None:
+            raise KeyError (key)
+        return value
+
+    def __contains__(self, key):
+        return isinstance(key, str) and self._find (key) is not None
+
+    def __iter__(self):
+        for i in range (self.count):
+            start, split, end = self._record (i)
+            yield self.buf[start:split].decode ("utf-8")
+
+    def __len__(self):
+        return self.count
+
+    @staticmethod
+    def write (symbols, path, sources=()):
+        """ Compile a symbol map into an index file at path, recording the names of the source files. """
+        records = sorted ((k.encode ("utf-8"), v.encode ("utf-8")) for k, v in symbols.items ())
+        names = "\n".join (sorted (os.path.basename (s) for s in sources)).encode ("utf-8")
+        offsets = []
+        position = 0
+        for symbol, curie in records:
+            offsets.append (position)
+            position += len(symbol) + 1 + len(curie)
+        offsets.append (position)
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "wb") as stream:
+            stream.write (VocabularyIndex.HEADER.pack (VocabularyIndex.MAGIC, len(records), len(names)))
+            stream.write (names)
+            stream.write (struct.pack (f"<{len(offsets)}I", *offsets))
+            for symbol, curie in records:
+                stream.write (symbol + b"\0" + curie)
+        os.replace (temp_path, path)
+
+    @staticmethod
+    def is_current (path, sources):
+        """
+        True if the index was compiled from exactly the source files that exist now, and is
+        newer than each of them. An index built before a source was added is stale.
+        """
+        if not os.path.exists (path):
+            return False
+        present = [ s for s in sources if os.path.exists (s) ]
+        try:
+            compiled = VocabularyIndex (path).sources
+        except ValueError:
+            return False
+        if sorted (compiled) != sorted (os.path.basename (s) for s in present):
+            return False
+        built = os.path.getmtime (path)
+        return all (os.path.getmtime (s) <= built for s in present)
+
+class Vocabulary:
+    """
+    Gene and disease symbols mapped to curies. The vocabulary is loaded once per
+    process and published as a read-only mapping shared by every Context. The
+    compiled index is used when it is current; otherwise the sources are parsed.
+    """
+    _instance = None
+    _lock = threading.Lock ()
+
+    conf_path = os.path.join (os.path.dirname (__file__), "conf")
+    index_path = os.environ.get ("TRANQL_VOCABULARY_INDEX",
+                                 os.path.join (conf_path, "vocabulary.idx"))
+    sources = [ os.path.join (conf_path, "genes.txt"),
+                os.path.join (conf_path, "mondo.json"),
+                os.path.join (os.path.dirname (__file__), "disease_vocab.py") ]
+
+    def __init__(self):
+        self.mem = {}
+
+    def set(self, name, val):
+        self.mem[name] = val
+
+    def load_sources (self):
+        """ Parse the gene and disease vocabularies. """
+        generate_gene_vocab (self)
+        try:
+            from tranql.disease_vocab import DiseaseVocab
+            DiseaseVocab (self)
+        except ImportError:
+            if os.path.exists (self.sources[1]):
+                for label, identifier in read_disease_vocab (self.sources[1]):
+                    self.set (label.lower (), identifier)
+            else:
+                logger.warning ("No disease vocabulary found. Run: python -m tranql.util --disease-vocab")
+        return self.mem
+
+    @staticmethod
+    def parse ():
+        """ Build a read-only vocabulary from the source files. """
+        return MappingProxyType (Vocabulary ().load_sources ())
+
+    @staticmethod
+    def load (index_path=None):
+        """ Open the compiled index if it is current, otherwise parse the sources. """
+        index_path = index_path or Vocabulary.index_path
+        if VocabularyIndex.is_current (index_path, Vocabulary.sources):
+            return VocabularyIndex (index_path)
+        logger.info (f"Vocabulary index {index_path} missing or stale; parsing sources. "
+                     "Run: python -m tranql.util --index")
+        return Vocabulary.parse ()
+
+    @staticmethod
+    def compile (index_path=None):
+        """ Compile the vocabulary sources into an index. """
+        index_path = index_path or Vocabulary.index_path
+        sources = [ s for s in Vocabulary.sources if os.path.exists (s) ]
+        VocabularyIndex.write (Vocabulary ().load_sources (), index_path, sources)
+        return index_path
+
+    @staticmethod
+    def get_instance ():
+        """ Get the shared symbol table, loading it on first use. """
+        if Vocabulary._instance is None:
+            with Vocabulary._lock:
+                if Vocabulary._instance is None:
+                    Vocabulary._instance = Vocabulary.load ()
+        return Vocabulary._instance
+
+class ContextMemory(dict):
+    """
+    Per-context variables layered over the shared vocabulary. Reads fall through
+    to the vocabulary; writes stay local, shadowing any vocabulary entry.
+    """
+    def __init__(self, vocabulary):
+        super().__init__ ()
+        self.vocabulary = vocabulary
+
+    def __missing__(self, key):
+        return self.vocabulary[key]
+
+    def __contains__(self, key):
+        return dict.__contains__ (self, key) or key in self.vocabulary
+
+    def get(self, key, default=None):
+        if dict.__contains__ (self, key):
+            return dict.__getitem__ (self, key)
+        return self.vocabulary.get (key, default)
+
+    def all_keys (self):
+        """ Keys of both local variables and the vocabulary. """
+        return set(self.keys ()) | set(self.vocabulary.keys ())
+
 class Context:
     """ A trivial context implementation. """
     def __init__(self):
-        self.mem = {
-        }
+        self.mem = ContextMemory (Vocabulary.get_instance ())
         self.jk = JSONKit ()
-        generate_gene_vocab (self)
-        #generate_disease_vocab (self)
-        DiseaseVocab (self)
 
     '''
     def resolve_arg(self, val):
@@ -336,32 +538,37 @@ def generate_gene_vocab (context):
             if not "~withdrawn" in symbol and not ' ' in symbol:
                 context.set(symbol, identifier)
 
-def generate_disease_vocab (context):
-    file_name = os.path.join (os.path.dirname (__file__), "conf", "mondo.json")
+def read_disease_vocab (file_name):
+    """ Yield (label, identifier) pairs from the MONDO ontology. """
     with open(file_name, "r") as stream:
         ontology = json.load (stream)
-        for graph in ontology['graphs']:
-            for node in graph['nodes']:
-                label = node['lbl'].\
-                        replace (' ', '_').\
-                        replace (',', '').\
-                        replace ('-','_') if 'lbl' in node else None
-                if label:
-                    identifier = node['id'].\
-                                 split ('/')[-1].\
-                                 replace ('_', ':')
-                    #print (f"{label}={identifier}")
-                    context.set (label, identifier)
-        template = Template ("""
+    for graph in ontology['graphs']:
+        for node in graph['nodes']:
+            label = node['lbl'].\
+                    replace (' ', '_').\
+                    replace (',', '').\
+                    replace ('-','_') if 'lbl' in node else None
+            if label:
+                identifier = node['id'].\
+                             split ('/')[-1].\
+                             replace ('_', ':')
+                yield label, identifier
+
+def generate_disease_vocab (context):
+    file_name = os.path.join (os.path.dirname (__file__), "conf", "mondo.json")
+    for label, identifier in read_disease_vocab (file_name):
+        #print (f"{label}={identifier}")
+        context.set (label, identifier)
+    template = Template ("""
 class DiseaseVocab:
    def __init__(self, context):
        context.mem.update ({
            {% for k, v in disease_map.items () %}
            "{{ k.lower() }}" : "{{ v }}"{{ "," if not loop.last }}{% endfor %}
        })""")
-        text = template.render (disease_map=context.mem)
-        with open("disease_vocab.py", "w") as stream:
-            stream.write (text)
+    text = template.render (disease_map=context.mem)
+    with open("disease_vocab.py", "w") as stream:
+        stream.write (text)
 
 # Flatten a list of generic type
 # source: https://stackoverflow.com/a/2158532
@@ -404,6 +611,22 @@ def deep_merge(source, destination, no_list_repeat=True):
 
     return destination
 
+def deep_freeze(obj):
+    """ Return a read-only copy of a structure of dicts and lists. """
+    if isinstance(obj, dict):
+        return MappingProxyType ({ k : deep_freeze (v) for k, v in obj.items () })
+    elif isinstance(obj, (list, tuple)):
+        return tuple (deep_freeze (v) for v in obj)
+    return obj
+
 if __name__ == '__main__':
-    #generate_gene_vocab ()
-    generate_disease_vocab (Context ())
+    arg_parser = argparse.ArgumentParser (description='TranQL vocabulary build')
+    arg_parser.add_argument ('-d', '--disease-vocab', help="Render disease_vocab.py from mondo.json.", action="store_true")
+    arg_parser.add_argument ('-i', '--index', help="Compile the vocabulary index.", action="store_true")
+    arg_parser.add_argument ('-o', '--output', help="Index path.", default=Vocabulary.index_path)
+    args = arg_parser.parse_args ()
+    if args.disease_vocab:
+        #generate_gene_vocab ()
+        generate_disease_vocab (Vocabulary ())
+    if args.index or not args.disease_vocab:
+        print (f"wrote {Vocabulary.compile (args.output)}")
@@ -1,160 +1,451 @@
-from functools import reduce
+from tranql.util import light_merge
 import copy
+import operator
 
 QUESTION_GRAPH_KEY = 'question_graph'
 KNOWLEDGE_GRAPH_KEY = 'knowledge_graph'
 KNOWLEDGE_MAP_KEY = 'knowledge_map'
 
+# How the scores of the answers a merged answer was joined from combine into its score.
+# 'last' keeps the score of the last of them, in response order.
+SCORE_POLICIES = {
+    'last': lambda current, score: score,
+    'max': max,
+    'sum': operator.add,
+    'product': operator.mul
+}
 
-def connect_knowledge_maps(responses, query_order):
-    # each answer is a subset path defined by query_order
-    # task here is
-    # given a->b->c (query_order ) merge a->b from response-1 to b->c in response-2 where b is the same
-    new_knowledge_map = []
+
+class IdentifierClusters:
+    """
+    Union-find over node identifiers. Identifiers listed as equivalent on any node end up in
+    one cluster, however the equivalences are spread across nodes and responses.
+    """
+    def __init__(self):
+        self.parent = {}
+        self.size = {}
+
+    def find(self, identifier):
+        if identifier not in self.parent:
+            self.parent[identifier] = identifier
+            self.size[identifier] = 1
+            return identifier
+        # path halving
+        while self.parent[identifier] != identifier:
+            self.parent[identifier] = self.parent[self.parent[identifier]]
+            identifier = self.parent[identifier]
+        return identifier
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return a
+        if self.size[a] < self.size[b]:
+            a, b = b, a
+        self.parent[b] = a
+        self.size[a] += self.size[b]
+        return a
+
+
+def rewrite_edge_bindings(answer, id_map):
+    """ Replace edge ids in an answer's edge bindings. """
+    edge_bindings = answer.get('edge_bindings', {})
+    for concept in edge_bindings:
+        identifiers = edge_bindings[concept]
+        if isinstance(identifiers, list):
+            edge_bindings[concept] = [id_map.get(identifier, identifier) for identifier in identifiers]
+        else:
+            edge_bindings[concept] = id_map.get(identifiers, identifiers)
+
+
+class EdgeBindingIndex:
+    """
+    Inverted index from edge ids to the answers binding them, so replacing edge ids only
+    touches the answers that reference them.
+    """
+    def __init__(self, knowledge_maps=None):
+        self.answers = {}
+        for knowledge_map in knowledge_maps or []:
+            self.add(knowledge_map)
+
+    def add(self, answers, id_map=None):
+        """ Index answers, first replacing ids in id_map in the bindings of those binding any. """
+        id_map = id_map or {}
+        for answer in answers:
+            edge_bindings = answer.get('edge_bindings', {})
+            if id_map and any(identifier in id_map for identifiers in edge_bindings.values()
+                              for identifier in (identifiers if isinstance(identifiers, list) else [identifiers])):
+                rewrite_edge_bindings(answer, id_map)
+            for identifiers in edge_bindings.values():
+                for identifier in (identifiers if isinstance(identifiers, list) else [identifiers]):
+                    self.answers.setdefault(identifier, []).append(answer)
+
+    def referencing(self, edge_id):
+        """ The answers binding an edge id. """
+        return self.answers.get(edge_id, [])
+
+    def rewrite(self, id_map):
+        """ Replace edge ids in the bindings of the answers referencing them, and re-index those answers. """
+        touched = {}
+        for old_id, new_id in id_map.items():
+            answers = self.answers.pop(old_id, [])
+            for answer in answers:
+                touched[id(answer)] = answer
+            if len(answers) > 0:
+                self.answers.setdefault(new_id, []).extend(answers)
+        for answer in touched.values():
+            rewrite_edge_bindings(answer, id_map)
+
+
+def connect_knowledge_maps(responses, query_order, score_policy='last'):
+    """
+    Join the answers of every response into complete answers. Given a->b from one response and
+    b->c from another, answers are joined on the curies bound to b into a->b->c. Answers are
+    indexed under each node they bind that is the source of a question graph edge, and partial
+    answers are extended by probing that index with their last node, depth first. Answers that
+    no other answer extends or leads into are kept as they are.
+
+    query_order is not used: the question graph edges of the responses decide how answers join.
+    It is still accepted so callers passing the order of the query's concepts keep working.
+    """
     # STEP 1 some prep work , transforming knowledge map from every response,
     # getting the q_graph edges as a map for navigating through out knowledge_map
     # first lets get everything from all the responses into a giant list
 
     # 1.1 When SelectStatement generates question it uses same edge id for the query graph for different parts.
     # which would collisions here.
-
-    all_knowledge_maps = reduce(lambda a, b: a + b,
-                                map(lambda response: response.get(KNOWLEDGE_MAP_KEY, []), responses),
-                                [])
-    q_graph_edges = list(reduce(lambda a, b: a + b, map(lambda r: r[QUESTION_GRAPH_KEY]['edges'], responses), []))
+    all_knowledge_maps = [answer for response in responses for answer in response.get(KNOWLEDGE_MAP_KEY, [])]
     # transform q_graph_edges to
     # source : target : edge
     transformed_q_graph_edges = {}
-    for edge in q_graph_edges:
-        transformed_q_graph_edges[edge['source_id']] = transformed_q_graph_edges.get(edge['source_id'], {})
-        transformed_q_graph_edges[edge['source_id']][edge['target_id']] = transformed_q_graph_edges[edge['source_id']]\
-            .get(edge['target_id'], set())
-        transformed_q_graph_edges[edge['source_id']][edge['target_id']].add(edge['id'])
+    for response in responses:
+        for edge in response[QUESTION_GRAPH_KEY]['edges']:
+            targets = transformed_q_graph_edges.setdefault(edge['source_id'], {})
+            targets.setdefault(edge['target_id'], set()).add(edge['id'])
     # convert node ids into list, collect score aswell
     score_table = {}
     for bindings in all_knowledge_maps:
-        score_key = set()
         nodes = bindings.get('node_bindings', {})
-        edges = bindings.get('edge_bindings', {})
-        score = bindings.get('score', 0)
         # convert nodes to list
         for concept in nodes:
             curie = nodes[concept]
-            curie = curie if isinstance(curie, list) else [curie]
-            nodes[concept] = curie
-            score_key.add(curie[0])
-        for edge_id in edges:
-            score_key.add(edges[edge_id][0])
-        score_key = frozenset(score_key)
-        score_table[score_key] = score
-
+            nodes[concept] = curie if isinstance(curie, list) else [curie]
+        score_table[frozenset(binding_ids(bindings))] = bindings.get('score', 0)
 
     # Step 2
-    # make a transformed graph in a structure that makes it easier to extract the parts for final merged kG graph.
-    knowledge_map_graph_repr = {
-        # frozenset(node_kg_id, node_q_id): [
-            # (other_node_kg_id, other_node_q_id), (edge_kg_id, edge_q_id)
-    #]
-    }
+    # index answers by the nodes they join on: (node_q_id, node_kg_ids) : {
+    #     (other_node_q_id, other_node_kg_ids): [ {edge_q_id: edge_kg_ids}, ... ]
+    # }
+    index = {}
+    # the curies of each node in the order first bound, as sets have none
+    curies = {}
     for answer in all_knowledge_maps:
         node_bindings = answer.get('node_bindings', {})
-        edge_bindings = answer.get('edge_bindings', [])
-        # first thing is let's find out potential source nodes
-        # remember the transformed_q_graph_edges , we are going to use that here as our meta map
-        freeze = lambda node_type, node_curie: frozenset({node_type, frozenset(node_curie)})
+        edge_bindings = answer.get('edge_bindings', {})
         for concept in node_bindings:
-            is_source = concept in transformed_q_graph_edges
-            if is_source:
-                target_concepts = transformed_q_graph_edges[concept]
-                # This would  be something like frozenset(curie, type)
-                source_node_key = freeze(node_type=concept, node_curie=node_bindings[concept])
-                # collected target nodes edges
-                target_bindings_dict = knowledge_map_graph_repr.get(source_node_key, {})
-                for target_concept in target_concepts:
-                    # grab a target instance from node bindings
-                    target_curie = node_bindings.get(target_concept, None)
-                    if target_curie:
-                        target_node_key = freeze(node_type=target_concept, node_curie=node_bindings[target_concept])
-                        edges = []
-                        # collect the edge(s), using the query graph edge id
-                        edge_q_ids = transformed_q_graph_edges[concept][target_concept]
-                        for edge_q_id in edge_q_ids:
-                            if edge_q_id in edge_bindings:
-                                edges.append({
-                                    edge_q_id: edge_bindings[edge_q_id]
-                                })
-                        # If there are edges add them.
-                        if edges:
-                            target_bindings_dict[target_node_key] = target_bindings_dict.get(target_node_key, [])
-                            target_bindings_dict[target_node_key] += edges
-                knowledge_map_graph_repr[source_node_key] = target_bindings_dict
-
-    # Using depth first search extract possible paths
-    # from knowledge_map_graph_repr
-    paths = []
-    all_visits = set()
-    for node in knowledge_map_graph_repr:
-        visited = set()
-        if node not in all_visits and knowledge_map_graph_repr[node]:
-            find_all_paths(graph=knowledge_map_graph_repr, start=node,edge=None, visited=visited, stack=[], paths=paths)
-            # mark all items in paths as visited so we don't start form them and have partial duplicates
-            visited = set(map (lambda pair: pair[0], reduce(lambda accu, path: path + accu, paths , [])))
-            all_visits.update(visited)
-
+            if concept not in transformed_q_graph_edges:
+                continue
+            target_concepts = transformed_q_graph_edges[concept]
+            source = (concept, frozenset(node_bindings[concept]))
+            curies.setdefault(source, node_bindings[concept])
+            targets = index.setdefault(source, {})
+            for target_concept in target_concepts:
+                target_curie = node_bindings.get(target_concept, None)
+                if not target_curie:
+                    continue
+                # collect the edge(s), using the query graph edge id
+                edges = [{edge_q_id: edge_bindings[edge_q_id]}
+                         for edge_q_id in target_concepts[target_concept] if edge_q_id in edge_bindings]
+                if edges:
+                    target = (target_concept, frozenset(target_curie))
+                    curies.setdefault(target, target_curie)
+                    targets.setdefault(target, []).extend(edges)
 
+    # Step 3
+    # join from every node not already part of a joined answer, so partial answers aren't repeated.
     merged_answers = []
-    for path in paths:
-        answer = {
-            'node_bindings': {},
-            'edge_bindings': {}
-        }
-        for node_data, edge_data in path:
-            node_0, node_1 = node_data
-            # sometimes for the frozenset data structure the order gets messed up so checking for string
-            node_q_id, node_kg_id = [node_0, node_1] if isinstance(node_0, str) else [node_1, node_0]
-
-            answer['node_bindings'][node_q_id] = list(node_kg_id)
-            # Edge data contains information about incoming edge not out going so start nodes don't have any.
-            if edge_data:
-                for e in edge_data:
-                    answer['edge_bindings'].update(e)
-            answer['score'] = 0 # default score is 0
-        merged_answers.append(answer)
+    all_visits = set()
+    for node in index:
+        if node in all_visits or not index[node]:
+            continue
+        for path in iter_paths(index, node):
+            answer = {
+                'node_bindings': {},
+                'edge_bindings': {},
+                'score': 0  # default score is 0
+            }
+            for node, edge_data in path:
+                all_visits.add(node)
+                answer['node_bindings'][node[0]] = list(curies[node])
+                # Edge data contains information about incoming edge not out going so start nodes don't have any.
+                for e in edge_data or []:
+                    for edge_q_id, edge_kg_ids in e.items():
+                        answer['edge_bindings'][edge_q_id] = copy.copy(edge_kg_ids)
+            merged_answers.append(answer)
     # answer_sets
-    overlay_score(merged_answers, score_table)
+    overlay_score(merged_answers, score_table, score_policy)
     return merged_answers
 
-def overlay_score(merged_answers, score_table):
-    for score_key in score_table:
-        if score_table[score_key] == 0:
+def binding_ids(answer):
+    """ The first node and edge id of each of an answer's bindings, which scores are keyed on. """
+    node_bindings = answer.get('node_bindings', {})
+    edge_bindings = answer.get('edge_bindings', {})
+    return [node_bindings[concept][0] for concept in node_bindings] + \
+        [edge_bindings[edge_id][0] for edge_id in edge_bindings]
+
+
+def overlay_score(merged_answers, score_table, score_policy='last'):
+    """
+    Give each merged answer the scores of the original answers whose bindings it contains,
+    combined by a SCORE_POLICIES policy. Merged answers are indexed by binding id, so each
+    score key only visits the answers binding every id in it. Zero scores are ignored.
+    """
+    if score_policy not in SCORE_POLICIES:
+        raise ValueError(f"Unknown score policy {score_policy}. Expected one of {', '.join(SCORE_POLICIES)}.")
+    combine = SCORE_POLICIES[score_policy]
+    index = {}
+    for position, answer in enumerate(merged_answers):
+        for identifier in binding_ids(answer):
+            index.setdefault(identifier, set()).add(position)
+    scores = {}
+    for score_key, score in score_table.items():
+        if score == 0:
             continue
-        for answer in merged_answers:
-            node_bindings = list(map(lambda x: answer['node_bindings'][x][0], answer['node_bindings']))
-            edge_bindings = list(map(lambda x: answer['edge_bindings'][x][0], answer['edge_bindings']))
-            # make sure score key contains all nodes
-            filterd = list(filter(lambda x: x not in node_bindings, score_key))
-            # make sure edges are also contained
-            filterd = list(filter(lambda x: x not in edge_bindings, filterd))
-            # if 'filterd' is empty means this answer contains all the edges and nodes so will give it that score
-            # @TODO maybe have score be a asscoiated with sets of nodes, so it perseves origninal meaning that the
-            # @TODO kp intented
-            if len(filterd) == 0:
-                answer['score'] = score_table[score_key]
-
-
-
-def find_all_paths(graph, start, edge, visited = set(),stack= [], paths=[]):
-    stack.append([start, edge])
-    visited.add(start)
-    if start not in graph or not bool(len(graph[start])):
-        paths.append(copy.deepcopy(stack))
-        stack.pop(len(stack) - 1)
-        visited.remove(start)
+        if len(score_key) == 0:
+            positions = range(len(merged_answers))
+        else:
+            postings = sorted((index.get(identifier, set()) for identifier in score_key), key=len)
+            positions = postings[0].intersection(*postings[1:])
+        for position in positions:
+            scores[position] = combine(scores[position], score) if position in scores else score
+    for position, score in scores.items():
+        merged_answers[position]['score'] = score
+
+
+def iter_paths(graph, start, edge=None):
+    """
+    Every path from start to a node without successors that visits no node twice, depth first,
+    as lists of [node, incoming edge] pairs. Iterative over one shared stack, so long paths don't
+    reach the recursion limit and only the paths found are copied.
+    """
+    stack = [[start, edge]]
+    visited = {start}
+    if not graph.get(start):
+        yield [list(pair) for pair in stack]
         return
-    for node in graph[start]:
-        if node not in visited:
-            find_all_paths(graph, node, graph[start][node], visited, stack, paths)
-    # remove the item from stack once its loop through
-    if len(stack):
-        node, edge = stack.pop(len(stack) - 1)
-        visited.remove(node)
+    successors = [iter(graph[start])]
+    while successors:
+        for node in successors[-1]:
+            if node in visited:
+                continue
+            stack.append([node, graph[stack[-1][0]][node]])
+            if graph.get(node):
+                visited.add(node)
+                successors.append(iter(graph[node]))
+            else:
+                yield [list(pair) for pair in stack]
+                stack.pop()
+            break
+        else:
+            successors.pop()
+            visited.discard(stack.pop()[0])
+
+
+class MergeAccumulator:
+    """
+    Merge KGS responses one at a time as they arrive, into the same result merging all of them
+    at once would give. Nodes sharing an equivalent identifier, or a name with name_based_merging,
+    merge into the first of them, duplicate edges into the first of them, and node and edge
+    bindings are pointed at the winners. Running indexes from ids to the edges and answers
+    referencing them keep each response's work proportional to its own size and to what it
+    changes, so a response can be released once added. A cluster joined late by a bridging node
+    merges into the earliest cluster, taking its scalar properties cluster by cluster.
+    """
+    def __init__(self, question_graph=None, root_order=None, name_based_merging=True, resolve_name=None,
+                 score_policy='last'):
+        if score_policy not in SCORE_POLICIES:
+            raise ValueError(f"Unknown score policy {score_policy}. Expected one of {', '.join(SCORE_POLICIES)}.")
+        self.question_graph = question_graph
+        self.root_order = root_order
+        self.name_based_merging = name_based_merging
+        self.resolve_name = resolve_name
+        self.score_policy = score_policy
+        self.clusters = IdentifierClusters()
+        # cluster root : id of the node the cluster merged into
+        self.canonical = {}
+        # node id : [arrival, node], for nodes not merged away, in arrival order
+        self.nodes = {}
+        # merged away node id : id of the node it was merged into, and the reverse
+        self.node_ids = {}
+        self.merged_node_ids = {}
+        # edge key : [arrival, edge], for edges not merged away
+        self.edges = {}
+        # merged away edge id : id of the edge it was merged into, and the reverse
+        self.edge_ids = {}
+        self.merged_edge_ids = {}
+        # node id as written : keys of the edges / answers referencing it
+        self.node_edges = {}
+        self.node_answers = {}
+        self.edge_bindings = EdgeBindingIndex()
+        self.question_edges = {}
+        self.answers = []
+        self.arrivals = 0
+
+    def add(self, response):
+        """ Merge a response into the result. """
+        knowledge_graph = response.get(KNOWLEDGE_GRAPH_KEY, {})
+        nodes = knowledge_graph.get('nodes', [])
+        edges = knowledge_graph.get('edges', [])
+        self.normalize(nodes, edges)
+        replaced = []
+        for node in nodes:
+            replaced.extend(self.add_node(node))
+        for node_id in replaced:
+            self.replace_node_id(node_id, self.node_ids[node_id])
+        node_ids = self.node_ids
+        for edge in edges:
+            edge['source_id'] = node_ids.get(edge['source_id'], edge['source_id'])
+            edge['target_id'] = node_ids.get(edge['target_id'], edge['target_id'])
+            self.arrivals += 1
+            self.add_edge(self.arrivals, edge)
+        for edge in response.get(QUESTION_GRAPH_KEY, {}).get('edges', []):
+            self.question_edges.setdefault((edge['source_id'], edge['target_id'], edge['id']), edge)
+        answers = response.get(KNOWLEDGE_MAP_KEY, [])
+        for answer in answers:
+            node_bindings = answer.get('node_bindings', {})
+            for concept in node_bindings:
+                curies = node_bindings[concept]
+                curies = [node_ids.get(curie, curie) for curie in (curies if isinstance(curies, list) else [curies])]
+                node_bindings[concept] = curies
+                for curie in curies:
+                    self.node_answers.setdefault(curie, []).append(answer)
+            answer['node_bindings'] = node_bindings
+        self.edge_bindings.add(answers, self.edge_ids)
+        self.answers.extend(answers)
+
+    def normalize(self, nodes, edges):
+        """ Give nodes and edges a list of types, and nodes a list of equivalent identifiers including their own id. """
+        for node in nodes:
+            if 'type' not in node:
+                node['type'] = []
+            if not isinstance(node['type'], list):
+                node['type'] = [node['type']]
+            if 'equivalent_identifiers' not in node:
+                ids = [node['id']]
+                if self.resolve_name is not None:
+                    ids = self.resolve_name(node.get('name', None), node.get('type', ''))
+                node['equivalent_identifiers'] = ids
+            if isinstance(node['equivalent_identifiers'], str):
+                if node['equivalent_identifiers'] == 'None':
+                    node['equivalent_identifiers'] = []
+                else:
+                    node['equivalent_identifiers'] = [node['equivalent_identifiers']]
+            if node['id'] not in node['equivalent_identifiers']:
+                node['equivalent_identifiers'].append(node['id'])
+        for edge in edges:
+            if 'type' not in edge:
+                edge['type'] = []
+            if not isinstance(edge['type'], list):
+                edge['type'] = [edge['type']]
+
+    def add_node(self, node):
+        """ Merge a node into its cluster. Returns the ids that now belong to another node. """
+        identifiers = node['equivalent_identifiers']
+        if self.name_based_merging and node.get('name', None) is not None:
+            # Nodes with the same name are the same node. A tuple never collides with an identifier.
+            node['equivalent_identifiers'] = list(set(identifiers))
+            identifiers = node['equivalent_identifiers'] + [('name', node['name'])]
+        merging = []
+        root = self.clusters.find(node['id'])
+        for identifier in identifiers:
+            other = self.clusters.find(identifier)
+            if other != root:
+                for cluster in (root, other):
+                    if cluster in self.canonical:
+                        merging.append(self.nodes[self.canonical.pop(cluster)])
+                root = self.clusters.union(root, other)
+        if root in self.canonical:
+            merging.append(self.nodes[self.canonical[root]])
+        if len(merging) == 0:
+            self.canonical[root] = node['id']
+            self.arrivals += 1
+            self.nodes[node['id']] = [self.arrivals, node]
+            return []
+        merging.sort(key=lambda pair: pair[0])
+        first = merging[0][1]
+        self.canonical[root] = first['id']
+        replaced = []
+        for arrival, other in merging[1:] + [[None, node]]:
+            if other['id'] != first['id']:
+                replaced.append(other['id'])
+                self.nodes.pop(other['id'], None)
+                # Keep the map flat, so ids merged into the other node now lead to the first.
+                merged_ids = self.merged_node_ids.pop(other['id'], []) + [other['id']]
+                for merged_id in merged_ids:
+                    self.node_ids[merged_id] = first['id']
+                self.merged_node_ids.setdefault(first['id'], []).extend(merged_ids)
+            # Ensure that both nodes' properties are represented in the merged node.
+            light_merge(first, other)
+            light_merge(other, first)
+        return replaced
+
+    def replace_node_id(self, old_id, new_id):
+        """ Point the edges and answers referencing a node id at another, merging edges that become duplicates. """
+        for key in self.node_edges.pop(old_id, []):
+            if key not in self.edges:
+                continue  # re-keyed already
+            arrival, edge = self.edges.pop(key)
+            if edge['source_id'] == old_id:
+                edge['source_id'] = new_id
+            if edge['target_id'] == old_id:
+                edge['target_id'] = new_id
+            self.add_edge(arrival, edge)
+        answers = self.node_answers.pop(old_id, [])
+        for answer in answers:
+            node_bindings = answer['node_bindings']
+            for concept in node_bindings:
+                node_bindings[concept] = [new_id if curie == old_id else curie for curie in node_bindings[concept]]
+        self.node_answers.setdefault(new_id, []).extend(answers)
+
+    def add_edge(self, arrival, edge):
+        """ Add an edge, merging it with the edge of the same types and endpoints if there is one. """
+        key = (tuple(sorted(edge['type'])), edge['source_id'], edge['target_id'])
+        current = self.edges.get(key, None)
+        if current is None:
+            self.edges[key] = [arrival, edge]
+            self.node_edges.setdefault(edge['source_id'], []).append(key)
+            self.node_edges.setdefault(edge['target_id'], []).append(key)
+            return
+        if arrival < current[0]:
+            # An edge re-keyed by a node merge can precede the edge it now duplicates.
+            self.edges[key] = [arrival, edge]
+            first, other = edge, current[1]
+        else:
+            first, other = current[1], edge
+        old_id, new_id = other['id'], first['id']
+        light_merge(first, other)
+        light_merge(other, first)
+        if old_id != new_id and old_id not in self.edge_ids:
+            merged_ids = self.merged_edge_ids.pop(old_id, []) + [old_id]
+            for merged_id in merged_ids:
+                self.edge_ids[merged_id] = new_id
+            self.merged_edge_ids.setdefault(new_id, []).extend(merged_ids)
+            self.edge_bindings.rewrite({old_id: new_id})
+
+    def snapshot(self):
+        """
+        The merged response so far. Its knowledge graph shares node and edge objects with the
+        accumulator, so later responses may still merge into them.
+        """
+        responses = [{
+            QUESTION_GRAPH_KEY: {'edges': list(self.question_edges.values())},
+            KNOWLEDGE_MAP_KEY: self.answers
+        }]
+        return {
+            KNOWLEDGE_GRAPH_KEY: {
+                'nodes': [node for arrival, node in self.nodes.values()],
+                'edges': [edge for arrival, edge in sorted(self.edges.values(), key=lambda pair: pair[0])]
+            },
+            KNOWLEDGE_MAP_KEY: connect_knowledge_maps(responses, self.root_order, self.score_policy),
+            QUESTION_GRAPH_KEY: self.question_graph
+        }
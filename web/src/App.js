@@ -537,6 +537,8 @@ SELECT population_of_individual_organisms->chemical_substance->gene->biological_
     // Get valid options in the `from` clause and their respective `reasoner` values.
     // Doesn't belong in state.
     this.reasonerURLs = this._getReasonerURLs ();
+    // Types reachable from and reaching each type, possibly through intermediate types.
+    this.reachableTypes = this._getReachableTypes ();
 
     // Promises
     this.schemaPromise = new Promise(()=>{});
@@ -1054,6 +1056,18 @@ SELECT population_of_individual_organisms->chemical_substance->gene->biological_
                     return edge.target_id
                   }
                 })
+                if (predicate[1] === "") {
+                  // Without a predicate, the planner bridges types no reasoner connects through intermediate types.
+                  setLoading(true);
+                  const reachableTypes = await this.reachableTypes;
+                  setLoading(false);
+                  const entry = reachableTypes[previousConcept];
+                  if (entry !== undefined) {
+                    validConcepts = validConcepts.concat((backwards ? entry.reaching : entry.reachable)
+                      .filter(([type, hops]) => hops > 1 && type.startsWith(currentConcept))
+                      .map(([type, hops]) => type));
+                  }
+                }
               }
               validConcepts = validConcepts.unique().map((concept) => {
                 return {
@@ -1749,6 +1763,17 @@ SELECT population_of_individual_organisms->chemical_substance->gene->biological_
 
     return reasonerURLs;
   }
+  /**
+   * Get the types reachable from and reaching each schema type
+   *
+   * @private
+   */
+  async _getReachableTypes () {
+    const res = await fetch(this.tranqlURL + '/tranql/schema/reachable', {
+      method: "GET",
+    })
+    return await res.json();
+  }
   /**
    * Get the concept model and stores as state.
    *